@@ -0,0 +1,236 @@
+import os
+import re
+import asyncio
+import hashlib
+import tempfile
+from typing import AsyncIterator, Optional
+
+CHUNK_SIZE = 256 * 1024
+BLOB_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_blob_hash(value: str) -> bool:
+    return bool(value) and bool(BLOB_HASH_RE.match(value))
+
+
+def blob_url(blob_hash: str) -> str:
+    return f"/api/blobs/{blob_hash}"
+
+
+class BlobStore:
+    """Content-addressed storage; blobs are immutable and keyed by SHA-256 hex digest."""
+
+    async def exists(self, blob_hash: str) -> bool:
+        raise NotImplementedError
+
+    async def put(self, data: bytes) -> str:
+        raise NotImplementedError
+
+    async def open_writer(self) -> "BlobWriter":
+        raise NotImplementedError
+
+    def iter_chunks(self, blob_hash: str) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    def read_sync(self, blob_hash: str) -> bytes:
+        # Blocking read used by the renderer/filters, which never run on the event loop
+        raise NotImplementedError
+
+    async def delete(self, blob_hash: str):
+        # Only for blobs no record refers to any more; a missing blob is not an error
+        raise NotImplementedError
+
+
+class BlobWriter:
+    """Accepts a blob chunk by chunk, hashing as it goes; nothing is addressable until commit()."""
+
+    def __init__(self):
+        self.size = 0
+        self._hasher = hashlib.sha256()
+
+    async def write(self, chunk: bytes):
+        self._hasher.update(chunk)
+        self.size += len(chunk)
+        await self._write(chunk)
+
+    async def _write(self, chunk: bytes):
+        raise NotImplementedError
+
+    async def commit(self) -> str:
+        raise NotImplementedError
+
+    async def abort(self):
+        raise NotImplementedError
+
+
+class LocalBlobWriter(BlobWriter):
+    def __init__(self, store: "LocalBlobStore"):
+        super().__init__()
+        self.store = store
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.join(store.root, "tmp"))
+        self._file = os.fdopen(fd, "wb")
+
+    async def _write(self, chunk: bytes):
+        await asyncio.to_thread(self._file.write, chunk)
+
+    def _finish(self, blob_hash: str):
+        self._file.close()
+        path = self.store._path(blob_hash)
+        if os.path.exists(path):
+            os.unlink(self.tmp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp_path, path)
+
+    async def commit(self) -> str:
+        blob_hash = self._hasher.hexdigest()
+        await asyncio.to_thread(self._finish, blob_hash)
+        return blob_hash
+
+    async def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+class GridFSBlobWriter(BlobWriter):
+    def __init__(self, store: "GridFSBlobStore"):
+        super().__init__()
+        self.store = store
+        # Written under a temporary name and renamed to its hash once complete
+        self._stream = store.bucket.open_upload_stream(f"tmp-{os.urandom(8).hex()}")
+
+    async def _write(self, chunk: bytes):
+        await self._stream.write(chunk)
+
+    async def commit(self) -> str:
+        blob_hash = self._hasher.hexdigest()
+        await self._stream.close()
+        if await self.store.exists(blob_hash):
+            await self.store.bucket.delete(self._stream._id)
+        else:
+            await self.store.bucket.rename(self._stream._id, blob_hash)
+        return blob_hash
+
+    async def abort(self):
+        await self._stream.abort()
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+    def _path(self, blob_hash: str) -> str:
+        if not is_blob_hash(blob_hash):
+            raise ValueError(f"Invalid blob hash: {blob_hash!r}")
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    async def exists(self, blob_hash: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(blob_hash))
+
+    def _write(self, blob_hash: str, data: bytes):
+        path = self._path(blob_hash)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def put(self, data: bytes) -> str:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, blob_hash, data)
+        return blob_hash
+
+    async def open_writer(self) -> BlobWriter:
+        return LocalBlobWriter(self)
+
+    async def iter_chunks(self, blob_hash: str) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self._path(blob_hash), "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def read_sync(self, blob_hash: str) -> bytes:
+        with open(self._path(blob_hash), "rb") as f:
+            return f.read()
+
+    def _delete(self, blob_hash: str):
+        try:
+            os.unlink(self._path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, blob_hash: str):
+        await asyncio.to_thread(self._delete, blob_hash)
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, mongo_url: str, db_name: str, db=None, bucket_name: str = "blob_data"):
+        self.db = db
+        self.db_name = db_name
+        self.mongo_url = mongo_url
+        self.bucket_name = bucket_name
+        self.bucket = None
+        self._sync_bucket = None
+        # Worker processes only read synchronously and don't get an async database handle
+        if db is not None:
+            from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+            self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+
+    async def exists(self, blob_hash: str) -> bool:
+        doc = await self.db[f"{self.bucket_name}.files"].find_one({"filename": blob_hash}, {"_id": 1})
+        return doc is not None
+
+    async def put(self, data: bytes) -> str:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if not await self.exists(blob_hash):
+            await self.bucket.upload_from_stream(blob_hash, data)
+        return blob_hash
+
+    async def open_writer(self) -> BlobWriter:
+        return GridFSBlobWriter(self)
+
+    async def iter_chunks(self, blob_hash: str) -> AsyncIterator[bytes]:
+        stream = await self.bucket.open_download_stream_by_name(blob_hash)
+        try:
+            while True:
+                chunk = await stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+    def read_sync(self, blob_hash: str) -> bytes:
+        if self._sync_bucket is None:
+            import gridfs
+            from pymongo import MongoClient
+
+            sync_db = MongoClient(self.mongo_url)[self.db_name]
+            self._sync_bucket = gridfs.GridFSBucket(sync_db, bucket_name=self.bucket_name)
+        return self._sync_bucket.open_download_stream_by_name(blob_hash).read()
+
+    async def delete(self, blob_hash: str):
+        async for doc in self.db[f"{self.bucket_name}.files"].find({"filename": blob_hash}, {"_id": 1}):
+            await self.bucket.delete(doc["_id"])
+
+
+def create_blob_store(kind: str, db=None, mongo_url: Optional[str] = None, root: Optional[str] = None, db_name: str = "pixelcrafter") -> BlobStore:
+    if kind == "local":
+        return LocalBlobStore(root)
+    if kind == "gridfs":
+        return GridFSBlobStore(mongo_url, db_name, db=db)
+    raise ValueError(f"Unknown blob store: {kind!r}")
@@ -0,0 +1,456 @@
+# Collaboration fan-out. Every broadcast goes through a backplane, so sockets for the same project
+# connected to different workers (or nodes) all receive it; a worker only listens on a project's
+# channel while it has local sockets for that project.
+import hmac
+import json
+import os
+import time
+import uuid
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import msgpack
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+
+from jobs import DurationStats
+
+Handler = Callable[[str, str], Awaitable[None]]  # (project_id, encoded message)
+
+
+class Backplane:
+    async def subscribe(self, project_id: str, handler: Handler):
+        raise NotImplementedError
+
+    async def unsubscribe(self, project_id: str, handler: Handler):
+        raise NotImplementedError
+
+    async def publish(self, project_id: str, message: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """In-process backplane for a single worker. Several managers can share one instance to stand in for several workers in tests."""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+        self.published = 0
+
+    async def subscribe(self, project_id: str, handler: Handler):
+        self._handlers.setdefault(project_id, []).append(handler)
+
+    async def unsubscribe(self, project_id: str, handler: Handler):
+        handlers = self._handlers.get(project_id, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._handlers.pop(project_id, None)
+
+    async def publish(self, project_id: str, message: str):
+        self.published += 1
+        for handler in list(self._handlers.get(project_id, [])):
+            await handler(project_id, message)
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub backplane: one channel per project, one pub/sub connection per worker."""
+
+    def __init__(self, url: str, prefix: str = "pixelcrafter:project:"):
+        from redis import asyncio as aioredis
+
+        self._redis = aioredis.from_url(url)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._prefix = prefix
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._reader: Optional[asyncio.Task] = None
+        self.published = 0
+
+    async def subscribe(self, project_id: str, handler: Handler):
+        handlers = self._handlers.setdefault(project_id, [])
+        handlers.append(handler)
+        if len(handlers) == 1:
+            await self._pubsub.subscribe(self._prefix + project_id)
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+
+    async def unsubscribe(self, project_id: str, handler: Handler):
+        handlers = self._handlers.get(project_id, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers and self._handlers.pop(project_id, None) is not None:
+            await self._pubsub.unsubscribe(self._prefix + project_id)
+
+    async def publish(self, project_id: str, message: str):
+        self.published += 1
+        await self._redis.publish(self._prefix + project_id, message)
+
+    async def _read(self):
+        while True:
+            try:
+                item = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Connection hiccup: redis-py reconnects and resubscribes on the next call
+                await asyncio.sleep(1.0)
+                continue
+            if item is None or item["type"] != "message":
+                continue
+            project_id = item["channel"].decode("utf-8")[len(self._prefix):]
+            message = item["data"].decode("utf-8")
+            for handler in list(self._handlers.get(project_id, [])):
+                await handler(project_id, message)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        await self._pubsub.close()
+        await self._redis.close()
+
+
+def create_backplane(kind: str, redis_url: Optional[str] = None) -> Backplane:
+    if kind == "redis":
+        return RedisBackplane(redis_url)
+    if kind == "local":
+        return LocalBackplane()
+    raise ValueError(f"Unknown collaboration backplane: {kind}")
+
+
+# Negotiated through Sec-WebSocket-Protocol; clients that offer neither get plain JSON text frames
+JSON_SUBPROTOCOL = "pixelcrafter.json"
+MSGPACK_SUBPROTOCOL = "pixelcrafter.msgpack"
+
+
+def negotiate_subprotocol(offered: List[str]) -> Optional[str]:
+    for subprotocol in (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL):
+        if subprotocol in offered:
+            return subprotocol
+    return None
+
+
+TRANSIENT_TYPES = {"cursor", "tool_change", "selection"}  # superseded by the next message of the same kind
+
+
+def transient_key(message: dict, sender_id: str) -> Optional[str]:
+    # Transient messages from the same sender replace each other in a queue; everything else is delivered in full
+    if message.get("type") in TRANSIENT_TYPES:
+        return f"{message['type']}:{sender_id}"
+    return None
+
+
+def encode_envelope(payload: str, key: Optional[str], sender_id: str = "") -> str:
+    # The payload is compact JSON and never contains a raw newline, so the first line is always the header
+    return f"{sender_id}\t{key or ''}\n{payload}"
+
+
+def decode_envelope(envelope: str) -> Tuple[str, Optional[str], str]:
+    header, payload = envelope.split("\n", 1)
+    sender_id, key = header.split("\t", 1)
+    return payload, key or None, sender_id
+
+
+class TransientThrottle:
+    """Latest-wins rate limit for one sender's transient messages, applied per message type.
+
+    A message arriving within `interval` of the previous one of its type is held back; if more arrive
+    before the slot opens, only the newest is forwarded. A burst of 120 cursor moves a second thus
+    becomes at most 1/interval forwarded messages, and the last position always gets through.
+    """
+
+    def __init__(self, interval: float, forward: Callable[[dict], Awaitable], stats: "FanoutStats"):
+        self.interval = interval
+        self._forward = forward
+        self._stats = stats
+        self._last_forwarded: Dict[str, float] = {}
+        self._pending: Dict[str, dict] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    async def submit(self, message: dict):
+        kind = message["type"]
+        self._stats.transient_received += 1
+        wait = self._last_forwarded.get(kind, float("-inf")) + self.interval - time.monotonic()
+        if wait <= 0 and kind not in self._timers:
+            self._last_forwarded[kind] = time.monotonic()
+            self._stats.transient_forwarded += 1
+            await self._forward(message)
+            return
+
+        if kind in self._pending:
+            self._stats.transient_coalesced += 1
+        self._pending[kind] = message
+        if kind not in self._timers:
+            self._timers[kind] = asyncio.get_running_loop().call_later(max(0.0, wait), self._flush, kind)
+
+    def _flush(self, kind: str):
+        self._timers.pop(kind, None)
+        message = self._pending.pop(kind, None)
+        if message is not None:
+            self._last_forwarded[kind] = time.monotonic()
+            self._stats.transient_forwarded += 1
+            asyncio.ensure_future(self._forward(message))
+
+    def cancel(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+
+
+class ClientConnection:
+    """The outbound side of one socket: a bounded queue drained by its own writer task.
+
+    A slow client only ever delays its own queue. When the queue is full, queued transient messages
+    are dropped first; a client that still can't keep up with durable messages (or stalls on a single
+    send for `send_timeout`) is disconnected so it can reload instead of silently missing edits.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int, send_timeout: float, stats: "FanoutStats", on_close: Callable[["ClientConnection"], None], binary: bool = False):
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.binary = binary
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.closed = False
+        self.throttle: Optional[TransientThrottle] = None
+        self._stats = stats
+        self._on_close = on_close
+        self._queue: Deque[list] = deque()  # [key, payload, queued_at]
+        self._transient: Dict[str, list] = {}
+        self._ready = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._write())
+
+    def enqueue(self, payload: Union[str, bytes], key: Optional[str] = None):
+        if self.closed:
+            return
+        if key is not None and key in self._transient:
+            self._transient[key][1] = payload
+            self._stats.coalesced += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            if key is not None:
+                self._stats.dropped += 1
+                return
+            if not self._drop_oldest_transient():
+                self._stats.slow_disconnects += 1
+                self.close(code=1013)
+                return
+
+        entry = [key, payload, time.monotonic()]
+        self._queue.append(entry)
+        if key is not None:
+            self._transient[key] = entry
+        self._stats.queued += 1
+        self._stats.max_queue_depth = max(self._stats.max_queue_depth, len(self._queue))
+        self._ready.set()
+
+    def _drop_oldest_transient(self) -> bool:
+        for entry in self._queue:
+            if entry[0] is not None:
+                self._queue.remove(entry)
+                del self._transient[entry[0]]
+                self._stats.dropped += 1
+                return True
+        return False
+
+    async def _write(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            key, payload, queued_at = self._queue.popleft()
+            if key is not None:
+                del self._transient[key]
+            try:
+                send = self.websocket.send_bytes if isinstance(payload, bytes) else self.websocket.send_text
+                await asyncio.wait_for(send(payload), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self._stats.slow_disconnects += 1
+                self.close(code=1013, from_writer=True)
+                return
+            except Exception:
+                self.close(from_writer=True)
+                return
+            self._stats.sent += 1
+            self._stats.delivery.add(time.monotonic() - queued_at)
+
+    def close(self, code: int = 1000, from_writer: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._transient.clear()
+        if self.throttle is not None:
+            self.throttle.cancel()
+        if not from_writer:
+            self._writer.cancel()
+        self._on_close(self)
+        asyncio.ensure_future(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class FanoutStats:
+    def __init__(self, max_tracked_projects: int = 1000):
+        self.broadcasts = 0
+        self.bytes_published = 0
+        self.bytes_queued = 0
+        # project_id -> [broadcasts, payload bytes, bytes queued to sockets], least recently active evicted first
+        self.projects: "OrderedDict[str, list]" = OrderedDict()
+        self.max_tracked_projects = max_tracked_projects
+        # /api/metrics is public, so projects are reported under a keyed hash of their id; the key lives only in
+        # this process, which keeps a label stable across scrapes without letting it be matched to a project
+        self._label_key = os.urandom(16)
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self.max_queue_depth = 0
+        self.delivery = DurationStats()
+        self.transient_received = 0
+        self.transient_forwarded = 0
+        self.transient_coalesced = 0
+        self.durable_forwarded = 0
+
+    def record_broadcast(self, project_id: str, size: int, recipients: int):
+        self.broadcasts += 1
+        self.bytes_queued += size * recipients
+        entry = self.projects.pop(project_id, None) or [0, 0, 0]
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += size * recipients
+        self.projects[project_id] = entry
+        if len(self.projects) > self.max_tracked_projects:
+            self.projects.popitem(last=False)
+
+    def project_label(self, project_id: str) -> str:
+        return hmac.new(self._label_key, project_id.encode(), "sha256").hexdigest()[:12]
+
+    def top_projects(self, count: int = 10) -> List[dict]:
+        ranked = sorted(self.projects.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        return [
+            {"project": self.project_label(project_id), "broadcasts": broadcasts, "payload_bytes": payload, "bytes_queued": queued}
+            for project_id, (broadcasts, payload, queued) in ranked
+        ]
+
+    def snapshot(self) -> dict:
+        return {
+            "broadcasts": self.broadcasts,
+            "bytes_published": self.bytes_published,
+            "bytes_queued": self.bytes_queued,
+            "queued": self.queued,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "slow_disconnects": self.slow_disconnects,
+            "max_queue_depth": self.max_queue_depth,
+            "delivery": self.delivery.snapshot(),
+            "transient_received": self.transient_received,
+            "transient_forwarded": self.transient_forwarded,
+            "transient_coalesced": self.transient_coalesced,
+            "durable_forwarded": self.durable_forwarded,
+            "top_projects_by_bytes": self.top_projects()
+        }
+
+
+class ConnectionManager:
+    def __init__(self, backplane: Backplane, max_queue: int = 256, send_timeout: float = 5.0, transient_rate: float = 30.0):
+        self.backplane = backplane
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.transient_interval = 1.0 / transient_rate if transient_rate > 0 else 0.0
+        self.active_connections: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        self.fanout = FanoutStats()
+
+    async def connect(self, websocket: WebSocket, project_id: str) -> ClientConnection:
+        subprotocol = negotiate_subprotocol(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(
+            websocket, self.max_queue, self.send_timeout, self.fanout,
+            on_close=lambda closed: asyncio.ensure_future(self.disconnect(closed.websocket, project_id)),
+            binary=subprotocol == MSGPACK_SUBPROTOCOL
+        )
+        connection.throttle = TransientThrottle(
+            self.transient_interval,
+            lambda message: self.broadcast_to_project(project_id, message, sender_id=connection.id),
+            self.fanout
+        )
+        if project_id not in self.active_connections:
+            self.active_connections[project_id] = {}
+            await self.backplane.subscribe(project_id, self._deliver)
+        self.active_connections[project_id][websocket] = connection
+        return connection
+
+    async def disconnect(self, websocket: WebSocket, project_id: str):
+        connections = self.active_connections.get(project_id)
+        if connections is None:
+            return
+        connection = connections.pop(websocket, None)
+        if connection is not None and not connection.closed:
+            connection.close()
+        if not connections and self.active_connections.get(project_id) is connections:
+            del self.active_connections[project_id]
+            await self.backplane.unsubscribe(project_id, self._deliver)
+
+    async def receive(self, connection: ClientConnection) -> Any:
+        if connection.binary:
+            return msgpack.unpackb(await connection.websocket.receive_bytes())
+        return await connection.websocket.receive_json()
+
+    async def handle_message(self, connection: ClientConnection, project_id: str, message: dict):
+        """Relays a message received from a collaborator's socket to everyone else on the project."""
+        if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+            return
+        message = {**message, "sender": connection.id}
+        if message["type"] in TRANSIENT_TYPES:
+            await connection.throttle.submit(message)
+        else:
+            self.fanout.durable_forwarded += 1
+            await self.broadcast_to_project(project_id, message, sender_id=connection.id)
+
+    def send_to(self, connection: ClientConnection, message: dict):
+        # A reply to one socket (acks, errors); goes through its queue like any broadcast
+        encoded = jsonable_encoder(message)
+        connection.enqueue(msgpack.packb(encoded) if connection.binary else json.dumps(encoded, separators=(",", ":")))
+
+    async def broadcast_to_project(self, project_id: str, message: dict, sender_id: str = ""):
+        # Encoded once here; every worker (this one included) receives it back through the backplane
+        payload = json.dumps(jsonable_encoder(message), separators=(",", ":"))
+        self.fanout.bytes_published += len(payload)
+        await self.backplane.publish(project_id, encode_envelope(payload, transient_key(message, sender_id), sender_id))
+
+    async def _deliver(self, project_id: str, envelope: str):
+        # Only enqueues: the cost of a broadcast no longer depends on how fast any socket drains
+        payload, key, sender_id = decode_envelope(envelope)
+        packed = None
+        recipients = 0
+        for connection in list(self.active_connections.get(project_id, {}).values()):
+            if connection.id == sender_id:
+                continue
+            recipients += 1
+            if connection.binary:
+                # Still encoded once per broadcast, however many binary clients there are
+                if packed is None:
+                    packed = msgpack.packb(json.loads(payload))
+                connection.enqueue(packed, key)
+            else:
+                connection.enqueue(payload, key)
+        self.fanout.record_broadcast(project_id, len(payload), recipients)
+
+    def stats(self) -> dict:
+        return {
+            "projects": len(self.active_connections),
+            "connections": sum(len(connections) for connections in self.active_connections.values()),
+            **self.fanout.snapshot()
+        }
@@ -0,0 +1,84 @@
+import io
+import json
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from image_cache import DecodedImage
+
+
+def blur(image: Image.Image, radius: float) -> Image.Image:
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+def brightness(image: Image.Image, factor: float) -> Image.Image:
+    # One 256-entry lookup table applied to the colour channels, alpha is left untouched
+    lut = np.clip(np.arange(256, dtype=np.float32) * factor + 0.5, 0, 255).astype(np.uint8)
+    pixels = np.array(image)
+    pixels[..., :3] = lut[pixels[..., :3]]
+    return Image.fromarray(pixels, image.mode)
+
+
+# op name -> (function, {param: (default, min, max)})
+FILTERS = {
+    "blur": (blur, {"radius": (5.0, 0.0, 100.0)}),
+    "brightness": (brightness, {"factor": (1.2, 0.0, 10.0)}),
+}
+
+
+def normalize_chain(steps: List[dict]) -> List[dict]:
+    """Validates a filter chain and returns it in canonical form (defaults filled in, unknown params rejected)."""
+    chain = []
+    for step in steps:
+        op = step.get("op")
+        if op not in FILTERS:
+            raise ValueError(f"Unknown filter: {op}")
+        _, spec = FILTERS[op]
+        params = step.get("params") or {}
+        unknown = set(params) - set(spec)
+        if unknown:
+            raise ValueError(f"Unknown parameters for {op}: {', '.join(sorted(unknown))}")
+        normalized = {}
+        for name, (default, low, high) in spec.items():
+            value = float(params.get(name, default))
+            if not low <= value <= high:
+                raise ValueError(f"{op} {name} must be between {low} and {high}")
+            normalized[name] = round(value, 4)
+        chain.append({"op": op, "params": normalized})
+    return chain
+
+
+def chain_key(source_hash: str, chain: List[dict]) -> str:
+    return hashlib.sha256(json.dumps([source_hash, chain], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def apply_filter_chain(source: DecodedImage, chain: List[dict], quality: int = 85) -> Tuple[bytes, str]:
+    """Runs every step in memory on the decoded source and encodes once. Returns (encoded bytes, content type).
+
+    `quality` applies to lossy WebP sources, which are written back as lossy WebP.
+    """
+    # Steps return new images, so the shared pixels of the source are never modified
+    image = source.image()
+
+    for step in chain:
+        function, _ = FILTERS[step["op"]]
+        image = function(image, **step["params"])
+
+    if not source.has_alpha:
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    if source.format == "JPEG" and image.mode == "RGB":
+        image.save(out, "JPEG", quality=92, optimize=True)
+        return out.getvalue(), "image/jpeg"
+    if source.format == "WEBP":
+        # Stays in the source's own mode: lossless WebP keeps artwork exact, a lossy photo re-encoded
+        # losslessly would grow several times over
+        if source.lossless:
+            image.save(out, "WEBP", lossless=True, method=4)
+        else:
+            image.save(out, "WEBP", quality=quality, method=4)
+        return out.getvalue(), "image/webp"
+    image.save(out, "PNG", compress_level=6)
+    return out.getvalue(), "image/png"
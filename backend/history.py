@@ -0,0 +1,201 @@
+# Project history: an append-only log of the changes behind every revision, plus periodic snapshots.
+#
+# Each write appends one entry to `project_ops` describing how the project went from `base_revision`
+# to `revision` (layer ops in apply_ops() form, changed top-level fields, and the layer order when the
+# ops alone don't reproduce it). Every `snapshot_interval` revisions the current project document is
+# copied into `project_snapshots`, so any revision can be rebuilt from the nearest snapshot plus a short
+# tail of the log, and saves only ever append their changes rather than a copy of the whole project.
+#
+# Retention: snapshots and log entries older than `retention_days` are removed, except the newest
+# snapshot past the cutoff and the entries after it, which every retained revision still needs.
+#
+# The log is written after the project itself; if that insert fails the history has a gap and the
+# revisions it covered can't be rebuilt until the next snapshot, but the save itself stands.
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import DESCENDING
+
+from cache import TTLCache
+from layer_ops import apply_ops
+
+logger = logging.getLogger(__name__)
+
+# Kept out of snapshots: derived from the state itself and maintained separately
+SNAPSHOT_EXCLUDED = ("_id", "thumbnails", "thumbnail_revision")
+
+
+def replay(state: dict, entry: dict):
+    """Applies one log entry to a project state in place."""
+    layers = state.setdefault("layers", [])
+    apply_ops(layers, entry.get("ops", []))
+    order = entry.get("order")
+    if order:
+        position = {layer_id: index for index, layer_id in enumerate(order)}
+        layers.sort(key=lambda layer: position.get(layer.get("id"), len(position)))
+    state.update(entry.get("fields") or {})
+    state["revision"] = entry["revision"]
+
+
+class ProjectHistory:
+    def __init__(self, db, snapshot_interval: int = 50, retention_days: float = 30):
+        self.db = db
+        self.snapshot_interval = snapshot_interval
+        self.retention_days = retention_days
+        # Last snapshot revision per project, to decide when the next one is due without a query per save
+        self._snapshot_revisions = TTLCache(maxsize=10000, ttl=3600)
+        self._snapshotting: Dict[str, asyncio.Task] = {}
+        self.entries_written = 0
+        self.snapshots_written = 0
+        self.entries_compacted = 0
+        self.snapshots_compacted = 0
+        self.write_errors = 0
+
+    async def record(self, project_id: str, base_revision: int, revision: int, ops: List[dict],
+                     fields: Optional[dict] = None, order: Optional[List[str]] = None,
+                     user_id: Optional[str] = None, source: str = "patch", **extra):
+        """Appends the entry for base_revision -> revision; never raises, a failed insert only leaves a gap."""
+        entry = {
+            "project_id": project_id,
+            "revision": revision,
+            "base_revision": base_revision,
+            "ops": ops,
+            "source": source,
+            "user_id": user_id,
+            "created_at": datetime.utcnow()
+        }
+        if fields:
+            entry["fields"] = fields
+        if order:
+            entry["order"] = order
+        entry.update(extra)
+        try:
+            await self.db.project_ops.insert_one(entry)
+            self.entries_written += 1
+        except Exception:
+            self.write_errors += 1
+            logger.warning("History entry %s@%s could not be written", project_id, revision, exc_info=True)
+            return
+        await self._maybe_snapshot(project_id, revision)
+
+    async def _maybe_snapshot(self, project_id: str, revision: int):
+        last = self._snapshot_revisions.get(project_id)
+        if last is None:
+            latest = await self.db.project_snapshots.find_one(
+                {"project_id": project_id}, {"revision": 1}, sort=[("revision", DESCENDING)]
+            )
+            last = latest["revision"] if latest else None
+            if last is not None:
+                self._snapshot_revisions.set(project_id, last)
+        # Projects from before the log existed get their first snapshot on their next save
+        if (last is None or revision - last >= self.snapshot_interval) and project_id not in self._snapshotting:
+            task = asyncio.ensure_future(self.snapshot(project_id, revision=revision))
+            self._snapshotting[project_id] = task
+            task.add_done_callback(lambda _: self._snapshotting.pop(project_id, None))
+
+    async def snapshot(self, project_id: str, project: Optional[dict] = None, revision: Optional[int] = None):
+        """Stores `project` (or the stored project, if it is still at `revision`) and compacts the log.
+
+        Snapshots are only taken at revisions the log ends an entry on; a project read halfway through a
+        multi-statement patch is skipped, and the next save tries again.
+        """
+        try:
+            if project is None:
+                project = await self.db.projects.find_one({"id": project_id, "revision": revision})
+                if project is None:
+                    return
+            state = {key: value for key, value in project.items() if key not in SNAPSHOT_EXCLUDED}
+            revision = state.get("revision", 0)
+            await self.db.project_snapshots.update_one(
+                {"project_id": project_id, "revision": revision},
+                {"$setOnInsert": {"state": state, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+            self.snapshots_written += 1
+            self._snapshot_revisions.set(project_id, revision)
+            await self.compact(project_id)
+        except Exception:
+            self.write_errors += 1
+            logger.warning("Snapshot of %s could not be written", project_id, exc_info=True)
+
+    async def compact(self, project_id: str):
+        # Everything up to the newest snapshot past the retention cutoff is only needed for expired revisions
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        base = await self.db.project_snapshots.find_one(
+            {"project_id": project_id, "created_at": {"$lt": cutoff}}, {"revision": 1}, sort=[("revision", DESCENDING)]
+        )
+        if base is None:
+            return
+        entries = await self.db.project_ops.delete_many({"project_id": project_id, "revision": {"$lte": base["revision"]}})
+        snapshots = await self.db.project_snapshots.delete_many({"project_id": project_id, "revision": {"$lt": base["revision"]}})
+        self.entries_compacted += entries.deleted_count
+        self.snapshots_compacted += snapshots.deleted_count
+
+    async def state_at(self, project_id: str, revision: int) -> Optional[dict]:
+        """Rebuilds the project as it was at `revision`, or None if that revision is expired or not in the log."""
+        snapshot = await self.db.project_snapshots.find_one(
+            {"project_id": project_id, "revision": {"$lte": revision}}, sort=[("revision", DESCENDING)]
+        )
+        if snapshot is None:
+            return None
+        state = snapshot["state"]
+        current = snapshot["revision"]
+        cursor = self.db.project_ops.find(
+            {"project_id": project_id, "revision": {"$gt": current, "$lte": revision}}
+        ).sort("revision", 1)
+        async for entry in cursor:
+            if entry["base_revision"] != current:
+                # A gap in the log
+                return None
+            try:
+                replay(state, entry)
+            except ValueError:
+                return None
+            current = entry["revision"]
+        return state if current == revision else None
+
+    async def entry(self, project_id: str, revision: int) -> Optional[dict]:
+        return await self.db.project_ops.find_one({"project_id": project_id, "revision": revision}, {"_id": 0})
+
+    async def undo_target(self, project_id: str, head: int) -> Optional[int]:
+        """Revision an undo at `head` goes back to: the one before the latest change not already undone."""
+        entry = await self.entry(project_id, head)
+        while entry is not None and entry["source"] == "undo":
+            # Undoing again steps back past the change the previous undo reverted
+            entry = await self.entry(project_id, entry["restored_revision"])
+        return entry["base_revision"] if entry is not None else None
+
+    async def redo_target(self, project_id: str, head: int) -> Optional[Tuple[int, int]]:
+        """(revision to restore, undo entry being reverted) for a redo at `head`, or None if nothing was undone."""
+        entry = await self.entry(project_id, head)
+        while entry is not None and entry["source"] == "redo":
+            # Each redo reverted one undo; the next candidate is the undo just before it
+            undone = await self.entry(project_id, entry["redone_revision"])
+            entry = await self.entry(project_id, undone["base_revision"]) if undone is not None else None
+        if entry is None or entry["source"] != "undo":
+            return None
+        return entry["base_revision"], entry["revision"]
+
+    async def entries(self, project_id: str, before: Optional[int] = None, limit: int = 50) -> List[dict]:
+        query = {"project_id": project_id}
+        if before is not None:
+            query["revision"] = {"$lt": before}
+        cursor = self.db.project_ops.find(query, {"_id": 0}).sort("revision", DESCENDING).limit(limit)
+        return await cursor.to_list(limit)
+
+    async def delete(self, project_id: str):
+        self._snapshot_revisions.invalidate(project_id)
+        await self.db.project_ops.delete_many({"project_id": project_id})
+        await self.db.project_snapshots.delete_many({"project_id": project_id})
+
+    def stats(self) -> dict:
+        return {
+            "entries_written": self.entries_written,
+            "snapshots_written": self.snapshots_written,
+            "entries_compacted": self.entries_compacted,
+            "snapshots_compacted": self.snapshots_compacted,
+            "write_errors": self.write_errors,
+            "snapshots_in_progress": len(self._snapshotting)
+        }
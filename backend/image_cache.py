@@ -0,0 +1,129 @@
+# Decoded image pixels shared by all image work in one process (filters, renders, proxy pyramids).
+#
+# Entries are keyed by the content hash of the encoded image (the blob hash, or the SHA-256 of an inline
+# data: URI's bytes, which is the hash the blob store would give it) and bounded by total decoded bytes,
+# evicting least recently used first. Pixels are stored once as a read-only uint8 RGBA array; consumers
+# get zero-copy views of it, either the array itself or a PIL image mapped onto the same memory, and
+# anything that needs to modify the pixels copies first. A burst of jobs on the same image decodes it once.
+#
+# Eviction only drops the cache's reference: a consumer still holding a view keeps that buffer alive.
+import hashlib
+import io
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+
+class DecodedImage:
+    def __init__(self, pixels: np.ndarray, has_alpha: bool, source_format: Optional[str], lossless: bool = True):
+        pixels.flags.writeable = False
+        self.pixels = pixels  # uint8 RGBA, shape (height, width, 4), read-only
+        self.has_alpha = has_alpha  # False for sources without transparency (alpha is then always 255)
+        self.format = source_format  # e.g. "JPEG", "PNG"
+        self.lossless = lossless  # False for lossy encodings (JPEG, lossy WebP, ...)
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.pixels.nbytes
+
+    def image(self) -> Image.Image:
+        """A read-only RGBA image sharing the cached pixels; PIL operations on it return new images."""
+        return Image.frombuffer("RGBA", (self.width, self.height), self.pixels, "raw", "RGBA", 0, 1)
+
+
+def webp_is_lossless(raw: bytes) -> bool:
+    # The image data chunk tells: "VP8L" is lossless, "VP8 " lossy; extended files put other chunks before it
+    position = 12
+    while position + 8 <= len(raw):
+        fourcc = raw[position:position + 4]
+        if fourcc == b"VP8L":
+            return True
+        if fourcc == b"VP8 ":
+            return False
+        size = int.from_bytes(raw[position + 4:position + 8], "little")
+        position += 8 + size + (size & 1)
+    return False
+
+
+def decode_image(raw: bytes) -> DecodedImage:
+    image = Image.open(io.BytesIO(raw))
+    source_format = image.format
+    image.load()
+    # Palette images may carry transparency; treat them as having alpha, as the filters always have
+    has_alpha = "A" in image.getbands() or image.mode == "P"
+    pixels = np.asarray(image.convert("RGBA"))
+    if source_format == "WEBP":
+        lossless = webp_is_lossless(raw)
+    else:
+        lossless = source_format not in ("JPEG", "MPO", "AVIF", "HEIF")
+    return DecodedImage(pixels, has_alpha, source_format, lossless)
+
+
+def content_hash(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+class DecodedImageCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, DecodedImage]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, load: Callable[[], bytes]) -> DecodedImage:
+        """The decoded image for content hash `key`, calling `load` for its encoded bytes only on a miss."""
+        decoded = self._entries.get(key)
+        if decoded is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decoded
+        self.misses += 1
+        decoded = decode_image(load())
+        # Images larger than the whole budget are handed out but not kept
+        if decoded.nbytes <= self.max_bytes:
+            self._entries[key] = decoded
+            self.size += decoded.nbytes
+            self._evict()
+        return decoded
+
+    def resize(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# One per process; image workers size it from DECODED_CACHE_MB in image_jobs.init_worker()
+decoded_images = DecodedImageCache()
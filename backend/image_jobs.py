@@ -0,0 +1,77 @@
+# CPU-bound image work executed in the JobPool's worker processes.
+# Each worker opens its own blob store in init_worker(); arguments and results must be picklable.
+from typing import Dict, List, Optional, Sequence
+
+from blob_store import create_blob_store
+from filters import apply_filter_chain
+from image_cache import decoded_images
+from ingest import normalize_image
+from render import SourceCache, encode_image, export_project_image, render_deep_zoom_tile, render_png_scanlines, render_proxies, render_thumbnails
+from render_cache import CompositeCache
+
+_blob_store = None
+# Last render of each project per scale in this worker, so the next thumbnail or export only redraws what changed
+_composites: Optional[CompositeCache] = None
+
+
+def init_worker(kind: str, mongo_url: str, root: str, composite_cache_bytes: int = 0, decoded_cache_bytes: int = 256 * 1024 * 1024):
+    global _blob_store, _composites
+    _blob_store = create_blob_store(kind, mongo_url=mongo_url, root=root)
+    _composites = CompositeCache(composite_cache_bytes) if composite_cache_bytes > 0 else None
+    decoded_images.resize(decoded_cache_bytes)
+
+
+def worker_stats() -> dict:
+    # Reported back to the JobPool with every result and shown under /api/metrics
+    return {
+        "decoded_images": decoded_images.stats(),
+        "composites": _composites.stats() if _composites is not None else None
+    }
+
+
+def read_blob(blob_hash: str) -> bytes:
+    return _blob_store.read_sync(blob_hash)
+
+
+def export_image(project: dict, fmt: str, quality: int, lossless: bool, scale: float) -> bytes:
+    return export_project_image(project, read_blob, fmt, quality, lossless, scale, _composites)
+
+
+def deep_zoom_tile(project: dict, level: int, col: int, row: int, fmt: str = "PNG", quality: int = 90) -> Optional[bytes]:
+    image = render_deep_zoom_tile(project, level, col, row, read_blob)
+    return encode_image(image, fmt, quality) if image is not None else None
+
+
+def deep_zoom_tiles(project: dict, tiles: List[tuple], fmt: str = "PNG", quality: int = 90) -> List[bytes]:
+    # A batch of tiles shares one source cache, so a large source is decoded once per batch rather than per tile
+    sources = SourceCache()
+    return [
+        encode_image(render_deep_zoom_tile(project, level, col, row, read_blob, sources=sources), fmt, quality)
+        for level, col, row in tiles
+    ]
+
+
+def png_scanlines(project: dict, region: tuple, scale: float) -> bytes:
+    return render_png_scanlines(project, region, scale, read_blob)
+
+
+def filter_chain(source_hash: str, chain: List[dict], quality: int = 85):
+    # Filters always start from the original upload, so repeated previews of one layer decode it once per worker
+    return apply_filter_chain(decoded_images.get(source_hash, lambda: read_blob(source_hash)), chain, quality)
+
+
+def thumbnails(project: dict, sizes: Sequence[int]) -> Dict[int, bytes]:
+    return render_thumbnails(project, read_blob, sizes, _composites)
+
+
+def ingest(path: str, max_edge: int, fmt: str, quality: int) -> dict:
+    # Uploads are staged on local disk before they reach the blob store, so only the normalized bytes are stored
+    with open(path, "rb") as f:
+        result = normalize_image(f, max_edge, fmt, quality)
+    # The proxy pyramid comes from the image already in memory instead of decoding the stored blob again
+    pyramid = render_proxies(result.pop("image").convert("RGBA"))
+    return {**result, "levels": pyramid["levels"]}
+
+
+def proxies(blob_hash: str) -> dict:
+    return render_proxies(decoded_images.get(blob_hash, lambda: read_blob(blob_hash)).image())
@@ -0,0 +1,93 @@
+# Index definitions for every collection the API queries, and a query plan audit that checks them.
+import logging
+from typing import Iterator, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds before an unfinished resumable upload is dropped
+
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "projects": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Equality on owner, then keyset order on (updated_at, id) for the project listing
+        IndexModel([("owner_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "chat_history": [
+        IndexModel([("session_id", ASCENDING), ("timestamp", ASCENDING)]),
+    ],
+    "blobs": [
+        IndexModel([("hash", ASCENDING)], unique=True),
+    ],
+    "filter_cache": [
+        IndexModel([("key", ASCENDING)], unique=True),
+    ],
+    "uploads": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Abandoned sessions expire; their staging files are swept by server.sweep_upload_staging()
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=UPLOAD_SESSION_TTL),
+    ],
+    "project_ops": [
+        IndexModel([("project_id", ASCENDING), ("revision", ASCENDING)], unique=True),
+    ],
+    "project_snapshots": [
+        IndexModel([("project_id", ASCENDING), ("revision", ASCENDING)], unique=True),
+    ],
+}
+
+# One entry per distinct query shape issued by server.py: (name, collection, filter, sort).
+# Values are placeholders; only the shape matters to the planner.
+QUERY_SHAPES = [
+    ("login / register", "users", {"email": "user@example.com"}, None),
+    ("current user", "users", {"id": "user"}, None),
+    ("project by id", "projects", {"id": "project", "owner_id": "user"}, None),
+    ("project list", "projects", {"owner_id": "user"}, [("updated_at", DESCENDING), ("id", DESCENDING)]),
+    ("chat history", "chat_history", {"session_id": "session"}, [("timestamp", DESCENDING)]),
+    ("blob download", "blobs", {"hash": "0" * 64}, None),
+    ("layer proxies", "blobs", {"hash": {"$in": ["0" * 64, "1" * 64]}, "proxies": {"$ne": []}}, None),
+    ("filter cache", "filter_cache", {"key": "0" * 64}, None),
+    ("resumable upload", "uploads", {"id": "upload", "owner_id": "user"}, None),
+    ("history entry", "project_ops", {"project_id": "project", "revision": 1}, None),
+    ("history page", "project_ops", {"project_id": "project", "revision": {"$lt": 100}}, [("revision", DESCENDING)]),
+    ("history tail", "project_ops", {"project_id": "project", "revision": {"$gt": 50, "$lte": 100}}, [("revision", ASCENDING)]),
+    ("nearest snapshot", "project_snapshots", {"project_id": "project", "revision": {"$lte": 100}}, [("revision", DESCENDING)]),
+    ("expired snapshots", "project_snapshots", {"project_id": "project", "created_at": {"$lt": "2024-01-01"}}, [("revision", DESCENDING)]),
+]
+
+
+async def ensure_indexes(db):
+    # create_indexes is a no-op for indexes that already exist with the same definition
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+
+
+def _plan_stages(plan) -> Iterator[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+async def audit_query_plans(db) -> List[dict]:
+    """Explains every query shape and reports the stages of its winning plan, flagging collection scans."""
+    report = []
+    for name, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        stages = list(_plan_stages(explained.get("queryPlanner", {}).get("winningPlan", {})))
+        entry = {"query": name, "collection": collection, "stages": stages, "collscan": "COLLSCAN" in stages}
+        if entry["collscan"]:
+            logger.warning("Query plan audit: '%s' on %s does a collection scan (%s)", name, collection, " <- ".join(stages))
+        report.append(entry)
+    return report
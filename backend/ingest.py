@@ -0,0 +1,125 @@
+# Upload normalization, run in the image workers before an upload is stored.
+#
+# Reads the real dimensions, applies the EXIF orientation (the renderer and the proxies draw pixels as
+# stored), caps the longest edge at `max_edge` and re-encodes:
+#   - lossless sources (PNG, BMP, TIFF, ...) become lossless WebP, so screenshots and artwork stay exact;
+#   - lossy sources (camera JPEGs, ...) become a quality-tuned JPEG, or lossy WebP/AVIF, when they had to
+#     be rotated or downscaled anyway, or when re-encoding makes them smaller.
+# Already compact lossy uploads that need no change are kept rather than re-compressed: a JPEG loses only its
+# metadata segments, its image data stays byte for byte; other formats carrying EXIF or XMP are re-encoded.
+# Metadata other than the colour profile is dropped (orientation is applied, location is never kept).
+import io
+import math
+from typing import BinaryIO, Optional
+
+from PIL import Image, ImageOps, features
+
+INGEST_FORMATS = ("auto", "jpeg", "webp", "avif", "original")
+# Encoding AVIF needs a Pillow built with libavif (11.3 or later); older releases don't know the feature
+AVIF_SUPPORTED = "avif" in features.modules and features.check_module("avif")
+LOSSY_SOURCE_FORMATS = {"JPEG", "MPO", "WEBP", "AVIF", "HEIF"}
+MIME_TYPES = {
+    "JPEG": "image/jpeg", "MPO": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "AVIF": "image/avif",
+    "GIF": "image/gif", "BMP": "image/bmp", "TIFF": "image/tiff", "HEIF": "image/heif"
+}
+EXIF_ORIENTATION = 0x0112
+# Image.info keys of metadata that must not reach the blob store (EXIF and XMP hold the camera, time and GPS)
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "photoshop", "comment")
+# APP1 (EXIF, XMP), APP13 (IPTC) and COM; APP0, APP2 and APP14 (JFIF, colour profile, Adobe colour
+# transform) are needed to decode the pixels as they were
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return "A" in image.getbands() or image.mode == "P" and "transparency" in image.info
+
+
+def _encode(image: Image.Image, fmt: str, quality: int, lossless: bool, icc_profile: Optional[bytes]) -> bytes:
+    out = io.BytesIO()
+    options = {"icc_profile": icc_profile} if icc_profile else {}
+    if fmt == "JPEG":
+        # Baseline rather than progressive: stored images are decoded far more often than they are streamed
+        image.convert("RGB").save(out, "JPEG", quality=quality, optimize=True, **options)
+    elif fmt == "WEBP":
+        # With lossless=True, quality is the compression effort rather than a fidelity setting
+        image.convert("RGBA" if _has_alpha(image) else "RGB").save(out, "WEBP", quality=quality, lossless=lossless, method=4, **options)
+    else:
+        image.convert("RGBA" if _has_alpha(image) else "RGB").save(out, "AVIF", quality=quality, **options)
+    return out.getvalue()
+
+
+def _strip_jpeg_metadata(raw: bytes) -> bytes:
+    # Copies the segments before the scan except the metadata ones, then the scan data untouched
+    out = [raw[:2]]
+    pos = 2
+    while pos + 4 <= len(raw) and raw[pos] == 0xFF:
+        marker = raw[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            pos += 1
+            continue
+        if marker == 0xDA or marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            break
+        end = pos + 2 + int.from_bytes(raw[pos + 2:pos + 4], "big")
+        if marker not in JPEG_METADATA_MARKERS:
+            out.append(raw[pos:end])
+        pos = end
+    out.append(raw[pos:])
+    return b"".join(out)
+
+
+def normalize_image(fp: BinaryIO, max_edge: int = 4096, fmt: str = "auto", quality: int = 85) -> dict:
+    """Normalizes an uploaded image, read from the seekable binary file `fp` as Pillow needs it.
+
+    Returns the oriented, capped `image`, its `width` and `height`, and `data`/`content_type` for the
+    bytes to store instead of the upload (None when the upload is kept as is). Raises if Pillow can't
+    read it.
+    """
+    if fmt not in INGEST_FORMATS:
+        raise ValueError(f"Unknown ingest format: {fmt}")
+    if fmt == "avif" and not AVIF_SUPPORTED:
+        raise ValueError("This Pillow build can't encode AVIF")
+    size = fp.seek(0, io.SEEK_END)
+    fp.seek(0)
+    image = Image.open(fp)
+    source_format = image.format
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    # Phone JPEGs often carry a second (depth or preview) picture and open as MPO; only real animations count
+    animated = getattr(image, "is_animated", False) and source_format != "MPO"
+    scale = max_edge / max(image.size) if max_edge and max(image.size) > max_edge else 1.0
+    if scale < 1.0 and source_format in ("JPEG", "MPO") and fmt != "original":
+        # Let the JPEG decoder downscale by a power of two on the way in; far cheaper than decoding 50 MP
+        image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    image.load()
+    # A CMYK profile would mislabel the RGB output
+    icc_profile = image.info.get("icc_profile") if image.mode != "CMYK" else None
+    metadata = any(image.info.get(key) for key in METADATA_KEYS)
+    result = {"image": image, "width": image.width, "height": image.height, "data": None, "content_type": MIME_TYPES.get(source_format)}
+    if fmt == "original" or animated:
+        # Animations would lose their frames; keep them as uploaded
+        return result
+
+    image = ImageOps.exif_transpose(image)
+    if max_edge and max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    changed = orientation != 1 or scale < 1.0
+    result.update(image=image, width=image.width, height=image.height)
+    lossless = source_format not in LOSSY_SOURCE_FORMATS
+    if not changed and not lossless and source_format in ("JPEG", "WEBP", "AVIF") and fmt in ("auto", source_format.lower()):
+        if source_format == "JPEG" and metadata:
+            fp.seek(0)
+            result.update(data=_strip_jpeg_metadata(fp.read()))
+        if source_format == "JPEG" or not metadata:
+            return result
+
+    if lossless:
+        target = "WEBP"
+    elif fmt in ("auto", "jpeg"):
+        # JPEG has no alpha channel
+        target = "WEBP" if _has_alpha(image) else "JPEG"
+    else:
+        target = fmt.upper()
+    data = _encode(image, target, quality, lossless, icc_profile)
+    if changed or metadata or len(data) < size:
+        result.update(data=data, content_type=MIME_TYPES[target])
+    return result
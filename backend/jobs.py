@@ -0,0 +1,186 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional
+
+
+class JobPoolSaturated(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _timed_call(fn: Callable, args: tuple, worker_stats: Optional[Callable] = None):
+    # Runs in the worker; wall-clock timestamps let the caller split queue wait from run time
+    started = time.time()
+    result = fn(*args)
+    finished = time.time()
+    # Worker-local state (caches) is only visible from inside the worker, so it rides along with each result
+    report = (os.getpid(), worker_stats()) if worker_stats is not None else None
+    return started, finished, result, report
+
+
+class DurationStats:
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._recent.append(seconds)
+
+    def snapshot(self) -> dict:
+        recent = sorted(self._recent)
+
+        def percentile(p):
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))] * 1000, 2) if recent else 0.0
+
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(self.max * 1000, 2)
+        }
+
+
+class JobPool:
+    """Process pool for CPU-bound work with a bounded number of in-flight jobs.
+
+    Jobs beyond `max_pending` are rejected immediately instead of queueing without bound, and a job's
+    slot is only released once its worker actually finishes, so timed-out jobs still count against
+    the limit until they stop consuming CPU. A worker that dies (e.g. killed for memory) breaks the
+    whole executor; the jobs it was running fail and the next job starts a fresh one.
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: float, initializer: Optional[Callable] = None, initargs: tuple = (),
+                 worker_stats: Optional[Callable] = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._initializer = initializer
+        self._initargs = initargs
+        self._worker_stats = worker_stats
+        self._worker_reports: Dict[int, dict] = {}  # latest worker_stats() per worker pid
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slot_freed = asyncio.Event()
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.restarts = 0
+        self.queue_wait = DurationStats()
+        self.run_time = DurationStats()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, not fork: the parent has an event loop and driver threads that must not be copied
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self._initializer,
+                initargs=self._initargs
+            )
+        return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        # Called for every job of a broken executor; only the first replaces it
+        if self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            self._worker_reports.clear()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, future, executor: ProcessPoolExecutor):
+        self.pending -= 1
+        self._slot_freed.set()
+        if not future.cancelled() and future.exception() is not None:
+            self.failed += 1
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._discard_executor(executor)
+
+    def _submit(self, fn: Callable, args: tuple):
+        executor = self._get_executor()
+        try:
+            return executor, executor.submit(_timed_call, fn, args, self._worker_stats)
+        except BrokenProcessPool:
+            # Broken by a crash whose jobs haven't reported back yet
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            return executor, executor.submit(_timed_call, fn, args, self._worker_stats)
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, wait: bool = False):
+        # wait=True is for follow-up jobs of an already admitted request (e.g. the next strip of a
+        # streaming export), which should queue for a slot rather than fail half way through
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        while self.pending >= self.max_pending:
+            if not wait:
+                self.rejected += 1
+                raise JobPoolSaturated()
+            self._slot_freed.clear()
+            try:
+                # Bounded like the job itself, so a pool that stays full can't hold a request forever
+                await asyncio.wait_for(self._slot_freed.wait(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise JobPoolSaturated()
+
+        self.pending += 1
+        submitted_at = time.time()
+        try:
+            executor, future = self._submit(fn, args)
+        except BaseException:
+            self.pending -= 1
+            self._slot_freed.set()
+            raise
+        self.submitted += 1
+        # Done callbacks fire on the executor's management thread; hop back to the loop to update counters
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f, executor))
+        try:
+            started, finished, result, report = await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            future.cancel()
+            raise JobTimeout()
+
+        self.completed += 1
+        self.queue_wait.add(max(0.0, started - submitted_at))
+        self.run_time.add(finished - started)
+        if report is not None:
+            self._worker_reports[report[0]] = report[1]
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "restarts": self.restarts,
+            "queue_wait": self.queue_wait.snapshot(),
+            "run_time": self.run_time.snapshot(),
+            "worker_stats": [self._worker_reports[pid] for pid in sorted(self._worker_reports)]
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._worker_reports.clear()
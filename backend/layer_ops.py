@@ -0,0 +1,262 @@
+import re
+import copy
+from typing import List, Optional, Tuple
+
+# Per-layer operations accepted by PATCH /api/projects/{id}/layers, e.g.
+#   {"op": "move", "id": "layer_1", "x": 10, "y": 20}
+#   {"op": "update", "id": "layer_1", "fields": {"name": "Logo", "data.text": "Hello"}}
+#   {"op": "add", "layer": {...}}
+#   {"op": "delete", "id": "layer_1"}
+
+NUMBER = (int, float)
+FIELD_TYPES = {
+    "name": (str,),
+    "visible": (bool,),
+    "opacity": NUMBER,
+    "x": NUMBER,
+    "y": NUMBER,
+    "width": NUMBER,
+    "height": NUMBER,
+    "z_index": (int,),
+    "data": (dict,),
+}
+DATA_FIELD_RE = re.compile(r"^data\.[A-Za-z0-9_]+$")
+
+
+class LayerNotFound(ValueError):
+    pass
+
+
+class LayerExists(ValueError):
+    pass
+
+# op -> (required fields, optional fields)
+FIELD_OPS = {
+    "move": (("x", "y"), ()),
+    "resize": (("width", "height"), ("x", "y")),
+    "opacity": (("opacity",), ()),
+    "reorder": (("z_index",), ()),
+}
+
+
+def validate_field(name: str, value):
+    if DATA_FIELD_RE.match(name):
+        return
+    types = FIELD_TYPES.get(name)
+    if types is None:
+        raise ValueError(f"Field cannot be patched: {name}")
+    # bool is an int subclass, so it has to be excluded explicitly from numeric fields
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        raise ValueError(f"Invalid value for {name}")
+    if name == "opacity" and not 0 <= value <= 1:
+        raise ValueError("opacity must be between 0 and 1")
+    if name in ("width", "height") and value < 0:
+        raise ValueError(f"{name} must not be negative")
+
+
+def normalize_ops(ops: List[dict]) -> List[dict]:
+    """Validates layer operations and rewrites field ops into {"op", "id", "fields"} form.
+
+    "add" ops are passed through with their layer untouched; callers validate the layer itself.
+    """
+    normalized = []
+    deleted = set()
+    added = set()
+    for op in ops:
+        kind = op.get("op")
+        if kind == "add":
+            layer = op.get("layer")
+            if not isinstance(layer, dict) or not layer.get("id"):
+                raise ValueError("add requires a layer with an id")
+            if layer["id"] in added:
+                raise ValueError(f"Layer {layer['id']} is added twice in the same patch")
+            added.add(layer["id"])
+            deleted.discard(layer["id"])
+            normalized.append({"op": "add", "layer": layer})
+            continue
+
+        layer_id = op.get("id")
+        if not isinstance(layer_id, str) or not layer_id:
+            raise ValueError(f"{kind} requires a layer id")
+        if layer_id in deleted:
+            raise ValueError(f"Layer {layer_id} is deleted earlier in the same patch")
+
+        if kind == "delete":
+            deleted.add(layer_id)
+            added.discard(layer_id)
+            normalized.append({"op": "delete", "id": layer_id})
+            continue
+
+        if kind == "update":
+            fields = op.get("fields")
+            if not isinstance(fields, dict) or not fields:
+                raise ValueError("update requires a non-empty fields object")
+        elif kind in FIELD_OPS:
+            required, optional = FIELD_OPS[kind]
+            missing = [name for name in required if name not in op]
+            if missing:
+                raise ValueError(f"{kind} requires {', '.join(missing)}")
+            fields = {name: op[name] for name in required + optional if name in op}
+        else:
+            raise ValueError(f"Unknown layer operation: {kind}")
+
+        for name, value in fields.items():
+            validate_field(name, value)
+        if "data" in fields and any(DATA_FIELD_RE.match(name) for name in fields):
+            raise ValueError("Set either data or individual data fields, not both")
+        normalized.append({"op": kind, "id": layer_id, "fields": dict(fields)})
+    return normalized
+
+
+def _conflicts(path: str, paths) -> bool:
+    # Setting both "data" and "data.text" in one update is rejected by Mongo; the same path twice just overwrites
+    return any(path.startswith(other + ".") or other.startswith(path + ".") for other in paths)
+
+
+def field_update(ops: List[dict]) -> Optional[Tuple[dict, List[dict]]]:
+    """Translates a patch of field ops only (moves, resizes, opacity, ...) into one $set on layers.$[...].
+
+    Returns the $set document and its array filters, or None when the patch adds or deletes layers or
+    changes both a field and part of it (e.g. "data" and "data.text"), which one update can't express;
+    such patches are applied with apply_ops() instead.
+    """
+    fields = {}
+    idents = {}
+    for op in ops:
+        if op["op"] in ("add", "delete"):
+            return None
+        ident = idents.setdefault(op["id"], f"l{len(idents)}")
+        for name, value in op["fields"].items():
+            path = f"layers.$[{ident}].{name}"
+            if _conflicts(path, fields):
+                return None
+            fields[path] = value
+    return fields, [{f"{ident}.id": layer_id} for layer_id, ident in idents.items()]
+
+
+def summarize_changes(ops: List[dict]) -> List[dict]:
+    # The response only echoes what changed, never the full layer list
+    changes = []
+    for op in ops:
+        if op["op"] == "add":
+            changes.append({"op": "add", "layer": op["layer"]})
+        elif op["op"] == "delete":
+            changes.append({"op": "delete", "id": op["id"]})
+        else:
+            changes.append({"op": op["op"], "id": op["id"], "fields": op["fields"]})
+    return changes
+
+
+def is_inline_data(value) -> bool:
+    return isinstance(value, str) and value.startswith("data:")
+
+
+def lightweight_layer(layer: dict) -> dict:
+    # Inline images stay out of broadcasts; collaborators fetch the layer itself when they need the pixels
+    data = layer.get("data") or {}
+    if not is_inline_data(data.get("src")):
+        return layer
+    return {**layer, "data": {**{k: v for k, v in data.items() if k != "src"}, "src_omitted": True}}
+
+
+def layer_changes(old_layers: List[dict], new_layers: List[dict]) -> List[dict]:
+    """Normalized ops that turn one full layer list into another (apart from ordering, see layer_order()).
+
+    Values are kept in full, inline image data included, so apply_ops() reproduces new_layers exactly.
+    """
+    old_by_id = {layer.get("id"): layer for layer in old_layers}
+    new_ids = {layer.get("id") for layer in new_layers}
+    changes = [{"op": "delete", "id": layer_id} for layer_id in old_by_id if layer_id not in new_ids]
+
+    for layer in new_layers:
+        old = old_by_id.get(layer.get("id"))
+        if old is not None and set(old) - set(layer):
+            # Fields can't be unset through an update, so a layer that lost some is replaced
+            changes.append({"op": "delete", "id": layer["id"]})
+            old = None
+        if old is None:
+            changes.append({"op": "add", "layer": layer})
+            continue
+        fields = {}
+        for name in set(old) | set(layer):
+            if name in ("id", "data") or old.get(name) == layer.get(name):
+                continue
+            fields[name] = layer.get(name)
+        old_data, new_data = old.get("data") or {}, layer.get("data") or {}
+        if set(old_data) - set(new_data):
+            # Keys can't be removed one by one, so the whole data object is replaced
+            fields["data"] = new_data
+        else:
+            for key in new_data:
+                if old_data.get(key) != new_data[key]:
+                    fields[f"data.{key}"] = new_data[key]
+        if fields:
+            changes.append({"op": "update", "id": layer["id"], "fields": fields})
+    return changes
+
+
+def layer_order(old_layers: List[dict], new_layers: List[dict], ops: List[dict]) -> Optional[List[str]]:
+    # apply_ops() keeps surviving layers in place and appends added ones; returns the ids if new_layers differs from that
+    expected = [layer.get("id") for layer in old_layers]
+    for op in ops:
+        if op["op"] == "add":
+            expected.append(op["layer"]["id"])
+        elif op["op"] == "delete":
+            expected.remove(op["id"])
+    new_ids = [layer.get("id") for layer in new_layers]
+    return None if expected == new_ids else new_ids
+
+
+def lightweight_changes(changes: List[dict]) -> List[dict]:
+    # Same changes with inline image data replaced by "<field>_omitted" markers, for broadcasting
+    light = []
+    for change in changes:
+        if change["op"] == "add":
+            change = {**change, "layer": lightweight_layer(change["layer"])}
+        elif change["op"] != "delete":
+            fields = {}
+            for name, value in change["fields"].items():
+                if is_inline_data(value):
+                    fields[f"{name}_omitted"] = True
+                elif name == "data" and isinstance(value, dict):
+                    fields[name] = lightweight_layer({"data": value})["data"]
+                else:
+                    fields[name] = value
+            change = {**change, "fields": fields}
+        light.append(change)
+    return light
+
+
+def apply_ops(layers: List[dict], ops: List[dict]):
+    """Applies normalized ops to a layer list in place: field ops update the layer with that id, adds
+    append, deletes remove.
+
+    Every referenced layer is checked before anything is modified, so a batch that can't apply
+    leaves `layers` untouched (LayerNotFound, LayerExists). The ops' values are copied, so later changes to `layers` never reach them.
+    """
+    ops = copy.deepcopy(ops)
+    ids = {layer.get("id") for layer in layers}
+    for op in ops:
+        if op["op"] == "add":
+            if op["layer"]["id"] in ids:
+                raise LayerExists(f"Layer {op['layer']['id']} already exists")
+            ids.add(op["layer"]["id"])
+        elif op["id"] not in ids:
+            raise LayerNotFound(f"Layer {op['id']} not found")
+        elif op["op"] == "delete":
+            ids.discard(op["id"])
+
+    for op in ops:
+        if op["op"] == "add":
+            layers.append(op["layer"])
+        elif op["op"] == "delete":
+            layers[:] = [layer for layer in layers if layer.get("id") != op["id"]]
+        else:
+            layer = next(layer for layer in layers if layer.get("id") == op["id"])
+            for name, value in op["fields"].items():
+                if name.startswith("data."):
+                    if not isinstance(layer.get("data"), dict):
+                        layer["data"] = {}
+                    layer["data"][name[len("data."):]] = value
+                else:
+                    layer[name] = value
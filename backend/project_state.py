@@ -0,0 +1,255 @@
+# Server-authoritative project state for projects with connected editors.
+#
+# Operations received over the WebSocket are applied to an in-memory copy of the project and broadcast
+# right away; MongoDB is written behind, at most `flush_interval` seconds (or `flush_ops` operations)
+# after the first unflushed change. A crash loses at most one flush window.
+#
+# The state lives in the worker that holds the project's sockets. Flushes are conditional on the
+# revision last read from or written to the database, so a write made elsewhere in the meantime (a
+# REST save, or another worker) is detected; the session then reloads and replays its pending ops.
+import time
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from layer_ops import apply_ops
+
+
+def revision_filter(revision: int):
+    # Projects saved before revisions existed have no field at all, which is revision 0
+    return {"$in": [0, None]} if revision == 0 else revision
+
+
+class ProjectSession:
+    def __init__(self, project: dict):
+        self.project = project
+        self.project_id = project["id"]
+        self.revision = project.get("revision", 0)
+        self.persisted_revision = self.revision
+        self.pending: List[List[dict]] = []  # op batches applied in memory but not yet written
+        self.first_pending_at: Optional[float] = None
+        self.sockets = 0
+        self.last_active = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+
+
+class ProjectStateStore:
+    def __init__(self, db, flush_interval: float = 1.0, flush_ops: int = 100, idle_timeout: float = 60.0,
+                 on_flush: Optional[Callable[[str, int, int, List[dict]], Awaitable]] = None, on_rebase: Optional[Callable[[str, int], Awaitable]] = None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.idle_timeout = idle_timeout
+        self._on_flush = on_flush
+        self._on_rebase = on_rebase
+        self._sessions: Dict[str, ProjectSession] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._evictor: Optional[asyncio.Task] = None
+        self.ops_applied = 0
+        self.flushes = 0
+        self.ops_flushed = 0
+        self.rebases = 0
+        self.dropped_ops = 0
+        self.evictions = 0
+        self.flush_errors = 0
+
+    def get(self, project_id: str) -> Optional[ProjectSession]:
+        return self._sessions.get(project_id)
+
+    async def attach(self, project_id: str) -> Optional[ProjectSession]:
+        """Registers a socket on the project, loading its state on the first one."""
+        session = self._sessions.get(project_id)
+        if session is None:
+            # Concurrent first joins share a single load
+            loading = self._loading.get(project_id)
+            if loading is None:
+                loading = self._loading[project_id] = asyncio.ensure_future(self._load(project_id))
+            try:
+                session = await asyncio.shield(loading)
+            finally:
+                self._loading.pop(project_id, None)
+            if session is None:
+                return None
+            session = self._sessions.setdefault(project_id, session)
+        session.sockets += 1
+        session.last_active = time.monotonic()
+        if self._evictor is None:
+            self._evictor = asyncio.ensure_future(self._evict_idle())
+        return session
+
+    def detach(self, project_id: str):
+        session = self._sessions.get(project_id)
+        if session is not None:
+            session.sockets = max(0, session.sockets - 1)
+            session.last_active = time.monotonic()
+
+    async def _load(self, project_id: str) -> Optional[ProjectSession]:
+        project = await self.db.projects.find_one({"id": project_id}, {"_id": 0})
+        return ProjectSession(project) if project else None
+
+    async def apply(self, session: ProjectSession, ops: List[dict]) -> int:
+        """Applies a validated batch in memory and returns the new revision; raises ValueError if it doesn't apply."""
+        async with session.lock:
+            apply_ops(session.project.setdefault("layers", []), ops)
+            session.revision += 1
+            session.pending.append(ops)
+            session.project["revision"] = session.revision
+            session.project["updated_at"] = datetime.utcnow()
+            session.last_active = time.monotonic()
+            self.ops_applied += len(ops)
+            if session.first_pending_at is None:
+                session.first_pending_at = time.monotonic()
+                self._schedule_flush(session)
+            pending_ops = sum(len(batch) for batch in session.pending)
+        if pending_ops >= self.flush_ops:
+            await self.flush(session.project_id)
+        return session.revision
+
+    def _schedule_flush(self, session: ProjectSession):
+        session.flush_timer = asyncio.get_running_loop().call_later(
+            self.flush_interval, lambda: asyncio.ensure_future(self._timed_flush(session.project_id))
+        )
+
+    async def _timed_flush(self, project_id: str):
+        try:
+            await self.flush(project_id)
+        except Exception:
+            # The ops stay pending; try again after another interval
+            self.flush_errors += 1
+            session = self._sessions.get(project_id)
+            if session is not None and session.pending and session.flush_timer is None:
+                session.first_pending_at = time.monotonic()
+                self._schedule_flush(session)
+
+    async def flush(self, project_id: str):
+        session = self._sessions.get(project_id)
+        if session is None:
+            return
+        async with session.lock:
+            await self._flush_locked(session)
+
+    async def _flush_locked(self, session: ProjectSession):
+        if session.flush_timer is not None:
+            session.flush_timer.cancel()
+            session.flush_timer = None
+        session.first_pending_at = None
+        if not session.pending:
+            return
+
+        result = await self.db.projects.update_one(
+            {"id": session.project_id, "revision": revision_filter(session.persisted_revision)},
+            {"$set": {
+                "layers": session.project["layers"],
+                "updated_at": session.project["updated_at"],
+                "revision": session.revision
+            }}
+        )
+        if result.matched_count == 0:
+            await self._rebase(session)
+            return
+
+        self.flushes += 1
+        ops = [op for batch in session.pending for op in batch]
+        base_revision = session.persisted_revision
+        self.ops_flushed += len(ops)
+        session.pending = []
+        session.persisted_revision = session.revision
+        if self._on_flush is not None:
+            await self._on_flush(session.project_id, base_revision, session.revision, ops)
+
+    async def _rebase(self, session: ProjectSession):
+        # Someone else wrote to the project since our last flush: take their version and replay ours on top
+        self.rebases += 1
+        project = await self.db.projects.find_one({"id": session.project_id}, {"_id": 0})
+        if project is None:
+            self.dropped_ops += sum(len(batch) for batch in session.pending)
+            session.pending = []
+            return
+
+        pending, session.pending = session.pending, []
+        session.project = project
+        session.revision = session.persisted_revision = project.get("revision", 0)
+        for ops in pending:
+            try:
+                apply_ops(session.project.setdefault("layers", []), ops)
+            except ValueError:
+                self.dropped_ops += len(ops)
+                continue
+            session.revision += 1
+            session.pending.append(ops)
+        session.project["revision"] = session.revision
+        if self._on_rebase is not None:
+            await self._on_rebase(session.project_id, session.revision)
+        if session.pending:
+            await self._flush_locked(session)
+
+    async def reload(self, project_id: str):
+        """Re-reads a project after a write that bypassed the session; flush first with flush()."""
+        session = self._sessions.get(project_id)
+        if session is None:
+            return
+        async with session.lock:
+            if session.pending:
+                await self._flush_locked(session)
+            project = await self.db.projects.find_one({"id": project_id}, {"_id": 0})
+            if project is None:
+                self._drop(project_id)
+                return
+            session.project = project
+            session.revision = session.persisted_revision = project.get("revision", 0)
+
+    def discard(self, project_id: str):
+        # The project was deleted: nothing left to flush to
+        self._drop(project_id)
+
+    def _drop(self, project_id: str):
+        session = self._sessions.pop(project_id, None)
+        if session is not None and session.flush_timer is not None:
+            session.flush_timer.cancel()
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 10.0))
+            now = time.monotonic()
+            for project_id, session in list(self._sessions.items()):
+                if session.sockets == 0 and now - session.last_active >= self.idle_timeout:
+                    await self.evict(project_id)
+
+    async def evict(self, project_id: str):
+        session = self._sessions.get(project_id)
+        if session is None:
+            return
+        try:
+            await self.flush(project_id)
+        except Exception:
+            # Keep the state in memory rather than lose edits; the next eviction pass retries
+            self.flush_errors += 1
+            return
+        if session.sockets == 0 and not session.pending:
+            self._drop(project_id)
+            self.evictions += 1
+
+    async def shutdown(self):
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+        for project_id in list(self._sessions):
+            try:
+                await self.flush(project_id)
+            except Exception:
+                self.flush_errors += 1
+            self._drop(project_id)
+
+    def stats(self) -> dict:
+        return {
+            "active_projects": len(self._sessions),
+            "unflushed_ops": sum(len(batch) for session in self._sessions.values() for batch in session.pending),
+            "ops_applied": self.ops_applied,
+            "flushes": self.flushes,
+            "ops_flushed": self.ops_flushed,
+            "rebases": self.rebases,
+            "dropped_ops": self.dropped_ops,
+            "evictions": self.evictions,
+            "flush_errors": self.flush_errors
+        }
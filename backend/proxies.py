@@ -0,0 +1,50 @@
+# Downscaled proxies for image layers.
+#
+# Every image blob used by a layer gets a pyramid of half-size WEBP copies (see render.render_proxies),
+# recorded on its blobs entry as `proxies`, largest first. When a project is loaded for a given
+# viewport scale, each image layer's `data.src` points at the smallest proxy that still covers the
+# layer on screen; `data.full_src` keeps the original for zooming in. Exports and server-side
+# rendering always read `data.blob`, so they are unaffected.
+from typing import Callable, List, Optional
+
+# Added to a layer's data when it is served with a proxy; never stored
+PROXY_FIELDS = ("full_src", "proxy_width", "proxy_height")
+
+
+def select_proxy(proxies: List[dict], width: float, height: float) -> Optional[dict]:
+    """Smallest proxy at least width x height pixels, or None when only the original is large enough."""
+    for proxy in reversed(proxies):
+        if proxy["width"] >= width and proxy["height"] >= height:
+            return proxy
+    return None
+
+
+def with_proxy(layer: dict, proxies: List[dict], scale: float, url_for: Callable[[str], str]) -> dict:
+    data = layer.get("data") or {}
+    proxy = select_proxy(proxies, (layer.get("width") or 0) * scale, (layer.get("height") or 0) * scale)
+    if proxy is None:
+        return layer
+    return {**layer, "data": {
+        **data,
+        "src": url_for(proxy["hash"]),
+        "full_src": data.get("src") or url_for(data["blob"]),
+        "proxy_width": proxy["width"],
+        "proxy_height": proxy["height"]
+    }}
+
+
+def strip_proxy(data: dict) -> dict:
+    # Layer data loaded with a proxy goes back to its full-resolution source when the client saves it
+    if not isinstance(data, dict) or not any(field in data for field in PROXY_FIELDS):
+        return data
+    stripped = {key: value for key, value in data.items() if key not in PROXY_FIELDS}
+    if data.get("full_src"):
+        stripped["src"] = data["full_src"]
+    return stripped
+
+
+def strip_proxy_layers(layers: List[dict]) -> List[dict]:
+    return [
+        {**layer, "data": strip_proxy(layer["data"])} if isinstance(layer, dict) and isinstance(layer.get("data"), dict) else layer
+        for layer in layers
+    ]
@@ -0,0 +1,447 @@
+import io
+import math
+import zlib
+import base64
+import struct
+import zipfile
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from image_cache import content_hash, decoded_images
+
+# Maps the export format names accepted by the API to Pillow encoder names
+EXPORT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+Box = Tuple[int, int, int, int]
+BlobReader = Callable[[str], bytes]
+
+TILE_SIZE = 512
+STRIP_BYTES = 16 * 1024 * 1024  # RGBA rows of one streamed PNG strip; wider canvases get shorter strips
+THUMBNAIL_SIZES = (128, 512)  # longest edge in pixels
+PROXY_MIN_EDGE = 256  # the smallest proxy level; images already this small get none
+
+
+def parse_color(value: Optional[str], default=(255, 255, 255, 255)) -> Tuple[int, int, int, int]:
+    if not value:
+        return default
+    if value == "transparent":
+        return (0, 0, 0, 0)
+    try:
+        return ImageColor.getcolor(value, "RGBA")
+    except ValueError:
+        return default
+
+
+def sorted_layers(layers: Iterable[dict]) -> List[dict]:
+    # Stable sort, so layers sharing a z_index keep their document order
+    return sorted((layer for layer in layers if layer.get("visible", True)), key=lambda layer: layer.get("z_index", 0))
+
+
+def layer_pixel_box(layer: dict, scale: float) -> Box:
+    # Edges are rounded independently so adjacent regions of the same render line up exactly
+    x0 = round(layer.get("x", 0) * scale)
+    y0 = round(layer.get("y", 0) * scale)
+    x1 = max(x0 + 1, round((layer.get("x", 0) + layer.get("width", 0)) * scale))
+    y1 = max(y0 + 1, round((layer.get("y", 0) + layer.get("height", 0)) * scale))
+    return x0, y0, x1, y1
+
+
+def intersect(a: Box, b: Box) -> Optional[Box]:
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+
+def decode_image_bytes(layer: dict, read_blob: BlobReader) -> Optional[bytes]:
+    data = layer.get("data") or {}
+    if data.get("blob"):
+        return read_blob(data["blob"])
+    src = data.get("src") or ""
+    if src.startswith("data:") and "," in src:
+        # Projects saved before the blob store keep their image inline
+        return base64.b64decode(src.split(",", 1)[1])
+    return None
+
+
+def load_layer_image(layer: dict, read_blob: BlobReader) -> Optional[Image.Image]:
+    # Decoded through the process-wide cache; the result is a read-only RGBA view of the cached pixels
+    data = layer.get("data") or {}
+    if data.get("blob"):
+        return decoded_images.get(data["blob"], lambda: read_blob(data["blob"])).image()
+    raw = decode_image_bytes(layer, read_blob)
+    if raw is None:
+        return None
+    return decoded_images.get(content_hash(raw), lambda: raw).image()
+
+
+def rasterize_text(layer: dict) -> Image.Image:
+    data = layer.get("data") or {}
+    text = data.get("text") or ""
+    font = ImageFont.load_default(size=max(1, int(data.get("fontSize", 20))))
+    left, top, right, bottom = font.getbbox(text) if text else (0, 0, 1, 1)
+    image = Image.new("RGBA", (max(1, right), max(1, bottom)), (0, 0, 0, 0))
+    ImageDraw.Draw(image).text((0, 0), text, font=font, fill=parse_color(data.get("color"), (0, 0, 0, 255)))
+    return image
+
+
+def layer_source(layer: dict, read_blob: BlobReader) -> Optional[Image.Image]:
+    layer_type = layer.get("type")
+    if layer_type == "text":
+        return rasterize_text(layer)
+    if layer_type in ("image", "brush"):
+        return load_layer_image(layer, read_blob)
+    return None
+
+
+def source_key(layer: dict):
+    data = layer.get("data") or {}
+    if layer.get("type") == "text":
+        return ("text", data.get("text"), data.get("fontSize"), data.get("color"))
+    if data.get("blob"):
+        return ("blob", data["blob"])
+    return ("layer", layer.get("id"))
+
+
+class SourceCache:
+    """Layer sources shared by every region of one render, bounded by decoded bytes.
+
+    Tiled renders touch the same source from many tiles; without this each tile would rasterize its text
+    again and look up its images again (image pixels themselves are shared through image_cache).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+
+    def get(self, layer: dict, read_blob: BlobReader) -> Optional[Image.Image]:
+        key = source_key(layer)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        source = layer_source(layer, read_blob)
+        if source is not None:
+            nbytes = source.width * source.height * 4
+            if nbytes <= self.max_bytes:
+                self._entries[key] = source
+                self.size += nbytes
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= evicted.width * evicted.height * 4
+        return source
+
+
+def with_natural_size(layer: dict, source: Optional[Image.Image]) -> dict:
+    # Layers created without explicit dimensions render at the size of their content
+    if source is None or (layer.get("width") and layer.get("height")):
+        return layer
+    return {**layer, "width": layer.get("width") or source.width, "height": layer.get("height") or source.height}
+
+
+def shape_coverage(layer: dict, layer_box: Box, region: Box) -> np.ndarray:
+    # Coverage of an axis-aligned shape over `region`, sampled at pixel centres
+    height, width = region[3] - region[1], region[2] - region[0]
+    if (layer.get("data") or {}).get("shape") != "circle":
+        return np.ones((height, width, 1), dtype=np.float32)
+    cx = (layer_box[0] + layer_box[2]) / 2
+    cy = (layer_box[1] + layer_box[3]) / 2
+    rx = (layer_box[2] - layer_box[0]) / 2
+    ry = (layer_box[3] - layer_box[1]) / 2
+    xs = (np.arange(region[0], region[2], dtype=np.float32) + 0.5 - cx) / rx
+    ys = (np.arange(region[1], region[3], dtype=np.float32) + 0.5 - cy) / ry
+    inside = (ys[:, None] ** 2 + xs[None, :] ** 2) <= 1.0
+    return inside[..., None].astype(np.float32)
+
+
+def blend_over(dst: np.ndarray, rgb: np.ndarray, alpha: np.ndarray):
+    # Porter-Duff "over" on premultiplied float32 pixels; `rgb` is straight (unpremultiplied) colour
+    dst *= 1.0 - alpha
+    dst[..., :3] += rgb * alpha
+    dst[..., 3:4] += alpha
+
+
+def composite_layer(canvas: np.ndarray, region: Box, layer: dict, scale: float, read_blob: BlobReader, sources: Optional[SourceCache] = None):
+    opacity = min(max(float(layer.get("opacity", 1.0)), 0.0), 1.0)
+    if opacity <= 0:
+        return
+
+    if layer.get("type") == "shape":
+        box = layer_pixel_box(layer, scale)
+        visible = intersect(box, region)
+        if visible is None:
+            return
+        fill = np.array(parse_color((layer.get("data") or {}).get("fill"), (0, 0, 0, 255)), dtype=np.float32) / 255.0
+        alpha = shape_coverage(layer, box, visible) * (fill[3] * opacity)
+        rgb = fill[:3]
+    else:
+        # Skip decoding anything that can't land in the region
+        if layer.get("width") and layer.get("height") and intersect(layer_pixel_box(layer, scale), region) is None:
+            return
+        source = sources.get(layer, read_blob) if sources is not None else layer_source(layer, read_blob)
+        if source is None:
+            return
+        box = layer_pixel_box(with_natural_size(layer, source), scale)
+        visible = intersect(box, region)
+        if visible is None:
+            return
+        # Resample only the part of the source that maps onto the visible region
+        sx = source.width / (box[2] - box[0])
+        sy = source.height / (box[3] - box[1])
+        source_box = (
+            (visible[0] - box[0]) * sx,
+            (visible[1] - box[1]) * sy,
+            (visible[2] - box[0]) * sx,
+            (visible[3] - box[1]) * sy,
+        )
+        size = (visible[2] - visible[0], visible[3] - visible[1])
+        pixels = np.asarray(source.resize(size, Image.BILINEAR, box=source_box), dtype=np.float32) / 255.0
+        alpha = pixels[..., 3:4] * opacity
+        rgb = pixels[..., :3]
+
+    dst = canvas[visible[1] - region[1]:visible[3] - region[1], visible[0] - region[0]:visible[2] - region[0]]
+    blend_over(dst, rgb, alpha)
+
+
+def composite_region(project: dict, layers: Iterable[dict], region: Box, scale: float, read_blob: BlobReader,
+                     sources: Optional[SourceCache] = None, base: Optional[np.ndarray] = None) -> np.ndarray:
+    """Composites `layers` into the pixel rectangle `region` of the project canvas rendered at `scale`.
+
+    Starts from the background, or from a copy of `base` (the same region with lower layers already
+    composited). Returns a premultiplied float32 RGBA array of shape (height, width, 4).
+    """
+    if base is not None:
+        canvas = base.copy()
+    else:
+        background = np.array(parse_color(project.get("background_color")), dtype=np.float32) / 255.0
+        canvas = np.empty((region[3] - region[1], region[2] - region[0], 4), dtype=np.float32)
+        canvas[..., :3] = background[:3] * background[3]
+        canvas[..., 3] = background[3]
+
+    for layer in sorted_layers(layers):
+        composite_layer(canvas, region, layer, scale, read_blob, sources)
+
+    return canvas
+
+
+def to_rgba8(canvas: np.ndarray) -> np.ndarray:
+    alpha = canvas[..., 3:4]
+    rgb = np.divide(canvas[..., :3], alpha, out=np.zeros_like(canvas[..., :3]), where=alpha > 0)
+    out = np.empty(canvas.shape, dtype=np.uint8)
+    out[..., :3] = np.clip(rgb * 255.0 + 0.5, 0, 255)
+    out[..., 3:4] = np.clip(alpha * 255.0 + 0.5, 0, 255)
+    return out
+
+
+def canvas_size(project: dict, scale: float) -> Tuple[int, int]:
+    return max(1, math.ceil(project.get("width", 0) * scale)), max(1, math.ceil(project.get("height", 0) * scale))
+
+
+def render_project(project: dict, read_blob: BlobReader, scale: float = 1.0, sources: Optional[SourceCache] = None, composites=None) -> Image.Image:
+    # `composites` (a render_cache.CompositeCache) keeps the last render per project and scale to re-render only what changed
+    if composites is not None:
+        return Image.fromarray(composites.render((project.get("id"), scale), project, scale, read_blob, sources), "RGBA")
+    width, height = canvas_size(project, scale)
+    canvas = composite_region(project, project.get("layers", []), (0, 0, width, height), scale, read_blob, sources)
+    return Image.fromarray(to_rgba8(canvas), "RGBA")
+
+
+def encode_image(image: Image.Image, fmt: str, quality: int = 90, lossless: bool = False) -> bytes:
+    out = io.BytesIO()
+    if fmt == "JPEG":
+        # JPEG has no alpha channel; flatten onto white like the editor's default background
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel("A"))
+        flattened.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "WEBP":
+        image.save(out, "WEBP", quality=quality, lossless=lossless, method=4)
+    else:
+        image.save(out, "PNG", compress_level=6)
+    return out.getvalue()
+
+
+def export_project_image(project: dict, read_blob: BlobReader, fmt: str, quality: int = 90, lossless: bool = False, scale: float = 1.0, composites=None) -> bytes:
+    return encode_image(render_project(project, read_blob, scale, composites=composites), fmt, quality, lossless)
+
+
+def thumbnail_scale(project: dict, size: int) -> float:
+    # Fit the longest edge into `size`; small canvases are never upscaled
+    return min(1.0, size / max(project.get("width", 0), project.get("height", 0), 1))
+
+
+def render_thumbnails(project: dict, read_blob: BlobReader, sizes: Iterable[int] = THUMBNAIL_SIZES, composites=None) -> Dict[int, bytes]:
+    # All sizes share one source cache, so each layer image is decoded once
+    sources = SourceCache()
+    return {
+        size: encode_image(render_project(project, read_blob, thumbnail_scale(project, size), sources, composites), "WEBP", 80)
+        for size in sizes
+    }
+
+
+def render_proxies(image: Image.Image, min_edge: int = PROXY_MIN_EDGE, quality: int = 85) -> dict:
+    """Mip-style pyramid for an uploaded image: each level halves the previous one until the longest edge fits min_edge.
+
+    Returns the source's size and the levels largest first as (width, height, WEBP bytes).
+    """
+    width, height = image.size
+    levels = []
+    level = image
+    while max(level.size) > min_edge and min(level.size) >= 2:
+        # reduce() box-filters 2x2 blocks, so each level costs a quarter of the previous one
+        level = level.reduce(2)
+        levels.append((level.width, level.height, encode_image(level, "WEBP", quality)))
+    return {"width": width, "height": height, "levels": levels}
+
+
+# Tiled rendering: memory is bounded by the tile (or strip) size rather than the canvas size
+
+def layers_in_region(layers: Iterable[dict], region: Box, scale: float) -> List[dict]:
+    # Layers without explicit dimensions take their content's size, so they can't be culled up front
+    return [
+        layer for layer in layers
+        if not (layer.get("width") and layer.get("height")) or intersect(layer_pixel_box(layer, scale), region) is not None
+    ]
+
+
+def iter_tile_boxes(width: int, height: int, tile_size: int = TILE_SIZE):
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield left // tile_size, top // tile_size, (left, top, min(left + tile_size, width), min(top + tile_size, height))
+
+
+def render_tile(project: dict, region: Box, scale: float, read_blob: BlobReader, sources: Optional[SourceCache] = None) -> Image.Image:
+    layers = layers_in_region(sorted_layers(project.get("layers", [])), region, scale)
+    return Image.fromarray(to_rgba8(composite_region(project, layers, region, scale, read_blob, sources)), "RGBA")
+
+
+def deep_zoom_levels(project: dict) -> int:
+    # Level N is full resolution, each level below halves it, level 0 is a single pixel
+    return max(1, math.ceil(math.log2(max(project.get("width", 1), project.get("height", 1), 2)))) + 1
+
+
+def deep_zoom_scale(project: dict, level: int) -> float:
+    return 2.0 ** (level - (deep_zoom_levels(project) - 1))
+
+
+def deep_zoom_descriptor(project: dict, fmt: str = "png", tile_size: int = TILE_SIZE) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" Format="{fmt}">'
+        f'<Size Width="{project.get("width", 0)}" Height="{project.get("height", 0)}"/></Image>'
+    )
+
+
+def render_deep_zoom_tile(project: dict, level: int, col: int, row: int, read_blob: BlobReader, tile_size: int = TILE_SIZE, sources: Optional[SourceCache] = None) -> Optional[Image.Image]:
+    scale = deep_zoom_scale(project, level)
+    width, height = canvas_size(project, scale)
+    left, top = col * tile_size, row * tile_size
+    if left >= width or top >= height:
+        return None
+    region = (left, top, min(left + tile_size, width), min(top + tile_size, height))
+    return render_tile(project, region, scale, read_blob, sources)
+
+
+def iter_deep_zoom_tiles(project: dict, tile_size: int = TILE_SIZE):
+    # Highest resolution first, matching the order viewers and archives list them in
+    for level in range(deep_zoom_levels(project) - 1, -1, -1):
+        width, height = canvas_size(project, deep_zoom_scale(project, level))
+        for col, row, _ in iter_tile_boxes(width, height, tile_size):
+            yield level, col, row
+
+
+class DeepZoomZipWriter:
+    """Builds a zip of a Deep Zoom tile set (`project.dzi` plus `project_files/<level>/<col>_<row>.<ext>`) incrementally.
+
+    Every call returns the archive bytes produced so far, so the zip can be streamed while tiles are still rendering.
+    """
+
+    def __init__(self, project: dict, fmt: str = "PNG", tile_size: int = TILE_SIZE):
+        self.extension = "jpg" if fmt == "JPEG" else fmt.lower()
+        self._buffer = _ChunkBuffer()
+        self._archive = zipfile.ZipFile(self._buffer, "w", compression=zipfile.ZIP_STORED)
+        self._archive.writestr("project.dzi", deep_zoom_descriptor(project, self.extension, tile_size))
+
+    def add_tile(self, level: int, col: int, row: int, data: bytes) -> bytes:
+        self._archive.writestr(f"project_files/{level}/{col}_{row}.{self.extension}", data)
+        return self._buffer.drain()
+
+    def finish(self) -> bytes:
+        self._archive.close()
+        return self._buffer.drain()
+
+
+class _ChunkBuffer(io.RawIOBase):
+    # Write-only, non-seekable sink so zipfile streams entries instead of seeking back to patch headers
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+def iter_strip_regions(project: dict, scale: float = 1.0, max_bytes: int = STRIP_BYTES):
+    width, height = canvas_size(project, scale)
+    strip_height = max(1, min(TILE_SIZE, max_bytes // (width * 4)))
+    for top in range(0, height, strip_height):
+        yield (0, top, width, min(top + strip_height, height))
+
+
+def render_png_scanlines(project: dict, region: Box, scale: float, read_blob: BlobReader, sources: Optional[SourceCache] = None) -> bytes:
+    """Renders a full-width strip as filtered PNG scanlines, independent of any other strip.
+
+    The strip is composited one TILE_SIZE-wide tile at a time, so only its 8-bit rows span the canvas width.
+    """
+    sources = sources if sources is not None else SourceCache()
+    rows = np.empty((region[3] - region[1], region[2] - region[0], 4), dtype=np.uint8)
+    for left in range(region[0], region[2], TILE_SIZE):
+        right = min(left + TILE_SIZE, region[2])
+        rows[:, left - region[0]:right - region[0]] = np.asarray(render_tile(project, (left, region[1], right, region[3]), scale, read_blob, sources))
+    rows = rows.reshape(region[3] - region[1], -1)
+    # "Up" filter (type 2) on every row but the first, which uses no filter so strips don't depend on each other
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 0] = 0
+    filtered[:, 1:] = rows
+    filtered[1:, 1:] -= rows[:-1]
+    return filtered.tobytes()
+
+
+class PngStripEncoder:
+    """Streams a PNG whose scanlines arrive one strip at a time from render_png_scanlines()."""
+
+    def __init__(self, width: int, height: int, level: int = 6):
+        self.width = width
+        self.height = height
+        self._compressor = zlib.compressobj(level)
+
+    def header(self) -> bytes:
+        return b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 6, 0, 0, 0))
+
+    def encode(self, scanlines: bytes) -> bytes:
+        data = self._compressor.compress(scanlines)
+        return _png_chunk(b"IDAT", data) if data else b""
+
+    def finish(self) -> bytes:
+        return _png_chunk(b"IDAT", self._compressor.flush()) + _png_chunk(b"IEND", b"")
@@ -0,0 +1,235 @@
+# Incremental re-rendering for repeated renders of the same project (thumbnails after each save, exports).
+#
+# The last render of each (project, scale) is kept with a signature of every visible layer. The next
+# render diffs the layer stack against it: each added, removed, changed or restacked layer marks its
+# old and new pixel boxes dirty, and only those rectangles are composited again (from the background
+# up, exactly as a full render would) and pasted over the previous result. Unchanged renders are free.
+#
+# When the same part of the stack keeps changing (one layer being dragged around), the layers below
+# it are composited once into a backdrop, and dirty rectangles are then composited from the backdrop up.
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from render import (
+    Box, BlobReader, SourceCache, canvas_size, composite_region, intersect, layer_pixel_box,
+    layers_in_region, parse_color, sorted_layers, source_key, to_rgba8
+)
+
+# Past this share of the canvas, redrawing the dirty rectangles costs about as much as a full render
+FULL_RENDER_RATIO = 0.5
+
+
+def layer_signature(layer: dict) -> tuple:
+    # Everything that affects a layer's pixels, apart from its position in the stack
+    data = layer.get("data") or {}
+    return (
+        layer.get("type"), layer.get("x", 0), layer.get("y", 0), layer.get("width", 0), layer.get("height", 0),
+        layer.get("opacity", 1.0), source_key(layer), data.get("src"), data.get("fill"), data.get("shape")
+    )
+
+
+def restacked(old_order: List[str], new_order: List[str]) -> List[str]:
+    """Layers whose position relative to the others changed: those outside the longest run kept in order."""
+    old_position = {layer_id: index for index, layer_id in enumerate(old_order)}
+    common = [layer_id for layer_id in new_order if layer_id in old_position]
+    # Longest increasing subsequence of old positions (patience sorting), tracking predecessors
+    tails: List[int] = []
+    tail_items: List[int] = []
+    previous = [-1] * len(common)
+    for index, layer_id in enumerate(common):
+        position = old_position[layer_id]
+        low, high = 0, len(tails)
+        while low < high:
+            mid = (low + high) // 2
+            if tails[mid] < position:
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(tails):
+            tails.append(position)
+            tail_items.append(index)
+        else:
+            tails[low] = position
+            tail_items[low] = index
+        previous[index] = tail_items[low - 1] if low else -1
+    kept = set()
+    index = tail_items[-1] if tail_items else -1
+    while index >= 0:
+        kept.add(common[index])
+        index = previous[index]
+    return [layer_id for layer_id in common if layer_id not in kept]
+
+
+def merge_boxes(boxes: List[Box]) -> List[Box]:
+    # Overlapping or touching rectangles are merged, so no pixel is composited twice
+    merged = list(boxes)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    merged[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+class CompositeEntry:
+    def __init__(self, size: Tuple[int, int], background: tuple, order: List[str], signatures: Dict[str, tuple],
+                 boxes: Dict[str, Box], pixels: np.ndarray):
+        self.size = size
+        self.background = background
+        self.order = order
+        self.signatures = signatures
+        self.boxes = boxes
+        self.pixels = pixels  # uint8 RGBA, shape (height, width, 4)
+        self.backdrop: Optional[Tuple[int, tuple, np.ndarray]] = None  # (layer count, their signatures, float canvas)
+        self.last_floor: Optional[int] = None
+
+    @property
+    def nbytes(self) -> int:
+        return self.pixels.nbytes + (self.backdrop[2].nbytes if self.backdrop is not None else 0)
+
+
+class CompositeCache:
+    """Last render per key, bounded by total bytes; one per worker process."""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, full_render_ratio: float = FULL_RENDER_RATIO):
+        self.max_bytes = max_bytes
+        self.full_render_ratio = full_render_ratio
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, CompositeEntry]" = OrderedDict()
+        self.full_renders = 0
+        self.incremental_renders = 0
+        self.unchanged_renders = 0
+        self.backdrop_renders = 0
+        self.pixels_rendered = 0
+        self.pixels_composited = 0
+
+    def render(self, key: Hashable, project: dict, scale: float, read_blob: BlobReader, sources: Optional[SourceCache] = None) -> np.ndarray:
+        """The project rendered at `scale` as uint8 RGBA, recompositing only what changed since the last render under `key`."""
+        # Each dirty rectangle composites its layers separately; decode each source once for all of them
+        sources = sources if sources is not None else SourceCache()
+        width, height = canvas_size(project, scale)
+        full = (0, 0, width, height)
+        background = parse_color(project.get("background_color"))
+        layers = sorted_layers(project.get("layers", []))
+        order = [layer.get("id") for layer in layers]
+        signatures = {layer.get("id"): layer_signature(layer) for layer in layers}
+        # Layers sized by their content can't be located without decoding them; treat them as covering everything
+        boxes = {
+            layer.get("id"): layer_pixel_box(layer, scale) if layer.get("width") and layer.get("height") else full
+            for layer in layers
+        }
+        self.pixels_rendered += width * height
+
+        entry = self._entries.get(key)
+        if entry is None or entry.size != (width, height) or entry.background != background or len(signatures) != len(order):
+            return self._full_render(key, project, layers, full, scale, read_blob, sources, order, signatures, boxes, background)
+
+        dirty: List[Box] = []
+        floor = len(order)
+        for layer_id in set(entry.order) - set(signatures):
+            dirty.append(entry.boxes[layer_id])
+            floor = 0
+        moved = set(restacked(entry.order, order))
+        for index, layer_id in enumerate(order):
+            previous = entry.signatures.get(layer_id)
+            if previous is None:
+                dirty.append(boxes[layer_id])
+            elif previous != signatures[layer_id] or layer_id in moved:
+                dirty += [entry.boxes[layer_id], boxes[layer_id]]
+            else:
+                continue
+            floor = min(floor, index)
+
+        if not dirty:
+            self.unchanged_renders += 1
+            self._entries.move_to_end(key)
+            return entry.pixels.copy()
+
+        rects = merge_boxes([box for box in (intersect(box, full) for box in dirty) if box is not None])
+        area = sum((box[2] - box[0]) * (box[3] - box[1]) for box in rects)
+        if area > self.full_render_ratio * width * height:
+            return self._full_render(key, project, layers, full, scale, read_blob, sources, order, signatures, boxes, background)
+
+        backdrop = self._backdrop(entry, project, layers, floor, full, scale, read_blob, sources, signatures)
+        start = backdrop[0] if backdrop is not None else 0
+        pixels = entry.pixels
+        for rect in rects:
+            base = backdrop[2][rect[1]:rect[3], rect[0]:rect[2]] if backdrop is not None else None
+            canvas = composite_region(project, layers_in_region(layers[start:], rect, scale), rect, scale, read_blob, sources, base=base)
+            pixels[rect[1]:rect[3], rect[0]:rect[2]] = to_rgba8(canvas)
+        self.pixels_composited += area
+        self.incremental_renders += 1
+
+        entry.order, entry.signatures, entry.boxes = order, signatures, boxes
+        self._entries.move_to_end(key)
+        return pixels.copy()
+
+    def _backdrop(self, entry: CompositeEntry, project: dict, layers: List[dict], floor: int, full: Box, scale: float,
+                  read_blob: BlobReader, sources: Optional[SourceCache], signatures: Dict[str, tuple]):
+        # The layers below `floor` didn't change; reuse (or, the second time in a row, build) their composite
+        prefix = tuple(signatures[layer.get("id")] for layer in layers[:floor])
+        backdrop = entry.backdrop
+        if backdrop is not None and backdrop[0] <= floor and backdrop[1] == prefix[:backdrop[0]]:
+            return backdrop
+        repeated = entry.last_floor == floor
+        entry.last_floor = floor
+        if floor == 0 or not repeated:
+            return None
+        canvas = composite_region(project, layers[:floor], full, scale, read_blob, sources)
+        if backdrop is not None:
+            self.size -= backdrop[2].nbytes
+            entry.backdrop = None
+        if entry.nbytes + canvas.nbytes > self.max_bytes:
+            return None
+        entry.backdrop = (floor, prefix, canvas)
+        self.size += canvas.nbytes
+        self.backdrop_renders += 1
+        self._evict(keep=entry)
+        return entry.backdrop
+
+    def _full_render(self, key: Hashable, project: dict, layers: List[dict], full: Box, scale: float, read_blob: BlobReader,
+                     sources: Optional[SourceCache], order: List[str], signatures: Dict[str, tuple], boxes: Dict[str, Box], background: tuple) -> np.ndarray:
+        pixels = to_rgba8(composite_region(project, layers, full, scale, read_blob, sources))
+        self.full_renders += 1
+        self.pixels_composited += full[2] * full[3]
+        self.discard(key)
+        if pixels.nbytes <= self.max_bytes:
+            entry = CompositeEntry((full[2], full[3]), background, order, signatures, boxes, pixels)
+            self._entries[key] = entry
+            self.size += entry.nbytes
+            self._evict(keep=entry)
+            return pixels.copy()
+        return pixels
+
+    def _evict(self, keep: CompositeEntry):
+        while self.size > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            if self._entries[oldest_key] is keep:
+                break
+            self.discard(oldest_key)
+
+    def discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.nbytes
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "full_renders": self.full_renders,
+            "incremental_renders": self.incremental_renders,
+            "unchanged_renders": self.unchanged_renders,
+            "backdrop_renders": self.backdrop_renders,
+            "composited_ratio": round(self.pixels_composited / self.pixels_rendered, 4) if self.pixels_rendered else 0.0
+        }
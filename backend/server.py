@@ -1,22 +1,91 @@
 import os
+import re
+import math
+import time
 import uuid
 import base64
+import itertools
 import json
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, UploadFile, File
+from typing import List, Optional, Dict, Any, Tuple
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse, JSONResponse, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import jwt
 from passlib.context import CryptContext
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
+from collaboration import ConnectionManager, create_backplane
+from blob_store import create_blob_store, blob_url, is_blob_hash
+from filters import chain_key, normalize_chain
+from history import ProjectHistory
+from ingest import AVIF_SUPPORTED, INGEST_FORMATS
+from project_state import ProjectStateStore, revision_filter
+from spatial import LayerIndexCache
+from proxies import PROXY_FIELDS, strip_proxy, strip_proxy_layers, with_proxy
+from layer_ops import LayerExists, LayerNotFound, apply_ops, field_update, layer_changes, layer_order, lightweight_changes, normalize_ops, summarize_changes
+from render import (
+    EXPORT_FORMATS, MEDIA_TYPES, THUMBNAIL_SIZES, DeepZoomZipWriter, PngStripEncoder, canvas_size,
+    deep_zoom_descriptor, deep_zoom_levels, iter_deep_zoom_tiles, iter_strip_regions
+)
+from jobs import JobPool, JobPoolSaturated, JobTimeout
+from indexes import UPLOAD_SESSION_TTL, audit_query_plans, ensure_indexes
+from thumbnails import ThumbnailScheduler
+import image_jobs
 
 # Environment variables
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-super-secret-jwt-key-change-in-production')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
+BLOB_STORE = os.environ.get('BLOB_STORE', 'local')  # 'local' or 'gridfs'
+BLOB_DIR = os.environ.get('BLOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobs'))
+UPLOAD_STAGING_DIR = os.environ.get('UPLOAD_STAGING_DIR', os.path.join(BLOB_DIR, 'uploads'))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 100 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries and headers around the file part
+PATCH_ATTEMPTS = 3  # a layer patch without a revision is re-applied this often when another write races it
+VIEWPORT_ATTEMPTS = 3  # a viewport query rebuilds its layer index this often when a write lands between index and read
+RENDER_MAX_PIXELS = int(os.environ.get('RENDER_MAX_PIXELS', 16_000_000))  # larger exports are rendered in strips
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 2))
+IMAGE_MAX_PENDING_JOBS = int(os.environ.get('IMAGE_MAX_PENDING_JOBS', IMAGE_WORKERS * 4))
+IMAGE_JOB_TIMEOUT = float(os.environ.get('IMAGE_JOB_TIMEOUT', 60))
+RENDER_CACHE_MB = float(os.environ.get('RENDER_CACHE_MB', 256))  # per image worker, for incremental re-renders; 0 disables
+DECODED_CACHE_MB = float(os.environ.get('DECODED_CACHE_MB', 256))  # per image worker, decoded pixels shared by filters and renders
+INGEST_MAX_EDGE = int(os.environ.get('INGEST_MAX_EDGE', 4096))  # uploads are downscaled to this longest edge; 0 keeps full resolution
+INGEST_FORMAT = os.environ.get('INGEST_FORMAT', 'auto')  # lossy re-encode target: auto (JPEG, or WebP with alpha), jpeg, webp, avif (Pillow 11.3+); 'original' stores uploads as is
+INGEST_QUALITY = int(os.environ.get('INGEST_QUALITY', 85))
+if INGEST_FORMAT not in INGEST_FORMATS:
+    raise ValueError(f"INGEST_FORMAT must be one of {', '.join(INGEST_FORMATS)}")
+if INGEST_FORMAT == "avif" and not AVIF_SUPPORTED:
+    # Every upload would otherwise fail in the worker and be stored as sent
+    raise ValueError("INGEST_FORMAT=avif needs Pillow with AVIF support (11.3 or later)")
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+TOKEN_CLAIMS_TRUST_SECONDS = float(os.environ.get('TOKEN_CLAIMS_TRUST_SECONDS', 0))  # 0 disables trusting token claims
+COLLAB_BACKPLANE = os.environ.get('COLLAB_BACKPLANE', 'local')  # 'local' (single worker) or 'redis'
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 1))  # max seconds live edits stay unpersisted
+STATE_FLUSH_OPS = int(os.environ.get('STATE_FLUSH_OPS', 100))  # ...or this many ops, whichever comes first
+STATE_IDLE_TIMEOUT = float(os.environ.get('STATE_IDLE_TIMEOUT', 60))  # in-memory state is dropped this long after the last socket leaves
+HISTORY_SNAPSHOT_INTERVAL = int(os.environ.get('HISTORY_SNAPSHOT_INTERVAL', 50))  # revisions between full snapshots in the history
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', 30))  # older history is compacted away
+LAYER_INDEX_CELL = float(os.environ.get('LAYER_INDEX_CELL', 512))  # grid cell size of the layer spatial index, in canvas pixels
+LAYER_INDEX_PROJECTS = int(os.environ.get('LAYER_INDEX_PROJECTS', 256))  # spatial indexes kept per worker
+COLLAB_SEND_QUEUE = int(os.environ.get('COLLAB_SEND_QUEUE', 256))  # messages buffered per socket before slow-client handling
+COLLAB_SEND_TIMEOUT = float(os.environ.get('COLLAB_SEND_TIMEOUT', 5))  # a single send stalling this long disconnects the client
+WS_PER_MESSAGE_DEFLATE = os.environ.get('WS_PER_MESSAGE_DEFLATE', 'true').lower() in ('1', 'true', 'yes')  # see scripts/bench_wire.py
+COLLAB_TRANSIENT_HZ = float(os.environ.get('COLLAB_TRANSIENT_HZ', 30))  # max cursor/tool updates relayed per sender per second
+QUERY_PLAN_AUDIT = os.environ.get('QUERY_PLAN_AUDIT', '').lower() in ('1', 'true', 'yes')  # dev only: explain every query at startup
+THUMBNAIL_DELAY = float(os.environ.get('THUMBNAIL_DELAY', 2))  # seconds of quiet after a save before rendering
+THUMBNAIL_MAX_DELAY = float(os.environ.get('THUMBNAIL_MAX_DELAY', 30))  # upper bound while a project keeps changing
 
 app = FastAPI(title="PixelCrafter API", version="1.0.0")
 
@@ -30,39 +99,123 @@ app.add_middleware(
 )
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Pinning min/max to the configured cost makes needs_update() flag hashes made at any other cost,
+# so changing BCRYPT_ROUNDS migrates users transparently on their next login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop without extra processes
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 security = HTTPBearer()
 
+# Authenticated users by id, so the hot paths don't re-read the user document on every request
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+auth_counters = {"claims_trusted": 0, "db_lookups": 0}
+ingest_counters = {"normalized": 0, "kept": 0, "unchecked": 0, "unreadable": 0, "bytes_uploaded": 0, "bytes_stored": 0}
+# Blobs are served without auth from the API origin, so only raster types a browser can't execute are served
+# inline; anything else (HTML, SVG, ...) goes out as a download
+INLINE_BLOB_TYPES = {"image/png", "image/jpeg", "image/webp", "image/gif", "image/avif", "image/bmp"}
+
 # MongoDB client
 mongo_client = AsyncIOMotorClient(MONGO_URL)
 db = mongo_client.pixelcrafter
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, project_id: str):
-        await websocket.accept()
-        if project_id not in self.active_connections:
-            self.active_connections[project_id] = []
-        self.active_connections[project_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, project_id: str):
-        if project_id in self.active_connections:
-            self.active_connections[project_id].remove(websocket)
-            if not self.active_connections[project_id]:
-                del self.active_connections[project_id]
-
-    async def broadcast_to_project(self, project_id: str, message: dict):
-        if project_id in self.active_connections:
-            for connection in self.active_connections[project_id].copy():
-                try:
-                    await connection.send_json(message)
-                except:
-                    self.active_connections[project_id].remove(connection)
-
-manager = ConnectionManager()
+# Blob storage for image data (layers only hold a reference)
+blob_store = create_blob_store(BLOB_STORE, db=db, mongo_url=MONGO_URL, root=BLOB_DIR)
+
+# Process pool for CPU-bound image work (decode, filter, composite, encode) so it never runs on the event loop
+image_pool = JobPool(
+    workers=IMAGE_WORKERS,
+    max_pending=IMAGE_MAX_PENDING_JOBS,
+    timeout=IMAGE_JOB_TIMEOUT,
+    initializer=image_jobs.init_worker,
+    initargs=(BLOB_STORE, MONGO_URL, BLOB_DIR, int(RENDER_CACHE_MB * 1024 * 1024), int(DECODED_CACHE_MB * 1024 * 1024)),
+    worker_stats=image_jobs.worker_stats
+)
+
+async def run_image_job(fn, *args, wait: bool = False):
+    try:
+        return await image_pool.run(fn, *args, wait=wait)
+    except JobPoolSaturated:
+        raise HTTPException(status_code=503, detail="Image processing is busy, please retry shortly", headers={"Retry-After": "1"})
+    except JobTimeout:
+        raise HTTPException(status_code=504, detail="Image processing timed out")
+
+async def generate_thumbnails(project_id: str):
+    project = await db.projects.find_one({"id": project_id}, {"_id": 0})
+    if not project:
+        return
+    revision = project.get("revision", 0)
+    if project.get("thumbnail_revision") == revision and project.get("thumbnails"):
+        return
+    
+    # Background work queues for a slot instead of being rejected like an interactive request
+    encoded = await image_pool.run(image_jobs.thumbnails, project, THUMBNAIL_SIZES, wait=True)
+    thumbnails = {}
+    for size, data in encoded.items():
+        blob_hash = await blob_store.put(data)
+        await register_blob(blob_hash, len(data), "image/webp", thumbnail_of=project_id)
+        thumbnails[str(size)] = blob_hash
+    
+    # Derived data: neither revision nor updated_at changes, so this never conflicts with an editor's save
+    previous = await db.projects.find_one_and_update(
+        {"id": project_id},
+        {"$set": {"thumbnails": thumbnails, "thumbnail_revision": revision}},
+        {"thumbnails": 1}
+    )
+    if previous is None:
+        # Deleted while rendering
+        await release_thumbnails(project_id, thumbnails.values())
+    else:
+        superseded = set((previous.get("thumbnails") or {}).values()) - set(thumbnails.values())
+        await release_thumbnails(project_id, superseded)
+
+# Thumbnails are rendered after a project goes quiet, never on the request path of a save
+thumbnail_scheduler = ThumbnailScheduler(generate_thumbnails, delay=THUMBNAIL_DELAY, max_delay=THUMBNAIL_MAX_DELAY)
+
+# WebSocket fan-out across workers; 'redis' is required once uvicorn runs more than one worker
+manager = ConnectionManager(
+    create_backplane(COLLAB_BACKPLANE, REDIS_URL),
+    max_queue=COLLAB_SEND_QUEUE,
+    send_timeout=COLLAB_SEND_TIMEOUT,
+    transient_rate=COLLAB_TRANSIENT_HZ
+)
+
+# Append-only change log plus periodic snapshots, for history browsing and undo
+project_history = ProjectHistory(db, snapshot_interval=HISTORY_SNAPSHOT_INTERVAL, retention_days=HISTORY_RETENTION_DAYS)
+
+# Per-project grids of layer bounding boxes, for viewport queries
+layer_index = LayerIndexCache(cell_size=LAYER_INDEX_CELL, maxsize=LAYER_INDEX_PROJECTS)
+
+async def record_change(project_id: str, base_revision: int, revision: int, ops: List[dict], order: Optional[List[str]] = None, **history):
+    # Every stored write ends here: the spatial index follows the same ops the history records
+    layer_index.apply(project_id, base_revision, revision, ops, reordered=order is not None)
+    await project_history.record(project_id, base_revision, revision, ops, order=order, **history)
+
+async def persist_live_edits(project_id: str, base_revision: int, revision: int, ops: List[dict]):
+    # Called once per write-behind flush; only the owner edits over the socket
+    session = project_states.get(project_id)
+    owner_id = session.project.get("owner_id") if session else None
+    thumbnail_scheduler.schedule(project_id)
+    await record_change(project_id, base_revision, revision, ops, user_id=owner_id, source="live")
+
+async def announce_rebase(project_id: str, revision: int):
+    # In-memory edits were replayed on top of a write made elsewhere; editors should reload
+    await manager.broadcast_to_project(project_id, {"type": "project_reload", "data": {"revision": revision}})
+
+# Live projects: WebSocket edits are applied in memory and written to MongoDB in batches
+project_states = ProjectStateStore(
+    db,
+    flush_interval=STATE_FLUSH_INTERVAL,
+    flush_ops=STATE_FLUSH_OPS,
+    idle_timeout=STATE_IDLE_TIMEOUT,
+    on_flush=persist_live_edits,
+    on_rebase=announce_rebase
+)
 
 # Pydantic models
 class UserCreate(BaseModel):
@@ -103,6 +256,17 @@ class Project(BaseModel):
     owner_id: str
     created_at: datetime
     updated_at: datetime
+    revision: int = 0  # bumped on every write; documents created before revisions existed read as 0
+
+class ProjectSummary(BaseModel):
+    id: str
+    name: str
+    width: int
+    height: int
+    background_color: str = "#ffffff"
+    updated_at: datetime
+    layer_count: int = 0
+    thumbnail: Optional[str] = None
 
 class ProjectCreate(BaseModel):
     name: str
@@ -110,6 +274,26 @@ class ProjectCreate(BaseModel):
     height: int = 1080
     background_color: str = "#ffffff"
 
+class LayerPatch(BaseModel):
+    ops: List[Dict[str, Any]]  # see layer_ops.py for the operation format
+    revision: Optional[int] = None  # expected project revision; omit to apply regardless
+
+class HistoryAction(BaseModel):
+    revision: Optional[int] = None  # expected current revision; omit to apply regardless
+
+class UploadInit(BaseModel):
+    filename: str
+    content_type: str = "application/octet-stream"
+    size: Optional[int] = None
+
+class FilterStep(BaseModel):
+    op: str  # 'blur', 'brightness'
+    params: Dict[str, float] = {}
+
+class FilterChainRequest(BaseModel):
+    filters: List[FilterStep]
+    replace: bool = False  # replace the layer's existing chain instead of appending to it
+
 class ChatMessage(BaseModel):
     message: str
     session_id: str
@@ -124,39 +308,99 @@ class CollaborationMessage(BaseModel):
     user_id: str
 
 # Utility functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    # Returns (valid, new_hash); new_hash is set when the stored hash was made with a different cost
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def user_claims(user: dict) -> dict:
+    # Profile claims let get_current_user skip the database for freshly issued tokens (TOKEN_CLAIMS_TRUST_SECONDS)
+    return {
+        "sub": user["id"],
+        "username": user["username"],
+        "email": user["email"],
+        "created_at": user["created_at"].isoformat()
+    }
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=24)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + timedelta(hours=24)
+    to_encode.update({"exp": expire, "iat": now})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm="HS256")
     return encoded_jwt
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await user_from_token(credentials.credentials)
+
+async def user_from_token(token: str) -> User:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    user = await db.users.find_one({"id": user_id})
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    if TOKEN_CLAIMS_TRUST_SECONDS > 0 and "username" in payload and time.time() - payload.get("iat", 0) <= TOKEN_CLAIMS_TRUST_SECONDS:
+        auth_counters["claims_trusted"] += 1
+        return User(
+            id=user_id,
+            username=payload["username"],
+            email=payload["email"],
+            created_at=datetime.fromisoformat(payload["created_at"])
+        )
+    
+    auth_counters["db_lookups"] += 1
+    user = await db.users.find_one({"id": user_id}, {"password": 0})
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     
-    return User(**user)
+    current_user = User(**user)
+    user_cache.set(user_id, current_user)
+    return current_user
 
 # Routes
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "service": "PixelCrafter API"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    return {
+        "image_jobs": image_pool.stats(),
+        "user_cache": {**user_cache.stats(), **auth_counters},
+        "thumbnails": thumbnail_scheduler.stats(),
+        "collaboration": manager.stats(),
+        "project_state": project_states.stats(),
+        "history": project_history.stats(),
+        "layer_index": layer_index.stats(),
+        "ingest": ingest_counters
+    }
+
+@app.on_event("startup")
+async def create_indexes():
+    await ensure_indexes(db)
+    await sweep_upload_staging()
+    if QUERY_PLAN_AUDIT:
+        await audit_query_plans(db)
+
+@app.on_event("shutdown")
+async def shutdown_executors():
+    await project_states.shutdown()
+    thumbnail_scheduler.shutdown()
+    await manager.backplane.close()
+    image_pool.shutdown()
+    password_executor.shutdown(wait=False)
+
 @app.post("/api/auth/register")
 async def register(user_data: UserCreate):
     # Check if user exists
@@ -166,7 +410,7 @@ async def register(user_data: UserCreate):
     
     # Create user
     user_id = str(uuid.uuid4())
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     
     user_doc = {
         "id": user_id,
@@ -176,10 +420,14 @@ async def register(user_data: UserCreate):
         "created_at": datetime.utcnow()
     }
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Two registrations racing past the check above; the unique email index lets only one through
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create access token
-    access_token = create_access_token(data={"sub": user_id})
+    access_token = create_access_token(data=user_claims(user_doc))
     
     return {
         "access_token": access_token,
@@ -194,10 +442,18 @@ async def register(user_data: UserCreate):
 @app.post("/api/auth/login")
 async def login(login_data: UserLogin):
     user = await db.users.find_one({"email": login_data.email})
-    if not user or not verify_password(login_data.password, user["password"]):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    access_token = create_access_token(data={"sub": user["id"]})
+    valid, new_hash = await verify_password(login_data.password, user["password"])
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    if new_hash:
+        await db.users.update_one({"id": user["id"]}, {"$set": {"password": new_hash}})
+        user_cache.invalidate(user["id"])
+    
+    access_token = create_access_token(data=user_claims(user))
     
     return {
         "access_token": access_token,
@@ -226,10 +482,13 @@ async def create_project(project_data: ProjectCreate, current_user: User = Depen
         "layers": [],
         "owner_id": current_user.id,
         "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
+        "updated_at": datetime.utcnow(),
+        "revision": 1
     }
     
     await db.projects.insert_one(project_doc)
+    await project_history.snapshot(project_id, project_doc)
+    thumbnail_scheduler.schedule(project_id)
     
     return Project(**project_doc)
 
@@ -238,88 +497,795 @@ async def get_user_projects(current_user: User = Depends(get_current_user)):
     projects = await db.projects.find({"owner_id": current_user.id}).to_list(100)
     return [Project(**project) for project in projects]
 
+def encode_project_cursor(project: dict) -> str:
+    position = json.dumps([project["updated_at"].isoformat(), project["id"]])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+def decode_project_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        updated_at, project_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(updated_at), project_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/projects/summary")
+async def get_project_summaries(limit: int = 50, cursor: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="Limit must be between 1 and 100")
+    
+    query = {"owner_id": current_user.id}
+    if cursor:
+        # Keyset pagination: resume strictly after the last (updated_at, id) of the previous page
+        updated_at, project_id = decode_project_cursor(cursor)
+        query["$or"] = [
+            {"updated_at": {"$lt": updated_at}},
+            {"updated_at": updated_at, "id": {"$lt": project_id}}
+        ]
+    
+    # Layers never leave the database; only their count does
+    projects = await db.projects.aggregate([
+        {"$match": query},
+        {"$sort": {"updated_at": -1, "id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "name": 1,
+            "width": 1,
+            "height": 1,
+            "background_color": 1,
+            "updated_at": 1,
+            "thumbnail": f"$thumbnails.{THUMBNAIL_SIZES[0]}",
+            "layer_count": {"$size": {"$ifNull": ["$layers", []]}}
+        }}
+    ]).to_list(limit + 1)
+    
+    next_cursor = encode_project_cursor(projects[limit - 1]) if len(projects) > limit else None
+    summaries = []
+    for project in projects[:limit]:
+        if project.get("thumbnail"):
+            project["thumbnail"] = blob_url(project["thumbnail"])
+        summaries.append(ProjectSummary(**project))
+    
+    return {"projects": summaries, "next_cursor": next_cursor}
+
 @app.get("/api/projects/{project_id}")
-async def get_project(project_id: str, current_user: User = Depends(get_current_user)):
-    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
+async def get_project(project_id: str, scale: Optional[float] = None, current_user: User = Depends(get_current_user)):
+    if scale is not None and not 0 < scale <= 16:
+        raise HTTPException(status_code=400, detail="Scale must be between 0 and 16")
+    
+    session = project_states.get(project_id)
+    if session and session.project.get("owner_id") == current_user.id:
+        # Includes live edits that haven't been flushed yet
+        project = session.project
+    else:
+        project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
     
+    if scale is not None:
+        # Progressive loading: image layers reference the proxy that fits the viewport's scale
+        project = await with_layer_proxies(project, scale)
     return Project(**project)
 
+async def with_layer_proxies(project: dict, scale: float) -> dict:
+    layers = project.get("layers") or []
+    hashes = list({layer["data"]["blob"] for layer in layers if layer.get("type") == "image" and (layer.get("data") or {}).get("blob")})
+    if not hashes:
+        return project
+    
+    pyramids = {}
+    async for blob in db.blobs.find({"hash": {"$in": hashes}, "proxies": {"$ne": []}}, {"_id": 0, "hash": 1, "proxies": 1}):
+        if blob.get("proxies"):
+            pyramids[blob["hash"]] = blob["proxies"]
+    return {**project, "layers": [
+        with_proxy(layer, pyramids[layer["data"]["blob"]], scale, blob_url)
+        if layer.get("type") == "image" and (layer.get("data") or {}).get("blob") in pyramids else layer
+        for layer in layers
+    ]}
+
+def project_query(project_id: str, current_user: User, revision: Optional[int] = None) -> dict:
+    query = {"id": project_id, "owner_id": current_user.id}
+    if revision is not None:
+        query["revision"] = revision_filter(revision)
+    return query
+
+async def revision_error(project_id: str, current_user: User) -> HTTPException:
+    # Only called after a conditional write matched nothing, to tell a missing project from a stale revision
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id}, {"revision": 1})
+    if not project:
+        return HTTPException(status_code=404, detail="Project not found")
+    return HTTPException(status_code=409, detail={
+        "message": "Project was modified by someone else",
+        "revision": project.get("revision", 0)
+    })
+
 @app.put("/api/projects/{project_id}")
 async def update_project(project_id: str, project_data: dict, current_user: User = Depends(get_current_user)):
-    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
+    expected_revision = project_data.get("revision")
+    if expected_revision is not None and (not isinstance(expected_revision, int) or isinstance(expected_revision, bool)):
+        raise HTTPException(status_code=400, detail="revision must be an integer")
     
-    update_data = {
-        **project_data,
-        "updated_at": datetime.utcnow()
-    }
+    # Identity and bookkeeping fields are owned by the server, whatever the client sends back
+    update_data = {key: value for key, value in project_data.items() if key not in ("_id", "id", "owner_id", "created_at", "revision")}
+    update_data["updated_at"] = datetime.utcnow()
+    if isinstance(update_data.get("layers"), list):
+        update_data["layers"] = strip_proxy_layers(update_data["layers"])
     
-    await db.projects.update_one(
-        {"id": project_id},
-        {"$set": update_data}
+    await project_states.flush(project_id)
+    # The previous state is returned (still one round-trip) so collaborators can be sent just the difference
+    previous = await db.projects.find_one_and_update(
+        project_query(project_id, current_user, expected_revision),
+        {"$set": update_data, "$inc": {"revision": 1}},
+        return_document=ReturnDocument.BEFORE
     )
+    if not previous:
+        raise await revision_error(project_id, current_user)
     
-    # Broadcast update to collaborators
+    return await finish_project_update(project_id, previous, update_data, current_user, source="save")
+
+async def finish_project_update(project_id: str, previous: dict, update_data: dict, current_user: User, source: str, **history_extra) -> Project:
+    # Shared by saves and history restores, once `update_data` has been $set on top of `previous`
+    project = {**previous, **update_data, "revision": previous.get("revision", 0) + 1}
+    await project_states.reload(project_id)
+    thumbnail_scheduler.schedule(project_id)
+    
+    fields = {key: value for key, value in update_data.items() if key != "layers" and previous.get(key) != value}
+    changes = []
+    order = None
+    if "layers" in update_data:
+        changes = layer_changes(previous.get("layers", []), update_data["layers"])
+        order = layer_order(previous.get("layers", []), update_data["layers"], changes)
+    await record_change(
+        project_id, project["revision"] - 1, project["revision"], changes,
+        fields=fields, order=order, user_id=current_user.id, source=source, **history_extra
+    )
+    
+    # Collaborators get the revision and what changed; inline image data is never pushed to them
     await manager.broadcast_to_project(project_id, {
         "type": "project_update",
-        "data": update_data,
+        "data": {
+            "revision": project["revision"],
+            "updated_at": update_data["updated_at"],
+            "project": {key: value for key, value in fields.items() if key != "updated_at"},
+            "changes": lightweight_changes(changes)
+        },
         "user_id": current_user.id
     })
     
-    updated_project = await db.projects.find_one({"id": project_id})
-    return Project(**updated_project)
+    return Project(**project)
+
+def validate_layer_ops(raw_ops: List[dict]) -> List[dict]:
+    ops = normalize_ops(raw_ops)
+    for op in ops:
+        if op["op"] == "add":
+            op["layer"] = Layer(**op["layer"]).dict()
+            op["layer"]["data"] = strip_proxy(op["layer"]["data"])
+        elif op["op"] != "delete":
+            # Proxy references are a property of how the client loaded the project, not of the layer
+            fields = op["fields"]
+            if "data" in fields:
+                fields["data"] = strip_proxy(fields["data"])
+            for name in PROXY_FIELDS:
+                fields.pop(f"data.{name}", None)
+    return [op for op in ops if op["op"] in ("add", "delete") or op["fields"]]
+
+@app.patch("/api/projects/{project_id}/layers")
+async def patch_project_layers(project_id: str, patch_data: LayerPatch, current_user: User = Depends(get_current_user)):
+    try:
+        ops = validate_layer_ops(patch_data.ops)
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await project_states.flush(project_id)
+    update = field_update(ops)
+    if update is not None:
+        base_revision, updated_at = await patch_layer_fields(project_id, current_user, patch_data.revision, ops, *update)
+    else:
+        base_revision, updated_at = await patch_layer_list(project_id, current_user, patch_data.revision, ops)
+    revision = base_revision + 1
+    await project_states.reload(project_id)
+    thumbnail_scheduler.schedule(project_id)
+    await record_change(
+        project_id, base_revision, revision, ops, fields={"updated_at": updated_at}, user_id=current_user.id, source="patch"
+    )
+    
+    changes = summarize_changes(ops)
+    await manager.broadcast_to_project(project_id, {
+        "type": "layers_patch",
+        "data": {"changes": lightweight_changes(changes), "updated_at": updated_at, "revision": revision},
+        "user_id": current_user.id
+    })
+    
+    return {"changes": changes, "updated_at": updated_at, "revision": revision}
+
+async def patch_layer_fields(project_id: str, current_user: User, expected_revision: Optional[int], ops: List[dict],
+                             fields: dict, array_filters: List[dict]) -> Tuple[int, datetime]:
+    # Drags and other field-only patches: one targeted update that neither reads nor rewrites the layers
+    # array, conditioned on the revision and on every layer it touches existing. Returns (base revision, updated_at).
+    layer_ids = list(dict.fromkeys(op["id"] for op in ops))
+    query = project_query(project_id, current_user, expected_revision)
+    if layer_ids:
+        query["layers.id"] = {"$all": layer_ids}
+    updated_at = datetime.utcnow()
+    project = await db.projects.find_one_and_update(
+        query,
+        {"$set": {**fields, "updated_at": updated_at}, "$inc": {"revision": 1}},
+        projection={"_id": 0, "revision": 1},
+        array_filters=array_filters or None,
+        return_document=ReturnDocument.AFTER
+    )
+    if project:
+        return project["revision"] - 1, updated_at
+    
+    stored = await db.projects.find_one(project_query(project_id, current_user, expected_revision), {"_id": 0, "layers.id": 1})
+    if stored:
+        present = {layer.get("id") for layer in stored.get("layers", [])}
+        missing = next((layer_id for layer_id in layer_ids if layer_id not in present), None)
+        if missing is not None:
+            raise HTTPException(status_code=404, detail=f"Layer {missing} not found")
+    raise await revision_error(project_id, current_user)
+
+async def patch_layer_list(project_id: str, current_user: User, expected_revision: Optional[int], ops: List[dict]) -> Tuple[int, datetime]:
+    # Adds and deletes: the ops are applied to the stored layers and written back in one update conditioned on
+    # the revision they were read at, so a patch is stored entirely or not at all, and always as a single revision
+    for _ in range(PATCH_ATTEMPTS):
+        project = await db.projects.find_one(project_query(project_id, current_user, expected_revision), {"_id": 0, "layers": 1, "revision": 1})
+        if not project:
+            raise await revision_error(project_id, current_user)
+        layers = project.get("layers", [])
+        try:
+            apply_ops(layers, ops)
+        except LayerNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except LayerExists as e:
+            # An add would otherwise duplicate a layer id, and every later update by id would hit both copies
+            raise HTTPException(status_code=409, detail=str(e))
+        base_revision = project.get("revision", 0)
+        updated_at = datetime.utcnow()
+        result = await db.projects.update_one(
+            project_query(project_id, current_user, base_revision),
+            {"$set": {"layers": layers, "updated_at": updated_at}, "$inc": {"revision": 1}}
+        )
+        if result.modified_count:
+            return base_revision, updated_at
+        if expected_revision is not None:
+            # The client's revision was current when read but not when written
+            raise await revision_error(project_id, current_user)
+    raise await revision_error(project_id, current_user)
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    try:
+        left, top, right, bottom = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be left,top,right,bottom")
+    if not all(math.isfinite(value) for value in (left, top, right, bottom)) or right < left or bottom < top:
+        raise HTTPException(status_code=400, detail="bbox must be left,top,right,bottom")
+    return left, top, right, bottom
+
+# Only what the spatial index needs, so rebuilding it never reads image data
+LAYER_GEOMETRY_PROJECTION = {"_id": 0, "revision": 1, **{f"layers.{name}": 1 for name in ("id", "x", "y", "width", "height", "z_index")}}
+
+@app.get("/api/projects/{project_id}/layers")
+async def get_layers_in_viewport(project_id: str, bbox: str, scale: Optional[float] = None, current_user: User = Depends(get_current_user)):
+    # Layers intersecting a viewport (canvas coordinates), bottom-most first
+    box = parse_bbox(bbox)
+    if scale is not None and not 0 < scale <= 16:
+        raise HTTPException(status_code=400, detail="Scale must be between 0 and 16")
+    
+    session = project_states.get(project_id)
+    if session and session.project.get("owner_id") == current_user.id:
+        grid = layer_index.get(project_id, session.revision) or layer_index.build(project_id, session.revision, session.project.get("layers", []))
+        by_id = {layer.get("id"): layer for layer in session.project.get("layers", [])}
+        layers = [by_id[layer_id] for layer_id in grid.query(box)]
+        revision = session.revision
+    else:
+        layers = None
+        grid = layer_index.get(project_id)
+        for _ in range(VIEWPORT_ATTEMPTS):
+            if grid is None:
+                project = await db.projects.find_one(project_query(project_id, current_user), LAYER_GEOMETRY_PROJECTION)
+                if not project:
+                    raise HTTPException(status_code=404, detail="Project not found")
+                grid = layer_index.build(project_id, project.get("revision", 0), project.get("layers", []))
+            ids = grid.query(box)
+            # Mongo filters the layers array, so only the matching layers leave the database
+            result = await db.projects.aggregate([
+                {"$match": project_query(project_id, current_user, grid.revision)},
+                {"$project": {"_id": 0, "layers": {"$filter": {"input": "$layers", "as": "layer", "cond": {"$in": ["$$layer.id", ids]}}}}}
+            ]).to_list(1)
+            if result:
+                position = {layer_id: index for index, layer_id in enumerate(ids)}
+                layers = sorted(result[0]["layers"], key=lambda layer: position[layer["id"]])
+                revision = grid.revision
+                break
+            # The index is behind the stored project (or it's gone): rebuild and try again
+            grid = None
+        if layers is None:
+            raise await revision_error(project_id, current_user)
+    
+    if scale is not None:
+        layers = (await with_layer_proxies({"layers": layers}, scale))["layers"]
+    return {"layers": [Layer(**layer) for layer in layers], "revision": revision}
+
+@app.get("/api/projects/{project_id}/layers/{layer_id}")
+async def get_project_layer(project_id: str, layer_id: str, current_user: User = Depends(get_current_user)):
+    # Lets collaborators fetch a single layer whose image data was left out of a broadcast
+    await project_states.flush(project_id)
+    project = await db.projects.find_one(
+        {"id": project_id, "owner_id": current_user.id},
+        {"layers": {"$elemMatch": {"id": layer_id}}}
+    )
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not project.get("layers"):
+        raise HTTPException(status_code=404, detail="Layer not found")
+    
+    return Layer(**project["layers"][0])
+
+@app.get("/api/projects/{project_id}/history")
+async def get_project_history(project_id: str, limit: int = 50, before: Optional[int] = None, current_user: User = Depends(get_current_user)):
+    if not 1 <= limit <= 200:
+        raise HTTPException(status_code=400, detail="Limit must be between 1 and 200")
+    # Newest first; pass next_before back as `before` for the previous page
+    if not await db.projects.find_one(project_query(project_id, current_user), {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    entries = await project_history.entries(project_id, before=before, limit=limit)
+    for entry in entries:
+        entry["ops"] = lightweight_changes(summarize_changes(entry["ops"]))
+    return {
+        "entries": entries,
+        "next_before": entries[-1]["revision"] if len(entries) == limit else None
+    }
+
+@app.get("/api/projects/{project_id}/history/{revision}")
+async def get_project_revision(project_id: str, revision: int, current_user: User = Depends(get_current_user)):
+    if not await db.projects.find_one(project_query(project_id, current_user), {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    state = await project_history.state_at(project_id, revision)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Revision not available")
+    return Project(**state)
+
+async def restore_project_revision(project_id: str, target_revision: int, expected_revision: Optional[int], current_user: User, source: str, **history_extra) -> Project:
+    # Writes an old revision back as a new one, so undo is itself part of the history
+    target = await project_history.state_at(project_id, target_revision)
+    if target is None:
+        raise HTTPException(status_code=404, detail="Revision not available")
+    
+    update_data = {key: target[key] for key in ("name", "width", "height", "background_color", "layers") if key in target}
+    update_data["updated_at"] = datetime.utcnow()
+    previous = await db.projects.find_one_and_update(
+        project_query(project_id, current_user, expected_revision),
+        {"$set": update_data, "$inc": {"revision": 1}},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not previous:
+        raise await revision_error(project_id, current_user)
+    
+    return await finish_project_update(
+        project_id, previous, update_data, current_user, source=source, restored_revision=target_revision, **history_extra
+    )
+
+async def current_revision(project_id: str, current_user: User, expected_revision: Optional[int]) -> int:
+    await project_states.flush(project_id)
+    project = await db.projects.find_one(project_query(project_id, current_user), {"revision": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    revision = project.get("revision", 0)
+    if expected_revision is not None and expected_revision != revision:
+        raise await revision_error(project_id, current_user)
+    return revision
+
+@app.post("/api/projects/{project_id}/undo")
+async def undo_project_change(project_id: str, action: Optional[HistoryAction] = None, current_user: User = Depends(get_current_user)):
+    head = await current_revision(project_id, current_user, action.revision if action else None)
+    target = await project_history.undo_target(project_id, head)
+    if target is None:
+        raise HTTPException(status_code=409, detail="Nothing to undo")
+    # Conditional on `head`, so a change landing in between is never silently undone
+    return await restore_project_revision(project_id, target, head, current_user, source="undo")
+
+@app.post("/api/projects/{project_id}/redo")
+async def redo_project_change(project_id: str, action: Optional[HistoryAction] = None, current_user: User = Depends(get_current_user)):
+    head = await current_revision(project_id, current_user, action.revision if action else None)
+    target = await project_history.redo_target(project_id, head)
+    if target is None:
+        raise HTTPException(status_code=409, detail="Nothing to redo")
+    revision, undo_revision = target
+    return await restore_project_revision(project_id, revision, head, current_user, source="redo", redone_revision=undo_revision)
+
+@app.post("/api/projects/{project_id}/history/{revision}/restore")
+async def restore_project_history(project_id: str, revision: int, action: Optional[HistoryAction] = None, current_user: User = Depends(get_current_user)):
+    head = await current_revision(project_id, current_user, action.revision if action else None)
+    return await restore_project_revision(project_id, revision, head, current_user, source="restore")
 
 @app.delete("/api/projects/{project_id}")
 async def delete_project(project_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.projects.delete_one({"id": project_id, "owner_id": current_user.id})
-    if result.deleted_count == 0:
+    project = await db.projects.find_one_and_delete({"id": project_id, "owner_id": current_user.id}, {"thumbnails": 1})
+    if not project:
         raise HTTPException(status_code=404, detail="Project not found")
+    project_states.discard(project_id)
+    layer_index.invalidate(project_id)
+    await project_history.delete(project_id)
+    await release_thumbnails(project_id, (project.get("thumbnails") or {}).values())
     
     return {"message": "Project deleted successfully"}
 
-@app.post("/api/projects/{project_id}/upload-image")
-async def upload_image(project_id: str, file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
-    # Verify project access
-    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
+def blob_content_type(content_type: Optional[str]) -> str:
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return media_type if media_type in INLINE_BLOB_TYPES else "application/octet-stream"
+
+async def register_blob(blob_hash: str, size: int, content_type: Optional[str], thumbnail_of: Optional[str] = None):
+    # Identical uploads across projects share one blob and one metadata record. Thumbnails list the projects
+    # showing them, so release_thumbnails() can delete one nobody shows; any other use pins the blob for good.
+    update = {"$setOnInsert": {
+        "hash": blob_hash,
+        "size": size,
+        "content_type": blob_content_type(content_type),
+        "created_at": datetime.utcnow()
+    }}
+    if thumbnail_of:
+        update["$addToSet"] = {"thumbnail_of": thumbnail_of}
+    else:
+        update["$set"] = {"pinned": True}
+    await db.blobs.update_one({"hash": blob_hash}, update, upsert=True)
+
+async def release_thumbnails(project_id: str, hashes):
+    for blob_hash in set(hashes):
+        await db.blobs.update_one({"hash": blob_hash}, {"$pull": {"thumbnail_of": project_id}})
+        # Blank canvases of the same size render identical thumbnails, so only the last project's release deletes
+        if await db.blobs.find_one_and_delete({"hash": blob_hash, "thumbnail_of": {"$size": 0}, "pinned": {"$ne": True}}):
+            await blob_store.delete(blob_hash)
+
+async def store_blob_stream(chunks, content_type: Optional[str]) -> str:
+    # Copies chunks into the blob store while hashing; memory use is one chunk regardless of file size
+    writer = await blob_store.open_writer()
+    try:
+        async for chunk in chunks:
+            if writer.size + len(chunk) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+            await writer.write(chunk)
+        blob_hash = await writer.commit()
+    except BaseException:
+        await writer.abort()
+        raise
     
-    # Read and encode image
-    contents = await file.read()
-    image_base64 = base64.b64encode(contents).decode('utf-8')
+    await register_blob(blob_hash, writer.size, content_type)
+    return blob_hash
+
+async def iter_upload_file(file: UploadFile):
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+async def ensure_proxies(blob_hash: str):
+    # Built once per blob; identical uploads and repeated filter results share the same pyramid
+    blob = await db.blobs.find_one({"hash": blob_hash}, {"proxies": 1})
+    if blob is None or "proxies" in blob:
+        return
+    try:
+        pyramid = await image_pool.run(image_jobs.proxies, blob_hash, wait=True)
+    except Exception:
+        # Not an image Pillow can read, or processing timed out: the layer just loads at full resolution
+        pyramid = {"levels": []}
+    await save_proxies(blob_hash, pyramid)
+
+async def save_proxies(blob_hash: str, pyramid: dict):
+    proxies = []
+    for width, height, data in pyramid["levels"]:
+        proxy_hash = await blob_store.put(data)
+        await register_blob(proxy_hash, len(data), "image/webp")
+        proxies.append({"hash": proxy_hash, "width": width, "height": height})
+    update = {"proxies": proxies}
+    if "width" in pyramid:
+        update.update(width=pyramid["width"], height=pyramid["height"])
+    await db.blobs.update_one({"hash": blob_hash}, {"$set": update})
+
+async def stage_upload_file(file: UploadFile) -> Tuple[str, int]:
+    # Uploads are normalized before they are stored, so they are first spooled to the staging directory
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    path = upload_staging_path(str(uuid.uuid4()))
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            async for chunk in iter_upload_file(file):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+                await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, size
+
+async def ingest_upload(path: str, size: int, content_type: Optional[str]) -> str:
+    """Stores a staged upload after normalizing it in an image worker (see ingest.py); returns its blob hash."""
+    ingest_counters["bytes_uploaded"] += size
+    try:
+        result = await image_pool.run(image_jobs.ingest, path, INGEST_MAX_EDGE, INGEST_FORMAT, INGEST_QUALITY, wait=True)
+    except (JobPoolSaturated, JobTimeout):
+        # Couldn't be checked in time: stored as uploaded, and served as a download unless it claims an image type
+        ingest_counters["unchecked"] += 1
+        blob_hash = await store_blob_stream(iter_staged_upload(path, size), content_type)
+        ingest_counters["bytes_stored"] += size
+        return blob_hash
+    except Exception:
+        ingest_counters["unreadable"] += 1
+        raise HTTPException(status_code=400, detail="File is not an image that can be read")
     
-    # Create a new image layer
+    if result["data"] is not None:
+        ingest_counters["normalized"] += 1
+        blob_hash = await blob_store.put(result["data"])
+        await register_blob(blob_hash, len(result["data"]), result["content_type"])
+        ingest_counters["bytes_stored"] += len(result["data"])
+    else:
+        ingest_counters["kept"] += 1
+        blob_hash = await store_blob_stream(iter_staged_upload(path, size), result["content_type"] or content_type)
+        ingest_counters["bytes_stored"] += size
+    # Identical uploads normalize to the same blob, which may already have its pyramid
+    blob = await db.blobs.find_one({"hash": blob_hash}, {"proxies": 1})
+    if "proxies" not in blob:
+        await save_proxies(blob_hash, result)
+    return blob_hash
+
+def image_layer_size(project: dict, blob: Optional[dict]) -> Tuple[float, float]:
+    # The image's own size, scaled down to fit the canvas; images stored unchecked get a placeholder size
+    width, height = (blob or {}).get("width"), (blob or {}).get("height")
+    if not width or not height:
+        return 300, 200
+    fit = min(1.0, (project.get("width") or width) / width, (project.get("height") or height) / height)
+    return round(width * fit), round(height * fit)
+
+async def add_image_layer(project: dict, blob_hash: str, filename: str) -> Tuple[dict, int]:
+    await ensure_proxies(blob_hash)
+    width, height = image_layer_size(project, await db.blobs.find_one({"hash": blob_hash}, {"width": 1, "height": 1}))
     layer_id = str(uuid.uuid4())
     layer = {
         "id": layer_id,
-        "name": f"Image Layer - {file.filename}",
+        "name": f"Image Layer - {filename}",
         "type": "image",
         "visible": True,
         "opacity": 1.0,
         "x": 0,
         "y": 0,
-        "width": 300,  # Default width, should be adjusted based on actual image size
-        "height": 200,  # Default height
+        "width": width,
+        "height": height,
         "data": {
-            "src": f"data:image/{file.content_type.split('/')[-1]};base64,{image_base64}",
-            "filename": file.filename
+            "blob": blob_hash,
+            "src": blob_url(blob_hash),
+            "filename": filename
         },
         "z_index": len(project.get("layers", []))
     }
     
-    # Add layer to project
-    await db.projects.update_one(
-        {"id": project_id},
+    await project_states.flush(project["id"])
+    updated_at = datetime.utcnow()
+    updated = await db.projects.find_one_and_update(
+        {"id": project["id"]},
         {
             "$push": {"layers": layer},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
+            "$set": {"updated_at": updated_at},
+            "$inc": {"revision": 1}
+        },
+        projection={"revision": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    await project_states.reload(project["id"])
+    thumbnail_scheduler.schedule(project["id"])
+    await record_change(
+        project["id"], updated["revision"] - 1, updated["revision"], [{"op": "add", "layer": layer}],
+        fields={"updated_at": updated_at}, user_id=project.get("owner_id"), source="upload"
     )
     
-    return {"layer": layer, "message": "Image uploaded successfully"}
+    return layer, updated["revision"]
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Reject oversized bodies before the multipart parser spools them to disk
+    content_length = request.headers.get("content-length")
+    if request.method in ("POST", "PUT") and content_length and content_length.isdigit():
+        if int(content_length) > MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD:
+            return JSONResponse(status_code=413, content={"detail": f"File exceeds the {MAX_UPLOAD_BYTES} byte upload limit"})
+    return await call_next(request)
+
+@app.post("/api/projects/{project_id}/upload-image")
+async def upload_image(project_id: str, file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
+    # Verify project access
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    path, size = await stage_upload_file(file)
+    try:
+        blob_hash = await ingest_upload(path, size, file.content_type)
+    finally:
+        os.unlink(path)
+    layer, revision = await add_image_layer(project, blob_hash, file.filename)
+    
+    return {"layer": layer, "revision": revision, "message": "Image uploaded successfully"}
+
+# Resumable uploads: init, append parts at an explicit offset, then complete.
+# Parts are staged on local disk, so a client can resume from GET /api/uploads/{id} after a dropped connection.
+def upload_staging_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_STAGING_DIR, upload_id)
+
+upload_sweep = {"last_run": 0.0}
+
+def remove_stale_staging_files(cutoff: float):
+    try:
+        names = os.listdir(UPLOAD_STAGING_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(UPLOAD_STAGING_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+async def sweep_upload_staging():
+    # Sessions left unfinished expire from db.uploads through a TTL index; their staging files (and any left by a
+    # crash mid-upload) are removed here once untouched for as long. Runs at startup and at most hourly after that.
+    now = time.time()
+    if now - upload_sweep["last_run"] < 3600:
+        return
+    upload_sweep["last_run"] = now
+    await asyncio.to_thread(remove_stale_staging_files, now - UPLOAD_SESSION_TTL)
+
+async def get_upload_session(upload_id: str, current_user: User) -> dict:
+    upload = await db.uploads.find_one({"id": upload_id, "owner_id": current_user.id})
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+def upload_session_response(upload: dict) -> dict:
+    return {
+        "upload_id": upload["id"],
+        "project_id": upload["project_id"],
+        "filename": upload["filename"],
+        "size": upload.get("size"),
+        "offset": upload["offset"],
+        "chunk_size": UPLOAD_CHUNK_SIZE
+    }
+
+@app.post("/api/projects/{project_id}/uploads")
+async def init_upload(project_id: str, upload_data: UploadInit, current_user: User = Depends(get_current_user)):
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id}, {"_id": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    if upload_data.size is not None and upload_data.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+    # Only a hint: complete_upload decodes the file, and the blob record keeps an allowlisted type
+    declared_type = upload_data.content_type.split(";")[0].strip().lower()
+    if declared_type != "application/octet-stream" and (not declared_type.startswith("image/") or declared_type == "image/svg+xml"):
+        raise HTTPException(status_code=400, detail="Only image uploads are accepted")
+    
+    upload = {
+        "id": str(uuid.uuid4()),
+        "project_id": project_id,
+        "owner_id": current_user.id,
+        "filename": upload_data.filename,
+        "content_type": blob_content_type(declared_type),
+        "size": upload_data.size,
+        "offset": 0,
+        "created_at": datetime.utcnow()
+    }
+    
+    await sweep_upload_staging()
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    open(upload_staging_path(upload["id"]), "wb").close()
+    await db.uploads.insert_one(upload)
+    
+    return upload_session_response(upload)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    upload = await get_upload_session(upload_id, current_user)
+    return upload_session_response(upload)
+
+@app.put("/api/uploads/{upload_id}")
+async def append_upload_part(upload_id: str, offset: int, request: Request, current_user: User = Depends(get_current_user)):
+    upload = await get_upload_session(upload_id, current_user)
+    if offset != upload["offset"]:
+        raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "offset": upload["offset"]})
+    
+    # Write at the requested offset so a retried part simply overwrites a partially written one
+    written = 0
+    with open(upload_staging_path(upload_id), "r+b") as f:
+        f.seek(offset)
+        async for chunk in request.stream():
+            written += len(chunk)
+            if offset + written > MAX_UPLOAD_BYTES or (upload.get("size") is not None and offset + written > upload["size"]):
+                raise HTTPException(status_code=413, detail="Upload exceeds its declared size or the upload limit")
+            await asyncio.to_thread(f.write, chunk)
+    
+    result = await db.uploads.update_one(
+        {"id": upload_id, "offset": offset},
+        {"$set": {"offset": offset + written}}
+    )
+    if result.modified_count == 0 and written:
+        current = await get_upload_session(upload_id, current_user)
+        raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "offset": current["offset"]})
+    
+    return {"upload_id": upload_id, "offset": offset + written}
+
+async def iter_staged_upload(path: str, length: int):
+    with open(path, "rb") as f:
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    upload = await get_upload_session(upload_id, current_user)
+    if upload.get("size") is not None and upload["offset"] != upload["size"]:
+        raise HTTPException(status_code=400, detail={"message": "Upload is incomplete", "offset": upload["offset"]})
+    
+    project = await db.projects.find_one({"id": upload["project_id"], "owner_id": current_user.id})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    # Claim the session before ingesting, so a repeated complete request can't ingest the same file twice
+    if not await db.uploads.find_one_and_delete({"id": upload_id, "owner_id": current_user.id, "offset": upload["offset"]}):
+        raise HTTPException(status_code=409, detail="Upload is already being completed or has changed")
+    path = upload_staging_path(upload_id)
+    try:
+        blob_hash = await ingest_upload(path, upload["offset"], upload["content_type"])
+    finally:
+        os.unlink(path)
+    layer, revision = await add_image_layer(project, blob_hash, upload["filename"])
+    
+    return {"layer": layer, "revision": revision, "message": "Image uploaded successfully"}
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    await get_upload_session(upload_id, current_user)
+    await db.uploads.delete_one({"id": upload_id})
+    path = upload_staging_path(upload_id)
+    if os.path.exists(path):
+        os.unlink(path)
+    
+    return {"message": "Upload aborted"}
+
+@app.get("/api/blobs/{blob_hash}")
+async def get_blob(blob_hash: str, request: Request):
+    if not is_blob_hash(blob_hash):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    blob = await db.blobs.find_one({"hash": blob_hash})
+    if not blob:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    # Content never changes for a given hash, so the hash itself is a strong ETag
+    etag = f'"{blob_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "X-Content-Type-Options": "nosniff"
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    # Records written before types were checked may hold any declared type
+    media_type = blob_content_type(blob.get("content_type"))
+    if media_type not in INLINE_BLOB_TYPES:
+        headers["Content-Disposition"] = "attachment"
+    headers["Content-Length"] = str(blob["size"])
+    return StreamingResponse(blob_store.iter_chunks(blob_hash), media_type=media_type, headers=headers)
 
 @app.post("/api/chat")
 async def chat_with_assistant(chat_data: ChatMessage):
@@ -376,42 +1342,288 @@ async def get_chat_history(session_id: str, limit: int = 50):
     return {"messages": messages[::-1]}  # Reverse to get chronological order
 
 @app.websocket("/api/ws/collaborate/{project_id}")
-async def websocket_collaboration(websocket: WebSocket, project_id: str):
-    await manager.connect(websocket, project_id)
+async def websocket_collaboration(websocket: WebSocket, project_id: str, token: Optional[str] = None):
+    connection = await manager.connect(websocket, project_id)
+    # Only the project's owner (authenticated with ?token=) may edit through the socket; anyone else just relays
+    user, session = None, None
+    if token:
+        try:
+            user = await user_from_token(token)
+        except HTTPException:
+            user = None
+    if user is not None:
+        session = await project_states.attach(project_id)
+        if session is not None and session.project.get("owner_id") != user.id:
+            project_states.detach(project_id)
+            session = None
+    
     try:
         while True:
-            data = await websocket.receive_json()
-            # Broadcast collaboration message to all users in the project
-            await manager.broadcast_to_project(project_id, data)
+            data = await manager.receive(connection)
+            if isinstance(data, dict) and data.get("type") == "ops":
+                await apply_socket_ops(connection, project_id, session, user, data)
+            else:
+                # Relayed to everyone else in the project; cursor-style messages are rate limited per sender
+                await manager.handle_message(connection, project_id, data)
     except WebSocketDisconnect:
-        manager.disconnect(websocket, project_id)
+        pass
+    finally:
+        if session is not None:
+            project_states.detach(project_id)
+        await manager.disconnect(websocket, project_id)
+
+async def apply_socket_ops(connection, project_id: str, session, user: Optional[User], message: dict):
+    # {"type": "ops", "ops": [...], "ref": <client tag echoed in the reply>}; same ops as PATCH /layers
+    ref = message.get("ref")
+    if session is None:
+        manager.send_to(connection, {"type": "ops_error", "ref": ref, "detail": "Not authorized to edit this project"})
+        return
+    try:
+        # Socket frames skip FastAPI's body validation, so they go through the same model as PATCH /layers
+        patch = LayerPatch(ops=message.get("ops") or [])
+        ops = validate_layer_ops(patch.ops)
+        revision = await project_states.apply(session, ops)
+    except (ValueError, ValidationError) as e:
+        manager.send_to(connection, {"type": "ops_error", "ref": ref, "detail": str(e), "revision": session.revision})
+        return
+    layer_index.apply(project_id, revision - 1, revision, ops)
+    
+    manager.send_to(connection, {"type": "ops_ack", "ref": ref, "revision": revision})
+    await manager.broadcast_to_project(project_id, {
+        "type": "layers_patch",
+        "data": {"changes": lightweight_changes(summarize_changes(ops)), "updated_at": session.project["updated_at"], "revision": revision},
+        "user_id": user.id
+    }, sender_id=connection.id)
 
 # Image processing endpoints
+async def ensure_layer_blob(layer: dict) -> str:
+    data = layer.get("data") or {}
+    if data.get("source_blob") or data.get("blob"):
+        return data.get("source_blob") or data["blob"]
+    # Older layers keep their image inline; move it into the blob store so results can be keyed by hash
+    src = data.get("src") or ""
+    if not src.startswith("data:") or "," not in src:
+        raise HTTPException(status_code=400, detail="Layer has no image data")
+    header, encoded = src.split(",", 1)
+    contents = base64.b64decode(encoded)
+    blob_hash = await blob_store.put(contents)
+    await register_blob(blob_hash, len(contents), header[len("data:"):].split(";")[0])
+    return blob_hash
+
+async def apply_layer_filter_chain(project_id: str, layer_id: str, steps: List[dict], replace: bool, current_user: User) -> dict:
+    await project_states.flush(project_id)
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    layer = next((layer for layer in project.get("layers", []) if layer.get("id") == layer_id), None)
+    if layer is None or layer.get("type") != "image":
+        raise HTTPException(status_code=404, detail="Image layer not found")
+    
+    try:
+        new_steps = normalize_chain(steps)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Filters are always applied to the original upload, so the stored chain fully describes the result
+    source_hash = await ensure_layer_blob(layer)
+    chain = new_steps if replace else (layer.get("data") or {}).get("filters", []) + new_steps
+    
+    cached = True
+    if not chain:
+        result_hash = source_hash
+    else:
+        key = chain_key(source_hash, chain)
+        entry = await db.filter_cache.find_one({"key": key})
+        if entry:
+            result_hash = entry["result"]
+        else:
+            cached = False
+            encoded, content_type = await run_image_job(image_jobs.filter_chain, source_hash, chain, INGEST_QUALITY)
+            result_hash = await blob_store.put(encoded)
+            await register_blob(result_hash, len(encoded), content_type)
+            await db.filter_cache.update_one(
+                {"key": key},
+                {"$setOnInsert": {"key": key, "source": source_hash, "chain": chain, "result": result_hash, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+    
+    await ensure_proxies(result_hash)
+    fields = {
+        "data.blob": result_hash,
+        "data.src": blob_url(result_hash),
+        "data.source_blob": source_hash,
+        "data.filters": chain
+    }
+    updated_at = datetime.utcnow()
+    updated = await db.projects.find_one_and_update(
+        {"id": project_id},
+        {
+            "$set": {**{f"layers.$[layer].{name}": value for name, value in fields.items()}, "updated_at": updated_at},
+            "$inc": {"revision": 1}
+        },
+        projection={"revision": 1},
+        array_filters=[{"layer.id": layer_id}],
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    await project_states.reload(project_id)
+    thumbnail_scheduler.schedule(project_id)
+    await record_change(
+        project_id, updated["revision"] - 1, updated["revision"], [{"op": "update", "id": layer_id, "fields": fields}],
+        fields={"updated_at": updated_at}, user_id=current_user.id, source="filter"
+    )
+    
+    return {
+        "layer_id": layer_id,
+        "blob": result_hash,
+        "src": blob_url(result_hash),
+        "filters": chain,
+        "cached": cached,
+        "revision": updated["revision"]
+    }
+
+@app.post("/api/projects/{project_id}/layers/{layer_id}/filters")
+async def apply_layer_filters(project_id: str, layer_id: str, filter_data: FilterChainRequest, current_user: User = Depends(get_current_user)):
+    steps = [step.dict() for step in filter_data.filters]
+    return await apply_layer_filter_chain(project_id, layer_id, steps, filter_data.replace, current_user)
+
 @app.post("/api/projects/{project_id}/filters/blur")
 async def apply_blur_filter(project_id: str, layer_id: str, blur_amount: float = 5.0, current_user: User = Depends(get_current_user)):
-    # Placeholder for blur filter implementation
-    # In a real implementation, you would process the layer's image data
-    return {"message": f"Blur filter applied to layer {layer_id} with amount {blur_amount}"}
+    result = await apply_layer_filter_chain(project_id, layer_id, [{"op": "blur", "params": {"radius": blur_amount}}], False, current_user)
+    return {**result, "message": f"Blur filter applied to layer {layer_id} with amount {blur_amount}"}
 
 @app.post("/api/projects/{project_id}/filters/brightness")
 async def apply_brightness_filter(project_id: str, layer_id: str, brightness: float = 1.2, current_user: User = Depends(get_current_user)):
-    # Placeholder for brightness filter implementation
-    return {"message": f"Brightness filter applied to layer {layer_id} with value {brightness}"}
+    result = await apply_layer_filter_chain(project_id, layer_id, [{"op": "brightness", "params": {"factor": brightness}}], False, current_user)
+    return {**result, "message": f"Brightness filter applied to layer {layer_id} with value {brightness}"}
 
 @app.post("/api/projects/{project_id}/export")
-async def export_project(project_id: str, format: str = "png", current_user: User = Depends(get_current_user)):
+async def export_project(project_id: str, format: str = "png", quality: int = 90, lossless: bool = False, scale: float = 1.0, tiled: bool = False, current_user: User = Depends(get_current_user)):
+    deep_zoom = format.lower() == "dzi"
+    image_format = "PNG" if deep_zoom else EXPORT_FORMATS.get(format.lower())
+    if image_format is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {format}")
+    if not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="Quality must be between 1 and 100")
+    if not 0 < scale <= 4:
+        raise HTTPException(status_code=400, detail="Scale must be greater than 0 and at most 4")
+    
+    # Socket edits may still be buffered in the project state store; render what collaborators see
+    await project_states.flush(project_id)
     project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
-    # In a real implementation, you would render all layers into a single image
-    # For now, return project data that can be processed on the frontend
-    return {
-        "project": project,
-        "export_format": format,
-        "message": "Project data ready for export"
-    }
+    filename = re.sub(r"[^A-Za-z0-9._-]+", "_", project["name"]).strip("_") or "export"
+    width, height = canvas_size(project, scale)
+    
+    if deep_zoom or tiled or width * height > RENDER_MAX_PIXELS:
+        if not deep_zoom and image_format != "PNG":
+            raise HTTPException(status_code=400, detail="Canvas is too large to encode in one piece; export as png or dzi")
+        # Streaming exports must be admitted up front; their later jobs queue for a slot instead of failing mid-stream
+        if image_pool.pending >= image_pool.max_pending:
+            raise HTTPException(status_code=503, detail="Image processing is busy, please retry shortly", headers={"Retry-After": "1"})
+    
+    if deep_zoom:
+        # Whole tile pyramid as a zip, rendered in batches of tiles and streamed as they finish
+        return StreamingResponse(
+            stream_deep_zoom_zip(project, quality),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}-dzi.zip"'}
+        )
+    
+    if tiled or width * height > RENDER_MAX_PIXELS:
+        # Rendered in horizontal strips, so memory stays proportional to the strip rather than the canvas
+        return StreamingResponse(
+            stream_png_strips(project, scale),
+            media_type="image/png",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.png"'}
+        )
+    
+    encoded = await run_image_job(image_jobs.export_image, project, image_format, quality, lossless, scale)
+    
+    extension = "jpg" if image_format == "JPEG" else image_format.lower()
+    return StreamingResponse(
+        iter_bytes(encoded),
+        media_type=MEDIA_TYPES[image_format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.{extension}"',
+            "Content-Length": str(len(encoded))
+        }
+    )
+
+async def stream_png_strips(project: dict, scale: float):
+    width, height = canvas_size(project, scale)
+    encoder = PngStripEncoder(width, height)
+    yield encoder.header()
+    for region in iter_strip_regions(project, scale):
+        scanlines = await run_image_job(image_jobs.png_scanlines, project, region, scale, wait=True)
+        yield await asyncio.to_thread(encoder.encode, scanlines)
+    yield encoder.finish()
+
+async def stream_deep_zoom_zip(project: dict, quality: int, batch_size: int = 16):
+    writer = DeepZoomZipWriter(project)
+    # Tile coordinates are generated as batches are sent; a large canvas has tens of thousands of them
+    tiles = iter_deep_zoom_tiles(project)
+    while True:
+        batch = list(itertools.islice(tiles, batch_size))
+        if not batch:
+            break
+        encoded = await run_image_job(image_jobs.deep_zoom_tiles, project, batch, "PNG", quality, wait=True)
+        for (level, col, row), data in zip(batch, encoded):
+            yield writer.add_tile(level, col, row, data)
+    yield writer.finish()
+
+@app.get("/api/projects/{project_id}/tiles.dzi")
+async def get_deep_zoom_descriptor(project_id: str, current_user: User = Depends(get_current_user)):
+    await project_states.flush(project_id)
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id}, {"width": 1, "height": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    return Response(content=deep_zoom_descriptor(project), media_type="application/xml")
+
+@app.get("/api/projects/{project_id}/tiles_files/{level}/{tile}.png")
+async def get_deep_zoom_tile(project_id: str, level: int, tile: str, current_user: User = Depends(get_current_user)):
+    await project_states.flush(project_id)
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    match = re.fullmatch(r"(\d+)_(\d+)", tile)
+    if not match or not 0 <= level < deep_zoom_levels(project):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    encoded = await run_image_job(image_jobs.deep_zoom_tile, project, level, int(match.group(1)), int(match.group(2)))
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    return Response(content=encoded, media_type="image/png", headers={"Cache-Control": "private, no-cache"})
+
+@app.get("/api/projects/{project_id}/thumbnail")
+async def get_project_thumbnail(project_id: str, size: int = THUMBNAIL_SIZES[0], current_user: User = Depends(get_current_user)):
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"Size must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
+    
+    project = await db.projects.find_one({"id": project_id, "owner_id": current_user.id}, {"thumbnails": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    blob_hash = (project.get("thumbnails") or {}).get(str(size))
+    if not blob_hash:
+        # Projects saved before thumbnails existed get one on first request
+        thumbnail_scheduler.schedule(project_id)
+        raise HTTPException(status_code=404, detail="Thumbnail not generated yet")
+    
+    # The redirect itself must be revalidated; the blob it points to is immutable and cached for a year
+    return RedirectResponse(blob_url(blob_hash), status_code=307, headers={"Cache-Control": "private, no-cache"})
+
+def iter_bytes(data: bytes, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8001, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
\ No newline at end of file
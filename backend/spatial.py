@@ -0,0 +1,163 @@
+# Spatial index of a project's layers, for viewport queries.
+#
+# A uniform grid over canvas coordinates: each layer's bounding box is registered in every cell it
+# touches, so a viewport query only looks at the layers in the cells it covers. Layers spanning more
+# than `max_cells` cells (backgrounds, huge images) are kept in a short list checked on every query.
+#
+# Indexes live in the worker's memory, one per project and tagged with the revision they describe.
+# Writes update them in place from the same layer ops the history records; anything that can't be
+# applied that way (a reorder, a revision gap) drops the index and the next query rebuilds it.
+import math
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from cache import TTLCache
+
+Box = Tuple[float, float, float, float]  # left, top, right, bottom
+GEOMETRY_FIELDS = ("x", "y", "width", "height")
+
+
+def layer_box(layer: dict) -> Box:
+    x, y = layer.get("x") or 0, layer.get("y") or 0
+    return x, y, x + max(layer.get("width") or 0, 0), y + max(layer.get("height") or 0, 0)
+
+
+def boxes_intersect(a: Box, b: Box) -> bool:
+    # Inclusive, so zero-sized layers (text without a measured size) are found at their anchor point
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class LayerGrid:
+    def __init__(self, revision: int, layers: Iterable[dict], cell_size: float = 512, max_cells: int = 256):
+        self.revision = revision
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self._boxes: Dict[str, Box] = {}
+        self._order: Dict[str, Tuple[int, int]] = {}  # (z_index, position in the layers array)
+        self._cells: Dict[Tuple[int, int], Set[str]] = {}
+        self._oversized: Set[str] = set()
+        self._next_position = 0
+        for layer in layers:
+            self._insert(layer)
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def _cell_range(self, box: Box):
+        size = self.cell_size
+        return (math.floor(box[0] / size), math.floor(box[1] / size),
+                math.floor(box[2] / size), math.floor(box[3] / size))
+
+    def _insert(self, layer: dict, position: Optional[int] = None):
+        layer_id = layer.get("id")
+        box = layer_box(layer)
+        self._boxes[layer_id] = box
+        if position is None:
+            position = self._next_position
+            self._next_position += 1
+        self._order[layer_id] = (layer.get("z_index") or 0, position)
+        left, top, right, bottom = self._cell_range(box)
+        if (right - left + 1) * (bottom - top + 1) > self.max_cells:
+            self._oversized.add(layer_id)
+            return
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                self._cells.setdefault((cx, cy), set()).add(layer_id)
+
+    def _remove(self, layer_id: str):
+        box = self._boxes.pop(layer_id)
+        if layer_id in self._oversized:
+            self._oversized.discard(layer_id)
+            return
+        left, top, right, bottom = self._cell_range(box)
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                cell = self._cells.get((cx, cy))
+                if cell is not None:
+                    cell.discard(layer_id)
+                    if not cell:
+                        del self._cells[(cx, cy)]
+
+    def apply(self, ops: List[dict]) -> bool:
+        """Updates the index for normalized layer ops; False if they don't match what it holds."""
+        for op in ops:
+            if op["op"] == "add":
+                if op["layer"].get("id") in self._boxes:
+                    return False
+                self._insert(op["layer"])
+                continue
+            layer_id = op["id"]
+            if layer_id not in self._boxes:
+                return False
+            if op["op"] == "delete":
+                self._remove(layer_id)
+                del self._order[layer_id]
+                continue
+            fields = op["fields"]
+            if "z_index" in fields:
+                self._order[layer_id] = (fields["z_index"], self._order[layer_id][1])
+            if any(name in fields for name in GEOMETRY_FIELDS):
+                left, top, right, bottom = self._boxes[layer_id]
+                layer = {"id": layer_id, "x": left, "y": top, "width": right - left, "height": bottom - top, **fields}
+                layer = {name: layer[name] for name in ("id", *GEOMETRY_FIELDS)}
+                layer["z_index"] = self._order[layer_id][0]
+                position = self._order[layer_id][1]
+                self._remove(layer_id)
+                self._insert(layer, position)
+        return True
+
+    def query(self, box: Box) -> List[str]:
+        """Ids of the layers intersecting `box`, bottom-most first (by z_index, then array order)."""
+        left, top, right, bottom = self._cell_range(box)
+        candidates = set(self._oversized)
+        if (right - left + 1) * (bottom - top + 1) > len(self._cells):
+            # A viewport larger than the occupied area: walking the occupied cells is cheaper
+            for (cx, cy), cell in self._cells.items():
+                if left <= cx <= right and top <= cy <= bottom:
+                    candidates |= cell
+        else:
+            for cx in range(left, right + 1):
+                for cy in range(top, bottom + 1):
+                    candidates |= self._cells.get((cx, cy), set())
+        hits = [layer_id for layer_id in candidates if boxes_intersect(self._boxes[layer_id], box)]
+        return sorted(hits, key=self._order.__getitem__)
+
+
+class LayerIndexCache:
+    def __init__(self, cell_size: float = 512, maxsize: int = 256, ttl: float = 3600):
+        self.cell_size = cell_size
+        self._grids = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.builds = 0
+        self.incremental_updates = 0
+
+    def get(self, project_id: str, revision: Optional[int] = None) -> Optional[LayerGrid]:
+        grid = self._grids.get(project_id)
+        if grid is not None and revision is not None and grid.revision != revision:
+            return None
+        return grid
+
+    def build(self, project_id: str, revision: int, layers: Iterable[dict]) -> LayerGrid:
+        grid = LayerGrid(revision, layers, self.cell_size)
+        self._grids.set(project_id, grid)
+        self.builds += 1
+        return grid
+
+    def apply(self, project_id: str, base_revision: int, revision: int, ops: List[dict], reordered: bool = False):
+        grid = self._grids.get(project_id)
+        if grid is None or grid.revision == revision:
+            # Not indexed, or already updated (live edits are indexed before their write-behind flush)
+            return
+        if grid.revision != base_revision or reordered or not grid.apply(ops):
+            self.invalidate(project_id)
+            return
+        grid.revision = revision
+        self.incremental_updates += 1
+
+    def invalidate(self, project_id: str):
+        self._grids.invalidate(project_id)
+
+    def stats(self) -> dict:
+        return {
+            **self._grids.stats(),
+            "builds": self.builds,
+            "incremental_updates": self.incremental_updates
+        }
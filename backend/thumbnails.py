@@ -0,0 +1,88 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailScheduler:
+    """Runs `generate(project_id)` in the background once a project has stopped changing.
+
+    Every schedule() call restarts the project's `delay` timer, but a project that keeps changing is
+    still rendered at least every `max_delay` seconds. Saves arriving while a render is running mark
+    the project dirty, and it is rendered once more afterwards, so at most one render per project is
+    in flight and a burst of saves collapses into a single render.
+    """
+
+    def __init__(self, generate: Callable[[str], Awaitable], delay: float, max_delay: float):
+        self._generate = generate
+        self.delay = delay
+        self.max_delay = max_delay
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._first_scheduled: Dict[str, float] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self._dirty: Set[str] = set()
+        self.scheduled = 0
+        self.coalesced = 0
+        self.generated = 0
+        self.failed = 0
+        self.errors: Dict[str, int] = {}
+
+    def schedule(self, project_id: str):
+        self.scheduled += 1
+        timer = self._timers.pop(project_id, None)
+        if timer is not None:
+            timer.cancel()
+            self.coalesced += 1
+
+        now = time.monotonic()
+        first = self._first_scheduled.setdefault(project_id, now)
+        delay = max(0.0, min(self.delay, first + self.max_delay - now))
+        self._timers[project_id] = asyncio.get_running_loop().call_later(delay, self._start, project_id)
+
+    def _start(self, project_id: str):
+        self._timers.pop(project_id, None)
+        self._first_scheduled.pop(project_id, None)
+        if project_id in self._running:
+            self._dirty.add(project_id)
+            return
+        self._running[project_id] = asyncio.ensure_future(self._run(project_id))
+
+    async def _run(self, project_id: str):
+        try:
+            await self._generate(project_id)
+            self.generated += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            # Metrics are public, so they only count failures by exception class; the details go to the log
+            name = type(e).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+            logger.warning("Thumbnails of %s could not be rendered", project_id, exc_info=True)
+        finally:
+            del self._running[project_id]
+            if project_id in self._dirty:
+                self._dirty.discard(project_id)
+                self._start(project_id)
+
+    def shutdown(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        for task in self._running.values():
+            task.cancel()
+        self._timers.clear()
+        self._first_scheduled.clear()
+        self._dirty.clear()
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": self.scheduled,
+            "coalesced": self.coalesced,
+            "pending": len(self._timers),
+            "running": len(self._running),
+            "generated": self.generated,
+            "failed": self.failed,
+            "errors": dict(self.errors)
+        }
@@ -39,6 +39,7 @@ TEST_PROJECT_DATA = {
 auth_token = None
 user_id = None
 project_id = None
+uploaded_layer = None
 
 def print_test_result(test_name, success, details=""):
     """Print formatted test results"""
@@ -348,9 +349,187 @@ def test_update_project():
         print_test_result("Update project", False, f"Exception: {str(e)}")
         return False
 
+def test_revision_conflict():
+    """Test that a save based on a stale revision is rejected"""
+    print("🔍 Testing Revision Conflict...")
+    
+    if not auth_token or not project_id:
+        print_test_result("Revision conflict", False, "No auth token or project ID available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        project = requests.get(f"{API_BASE}/projects/{project_id}", headers=headers, timeout=10).json()
+        revision = project.get("revision", 0)
+        
+        first = requests.put(
+            f"{API_BASE}/projects/{project_id}",
+            json={"background_color": "#222222", "revision": revision},
+            headers=headers,
+            timeout=10
+        )
+        stale = requests.put(
+            f"{API_BASE}/projects/{project_id}",
+            json={"background_color": "#333333", "revision": revision},
+            headers=headers,
+            timeout=10
+        )
+        
+        success = first.status_code == 200 and stale.status_code == 409
+        
+        if success:
+            current = stale.json()["detail"]["revision"]
+            success = current == first.json()["revision"] == revision + 1
+            details = f"Stale save rejected, current revision {current}"
+        else:
+            details = f"HTTP {first.status_code} then {stale.status_code}: {stale.text}"
+            
+        print_test_result("Revision conflict", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Revision conflict", False, f"Exception: {str(e)}")
+        return False
+
+def test_undo():
+    """Test that undo restores the previous revision as a new one"""
+    print("🔍 Testing Undo...")
+    
+    if not auth_token or not project_id:
+        print_test_result("Undo", False, "No auth token or project ID available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        project = requests.get(f"{API_BASE}/projects/{project_id}", headers=headers, timeout=10).json()
+        saved = requests.put(
+            f"{API_BASE}/projects/{project_id}",
+            json={"background_color": "#444444", "revision": project["revision"]},
+            headers=headers,
+            timeout=10
+        )
+        undone = requests.post(f"{API_BASE}/projects/{project_id}/undo", headers=headers, timeout=10)
+        
+        success = saved.status_code == 200 and undone.status_code == 200
+        
+        if success:
+            data = undone.json()
+            success = data["background_color"] == project["background_color"] and data["revision"] == project["revision"] + 2
+            details = f"Back to {data['background_color']} at revision {data['revision']}"
+        else:
+            details = f"HTTP {saved.status_code} then {undone.status_code}: {undone.text}"
+            
+        print_test_result("Undo", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Undo", False, f"Exception: {str(e)}")
+        return False
+
+def test_patch_layers():
+    """Test that a layer patch applies every op as one revision, or none of them"""
+    print("🔍 Testing Layer Patch...")
+    
+    if not auth_token or not project_id:
+        print_test_result("Layer patch", False, "No auth token or project ID available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        url = f"{API_BASE}/projects/{project_id}/layers"
+        first, second, third = (f"layer_{uuid.uuid4().hex[:8]}" for _ in range(3))
+        
+        def shape(layer_id):
+            return {"id": layer_id, "name": layer_id, "type": "shape", "x": 0, "y": 0, "width": 10, "height": 10, "data": {"fill": "#ff0000"}}
+        
+        added = requests.patch(url, json={"ops": [{"op": "add", "layer": shape(first)}, {"op": "add", "layer": shape(second)}]}, headers=headers, timeout=10)
+        revision = added.json()["revision"]
+        combined = requests.patch(
+            url,
+            json={"ops": [{"op": "move", "id": first, "x": 5, "y": 6}, {"op": "add", "layer": shape(third)}, {"op": "delete", "id": second}], "revision": revision},
+            headers=headers,
+            timeout=10
+        )
+        missing = requests.patch(
+            url,
+            json={"ops": [{"op": "move", "id": first, "x": 1, "y": 1}, {"op": "delete", "id": "no_such_layer"}]},
+            headers=headers,
+            timeout=10
+        )
+        stale = requests.patch(url, json={"ops": [{"op": "move", "id": first, "x": 1, "y": 1}], "revision": revision}, headers=headers, timeout=10)
+        
+        success = added.status_code == 200 and combined.status_code == 200 and missing.status_code == 404 and stale.status_code == 409
+        
+        if success:
+            project = requests.get(f"{API_BASE}/projects/{project_id}", headers=headers, timeout=10).json()
+            layers = {layer["id"]: layer for layer in project["layers"]}
+            # The rejected patches left nothing behind: the move in the 404 batch was not applied either
+            success = (
+                combined.json()["revision"] == revision + 1
+                and project["revision"] == revision + 1
+                and stale.json()["detail"]["revision"] == revision + 1
+                and (layers[first]["x"], layers[first]["y"]) == (5, 6)
+                and third in layers and second not in layers
+            )
+            details = f"Move, add and delete stored as revision {project['revision']}; missing layer HTTP 404, stale revision HTTP 409"
+        else:
+            details = f"HTTP {added.status_code}, {combined.status_code}, {missing.status_code}, {stale.status_code}: {stale.text}"
+            
+        print_test_result("Layer patch", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Layer patch", False, f"Exception: {str(e)}")
+        return False
+
+def test_layers_in_viewport():
+    """Test that a bbox query returns only the layers it intersects, bottom-most first"""
+    print("🔍 Testing Viewport Layer Query...")
+    
+    if not auth_token or not project_id:
+        print_test_result("Viewport layer query", False, "No auth token or project ID available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        url = f"{API_BASE}/projects/{project_id}/layers"
+        top, bottom, outside = (f"layer_{uuid.uuid4().hex[:8]}" for _ in range(3))
+        
+        def shape(layer_id, x, y, z_index):
+            return {"id": layer_id, "name": layer_id, "type": "shape", "x": x, "y": y, "width": 100, "height": 100, "z_index": z_index, "data": {"fill": "#00ff00"}}
+        
+        # Off to the side of the canvas, so layers from the other tests stay out of the viewport
+        added = requests.patch(
+            url,
+            json={"ops": [{"op": "add", "layer": shape(top, 3000, 3000, 2)}, {"op": "add", "layer": shape(bottom, 3050, 3050, 1)}, {"op": "add", "layer": shape(outside, 3600, 3600, 0)}]},
+            headers=headers,
+            timeout=10
+        )
+        overlapping = requests.get(url, params={"bbox": "3000,3000,3200,3200"}, headers=headers, timeout=10)
+        corner = requests.get(url, params={"bbox": "3620,3620,3640,3640"}, headers=headers, timeout=10)
+        invalid = requests.get(url, params={"bbox": "3200,3200,3000"}, headers=headers, timeout=10)
+        
+        success = added.status_code == 200 and overlapping.status_code == 200 and corner.status_code == 200 and invalid.status_code == 400
+        
+        if success:
+            ids = [layer["id"] for layer in overlapping.json()["layers"]]
+            corner_ids = [layer["id"] for layer in corner.json()["layers"]]
+            success = ids == [bottom, top] and corner_ids == [outside] and overlapping.json()["revision"] == added.json()["revision"]
+            details = f"Viewport returned {len(ids)} layers by z_index, corner returned {len(corner_ids)}"
+        else:
+            details = f"HTTP {added.status_code}, {overlapping.status_code}, {corner.status_code}, {invalid.status_code}: {overlapping.text}"
+            
+        print_test_result("Viewport layer query", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Viewport layer query", False, f"Exception: {str(e)}")
+        return False
+
 def test_image_upload():
     """Test image upload to project"""
     print("🔍 Testing Image Upload...")
+    global uploaded_layer
     
     if not auth_token or not project_id:
         print_test_result("Image upload", False, "No auth token or project ID available")
@@ -378,7 +557,10 @@ def test_image_upload():
             data = response.json()
             if "layer" in data and "message" in data:
                 layer = data["layer"]
-                details = f"Image uploaded as layer: {layer.get('name', 'Unknown')}"
+                uploaded_layer = layer
+                # The layer takes the image's real size rather than a placeholder
+                success = (layer.get("width"), layer.get("height")) == (200, 200)
+                details = f"Image uploaded as layer: {layer.get('name', 'Unknown')} ({layer.get('width')}x{layer.get('height')})"
             else:
                 success = False
                 details = "Invalid response format"
@@ -392,6 +574,125 @@ def test_image_upload():
         print_test_result("Image upload", False, f"Exception: {str(e)}")
         return False
 
+def test_resumable_upload():
+    """Test a resumable upload: init, append a part, resume from the committed offset, complete"""
+    print("🔍 Testing Resumable Upload...")
+    
+    if not auth_token or not project_id:
+        print_test_result("Resumable upload", False, "No auth token or project ID available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        data = create_test_image().getvalue()
+        half = len(data) // 2
+        
+        init = requests.post(
+            f"{API_BASE}/projects/{project_id}/uploads",
+            json={"filename": "resumed.png", "content_type": "image/png", "size": len(data)},
+            headers=headers,
+            timeout=10
+        )
+        if init.status_code != 200:
+            print_test_result("Resumable upload", False, f"HTTP {init.status_code}: {init.text}")
+            return False
+        upload_url = f"{API_BASE}/uploads/{init.json()['upload_id']}"
+        
+        first = requests.put(f"{upload_url}?offset=0", data=data[:half], headers=headers, timeout=10)
+        # A client that lost the response resends the same part and is told where the upload really is
+        repeated = requests.put(f"{upload_url}?offset=0", data=data[:half], headers=headers, timeout=10)
+        offset = requests.get(upload_url, headers=headers, timeout=10).json()["offset"]
+        rest = requests.put(f"{upload_url}?offset={offset}", data=data[offset:], headers=headers, timeout=10)
+        complete = requests.post(f"{upload_url}/complete", headers=headers, timeout=15)
+        
+        success = first.status_code == 200 and repeated.status_code == 409 and offset == half and rest.status_code == 200 and complete.status_code == 200
+        
+        if success:
+            layer = complete.json()["layer"]
+            gone = requests.get(upload_url, headers=headers, timeout=10)
+            success = (layer.get("width"), layer.get("height")) == (200, 200) and gone.status_code == 404
+            details = f"Resumed at offset {offset} of {len(data)}, layer {layer.get('width')}x{layer.get('height')}, session closed"
+        else:
+            details = f"HTTP {first.status_code}, {repeated.status_code}, {rest.status_code}, {complete.status_code}: {complete.text}"
+            
+        print_test_result("Resumable upload", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Resumable upload", False, f"Exception: {str(e)}")
+        return False
+
+def test_blob_download():
+    """Test fetching an uploaded image by content hash"""
+    print("🔍 Testing Blob Download...")
+    
+    if not uploaded_layer:
+        print_test_result("Blob download", False, "No uploaded layer available")
+        return False
+    
+    try:
+        blob_hash = uploaded_layer["data"].get("blob")
+        response = requests.get(f"{API_BASE}/blobs/{blob_hash}", timeout=10)
+        
+        success = response.status_code == 200 and response.headers.get("ETag") == f'"{blob_hash}"'
+        
+        if success:
+            # A conditional request with the same ETag should not resend the body
+            cached = requests.get(
+                f"{API_BASE}/blobs/{blob_hash}",
+                headers={"If-None-Match": response.headers["ETag"]},
+                timeout=10
+            )
+            success = cached.status_code == 304
+            details = f"Blob served ({len(response.content)} bytes), revalidation HTTP {cached.status_code}"
+        else:
+            details = f"HTTP {response.status_code}: {response.text[:200]}"
+            
+        print_test_result("Blob download", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Blob download", False, f"Exception: {str(e)}")
+        return False
+
+def test_apply_filters():
+    """Test applying a blur + brightness filter chain to the uploaded image layer"""
+    print("🔍 Testing Layer Filters...")
+    
+    if not auth_token or not project_id or not uploaded_layer:
+        print_test_result("Layer filters", False, "No auth token, project ID or uploaded layer available")
+        return False
+    
+    try:
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        filter_data = {
+            "filters": [
+                {"op": "blur", "params": {"radius": 2}},
+                {"op": "brightness", "params": {"factor": 1.3}}
+            ],
+            "replace": True
+        }
+        url = f"{API_BASE}/projects/{project_id}/layers/{uploaded_layer['id']}/filters"
+        
+        response = requests.post(url, json=filter_data, headers=headers, timeout=15)
+        success = response.status_code == 200
+        
+        if success:
+            # Re-applying the same chain must be served from the filter cache
+            repeat = requests.post(url, json=filter_data, headers=headers, timeout=15)
+            data = repeat.json()
+            success = repeat.status_code == 200 and data.get("cached") is True and len(data.get("filters", [])) == 2
+            details = f"Filtered blob: {data.get('blob', '')[:12]}..., cached on repeat: {data.get('cached')}"
+        else:
+            details = f"HTTP {response.status_code}: {response.text}"
+            
+        print_test_result("Layer filters", success, details)
+        return success
+        
+    except Exception as e:
+        print_test_result("Layer filters", False, f"Exception: {str(e)}")
+        return False
+
 def test_ai_chat():
     """Test AI chat integration (expecting configuration error)"""
     print("🔍 Testing AI Chat Integration...")
@@ -541,7 +842,14 @@ def run_all_tests():
     test_results["get_projects"] = test_get_projects()
     test_results["get_single_project"] = test_get_single_project()
     test_results["update_project"] = test_update_project()
+    test_results["revision_conflict"] = test_revision_conflict()
+    test_results["undo"] = test_undo()
+    test_results["patch_layers"] = test_patch_layers()
+    test_results["layers_in_viewport"] = test_layers_in_viewport()
     test_results["image_upload"] = test_image_upload()
+    test_results["resumable_upload"] = test_resumable_upload()
+    test_results["blob_download"] = test_blob_download()
+    test_results["apply_filters"] = test_apply_filters()
     test_results["ai_chat"] = test_ai_chat()
     
     # Security tests
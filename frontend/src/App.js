@@ -4,6 +4,9 @@ import './App.css';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
+// Layer image sources are either inline data URLs (older projects) or API paths like /api/blobs/<hash>
+const resolveAssetUrl = (src) => (src && src.startsWith('/') ? `${API_BASE_URL}${src}` : src);
+
 function App() {
   // Authentication state
   const [user, setUser] = useState(null);
@@ -12,7 +15,10 @@ function App() {
   
   // Project state
   const [projects, setProjects] = useState([]);
+  const [projectsCursor, setProjectsCursor] = useState(null);
   const [currentProject, setCurrentProject] = useState(null);
+  // Revision the editor's copy of the project is based on; sent with every write so stale saves are rejected
+  const revisionRef = useRef(0);
   const [showNewProjectModal, setShowNewProjectModal] = useState(false);
   const [newProjectForm, setNewProjectForm] = useState({ name: '', width: 1920, height: 1080 });
   
@@ -122,6 +128,7 @@ function App() {
     localStorage.removeItem('token');
     setUser(null);
     setProjects([]);
+    setProjectsCursor(null);
     setCurrentProject(null);
     if (ws) {
       ws.close();
@@ -130,16 +137,19 @@ function App() {
   };
 
   // Project functions
-  const loadProjects = async () => {
+  const loadProjects = async (cursor = null) => {
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`${API_BASE_URL}/api/projects`, {
+      // The picker only needs summaries; full projects are fetched when one is opened
+      const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await fetch(`${API_BASE_URL}/api/projects/summary${query}`, {
         headers: { 'Authorization': `Bearer ${token}` }
       });
       
       if (response.ok) {
-        const projectData = await response.json();
-        setProjects(projectData);
+        const page = await response.json();
+        setProjects(cursor ? [...projects, ...page.projects] : page.projects);
+        setProjectsCursor(page.next_cursor);
       }
     } catch (error) {
       console.error('Error loading projects:', error);
@@ -162,7 +172,7 @@ function App() {
       
       if (response.ok) {
         const project = await response.json();
-        setProjects([...projects, project]);
+        setProjects([project, ...projects]);
         setShowNewProjectModal(false);
         setNewProjectForm({ name: '', width: 1920, height: 1080 });
         openProject(project);
@@ -174,6 +184,7 @@ function App() {
 
   const openProject = async (project) => {
     setCurrentProject(project);
+    revisionRef.current = project.revision || 0;
     
     if (canvas) {
       canvas.setWidth(project.width);
@@ -193,7 +204,9 @@ function App() {
     
     // Set up WebSocket for collaboration
     if (ws) ws.close();
-    const websocket = new WebSocket(`${API_BASE_URL.replace('http', 'ws')}/api/ws/collaborate/${project.id}`);
+    // The token lets the socket edit the project; layer changes then go over it instead of PATCH
+    const wsToken = encodeURIComponent(localStorage.getItem('token') || '');
+    const websocket = new WebSocket(`${API_BASE_URL.replace('http', 'ws')}/api/ws/collaborate/${project.id}?token=${wsToken}`);
     
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data);
@@ -208,7 +221,7 @@ function App() {
     
     switch (layer.type) {
       case 'image':
-        fabric.Image.fromURL(layer.data.src, (img) => {
+        fabric.Image.fromURL(resolveAssetUrl(layer.data.src), (img) => {
           img.set({
             left: layer.x,
             top: layer.y,
@@ -219,9 +232,13 @@ function App() {
             selectable: true
           });
           img.layerId = layer.id;
+          if (layer.data.full_src) {
+            img.fullSrc = layer.data.full_src;
+            img.proxyWidth = layer.data.proxy_width;
+          }
           canvas.add(img);
           canvas.renderAll();
-        });
+        }, { crossOrigin: 'anonymous' });
         break;
       case 'text':
         const text = new fabric.Text(layer.data.text || 'Text', {
@@ -241,48 +258,74 @@ function App() {
   const updateLayer = (fabricObject) => {
     if (!fabricObject.layerId) return;
     
-    const updatedLayers = layers.map(layer => {
-      if (layer.id === fabricObject.layerId) {
-        return {
-          ...layer,
-          x: fabricObject.left,
-          y: fabricObject.top,
-          width: fabricObject.width * fabricObject.scaleX,
-          height: fabricObject.height * fabricObject.scaleY,
-          opacity: fabricObject.opacity
-        };
-      }
-      return layer;
-    });
+    const fields = {
+      x: fabricObject.left,
+      y: fabricObject.top,
+      width: fabricObject.width * fabricObject.scaleX,
+      height: fabricObject.height * fabricObject.scaleY,
+      opacity: fabricObject.opacity
+    };
+    const updatedLayers = layers.map(layer => (
+      layer.id === fabricObject.layerId ? { ...layer, ...fields } : layer
+    ));
     
     setLayers(updatedLayers);
-    saveProject();
+    // Only the moved layer's geometry goes over the wire, not the whole project
+    patchLayers([{ op: 'update', id: fabricObject.layerId, fields }]);
   };
 
-  const saveProject = async () => {
+  const patchLayers = async (ops) => {
     if (!currentProject) return;
     
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ type: 'ops', ops }));
+      return;
+    }
+    
     try {
       const token = localStorage.getItem('token');
-      const projectData = {
-        ...currentProject,
-        layers: layers,
-        updated_at: new Date().toISOString()
-      };
-      
-      await fetch(`${API_BASE_URL}/api/projects/${currentProject.id}`, {
-        method: 'PUT',
+      const response = await fetch(`${API_BASE_URL}/api/projects/${currentProject.id}/layers`, {
+        method: 'PATCH',
         headers: {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`
         },
-        body: JSON.stringify(projectData)
+        body: JSON.stringify({ ops, revision: revisionRef.current })
+      });
+      
+      if (response.ok) {
+        const data = await response.json();
+        revisionRef.current = data.revision;
+      } else if (response.status === 409) {
+        reloadProject();
+      }
+    } catch (error) {
+      console.error('Error saving layer changes:', error);
+    }
+  };
+
+  const fetchAndOpenProject = async (projectId) => {
+    try {
+      const token = localStorage.getItem('token');
+      // Image layers come back as proxies sized for the current zoom; full resolution is fetched on zoom-in
+      const response = await fetch(`${API_BASE_URL}/api/projects/${projectId}?scale=${viewScale(zoomLevel / 100)}`, {
+        headers: { 'Authorization': `Bearer ${token}` }
       });
+      
+      if (response.ok) {
+        openProject(await response.json());
+      }
     } catch (error) {
-      console.error('Error saving project:', error);
+      console.error('Error loading project:', error);
     }
   };
 
+  const reloadProject = () => {
+    // Someone else saved first: drop local state and pick up the latest version
+    console.warn('Project was modified elsewhere, reloading');
+    fetchAndOpenProject(currentProject.id);
+  };
+
   // Tool functions
   const addTextLayer = () => {
     if (!canvas) return;
@@ -312,6 +355,7 @@ function App() {
     
     canvas.add(text);
     setLayers([...layers, newLayer]);
+    patchLayers([{ op: 'add', layer: newLayer }]);
     canvas.renderAll();
   };
 
@@ -344,6 +388,7 @@ function App() {
     
     canvas.add(rect);
     setLayers([...layers, newLayer]);
+    patchLayers([{ op: 'add', layer: newLayer }]);
     canvas.renderAll();
   };
 
@@ -375,6 +420,7 @@ function App() {
     
     canvas.add(circle);
     setLayers([...layers, newLayer]);
+    patchLayers([{ op: 'add', layer: newLayer }]);
     canvas.renderAll();
   };
 
@@ -395,6 +441,10 @@ function App() {
       
       if (response.ok) {
         const data = await response.json();
+        // Only fast-forward if nobody else wrote in between; otherwise the next save should conflict
+        if (data.revision === revisionRef.current + 1) {
+          revisionRef.current = data.revision;
+        }
         setLayers([...layers, data.layer]);
         loadLayerOnCanvas(data.layer);
       }
@@ -403,12 +453,30 @@ function App() {
     }
   };
 
+  const viewScale = (zoom) => zoom * (window.devicePixelRatio || 1);
+
+  const upgradeProxies = (zoom) => {
+    // Swap proxy images for the original once they would be drawn larger than the proxy itself
+    canvas.getObjects().forEach(obj => {
+      if (!obj.fullSrc || obj.getScaledWidth() * viewScale(zoom) <= obj.proxyWidth) return;
+      const width = obj.getScaledWidth();
+      const height = obj.getScaledHeight();
+      const fullSrc = obj.fullSrc;
+      delete obj.fullSrc;
+      obj.setSrc(resolveAssetUrl(fullSrc), () => {
+        obj.set({ scaleX: width / obj.width, scaleY: height / obj.height });
+        canvas.renderAll();
+      }, { crossOrigin: 'anonymous' });
+    });
+  };
+
   // Zoom functions
   const zoomIn = () => {
     if (!canvas) return;
     const newZoom = Math.min(zoomLevel + 25, 500);
     setZoomLevel(newZoom);
     canvas.setZoom(newZoom / 100);
+    upgradeProxies(newZoom / 100);
     canvas.renderAll();
   };
 
@@ -427,17 +495,36 @@ function App() {
     canvas.renderAll();
   };
 
-  // Undo/Redo
-  const undo = () => {
-    if (!canvas) return;
-    // Fabric.js doesn't have built-in undo/redo, would need to implement state management
-    console.log('Undo functionality would be implemented here');
+  // Undo/Redo: the server keeps the project's history, so undo works across sessions and collaborators
+  const stepHistory = async (action) => {
+    if (!currentProject) return;
+    
+    try {
+      const token = localStorage.getItem('token');
+      const response = await fetch(`${API_BASE_URL}/api/projects/${currentProject.id}/${action}`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${token}`
+        },
+        body: JSON.stringify({ revision: revisionRef.current })
+      });
+      
+      if (response.ok) {
+        openProject(await response.json());
+      } else if (response.status === 409) {
+        const data = await response.json();
+        // A revision mismatch means someone else changed the project; "nothing to undo" is just ignored
+        if (data.detail && data.detail.revision !== undefined) reloadProject();
+      }
+    } catch (error) {
+      console.error(`Error during ${action}:`, error);
+    }
   };
 
-  const redo = () => {
-    if (!canvas) return;
-    console.log('Redo functionality would be implemented here');
-  };
+  const undo = () => stepHistory('undo');
+
+  const redo = () => stepHistory('redo');
 
   // Chat functions
   const sendChatMessage = async () => {
@@ -493,6 +580,13 @@ function App() {
         // Update layer from another user
         console.log('Layer update:', data);
         break;
+      case 'ops_ack':
+        revisionRef.current = data.revision;
+        break;
+      case 'ops_error':
+      case 'project_reload':
+        reloadProject();
+        break;
       default:
         console.log('Unknown collaboration message:', data);
     }
@@ -631,14 +725,30 @@ function App() {
                 className={`p-3 rounded-lg cursor-pointer transition-colors ${
                   currentProject?.id === project.id ? 'bg-blue-600' : 'bg-gray-700 hover:bg-gray-600'
                 }`}
-                onClick={() => openProject(project)}
+                onClick={() => fetchAndOpenProject(project.id)}
               >
+                {project.thumbnail && (
+                  <img
+                    src={resolveAssetUrl(project.thumbnail)}
+                    alt=""
+                    loading="lazy"
+                    className="w-full h-24 object-contain bg-gray-900 rounded mb-2"
+                  />
+                )}
                 <div className="font-medium">{project.name}</div>
                 <div className="text-sm text-gray-400">
                   {project.width} × {project.height}
                 </div>
               </div>
             ))}
+            {projectsCursor && (
+              <button
+                className="w-full p-2 rounded-lg bg-gray-700 hover:bg-gray-600 text-sm"
+                onClick={() => loadProjects(projectsCursor)}
+              >
+                Load more
+              </button>
+            )}
           </div>
         </div>
 
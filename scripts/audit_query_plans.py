@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Query plan audit.
+Creates the API's indexes on the target database, explains every query shape the API issues and
+exits non-zero if any of them is answered by a collection scan.
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from indexes import audit_query_plans, ensure_indexes  # noqa: E402
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="pixelcrafter")
+    parser.add_argument("--no-create", action="store_true", help="audit the existing indexes without creating missing ones")
+    args = parser.parse_args()
+
+    db = AsyncIOMotorClient(args.mongo_url)[args.db]
+    if not args.no_create:
+        await ensure_indexes(db)
+    report = await audit_query_plans(db)
+
+    width = max(len(entry["query"]) for entry in report)
+    for entry in report:
+        flag = "COLLSCAN" if entry["collscan"] else "ok"
+        print(f"{entry['query']:<{width}}  {entry['collection']:<13} {flag:<9} {' <- '.join(entry['stages'])}")
+
+    scans = sum(entry["collscan"] for entry in report)
+    print(f"\n{len(report)} queries, {scans} collection scans")
+    sys.exit(1 if scans else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
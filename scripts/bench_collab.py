@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Collaboration fan-out load test.
+Connects hundreds of simulated sockets to one project, a few of them on a slow link, and measures how
+long broadcasts take to reach the healthy clients: once with a sequential send loop (one await per
+socket, as the manager used to do) and once through ConnectionManager's per-socket queues.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from collaboration import ConnectionManager, LocalBackplane  # noqa: E402
+
+
+class SimulatedSocket:
+    def __init__(self, latency):
+        self.latency = latency
+        self.delays = []
+        # No subprotocol offered: the manager falls back to JSON text frames, which send_text() times
+        self.scope = {"subprotocols": []}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        self.delays.append(time.perf_counter() - json.loads(text)["sent_at"])
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000 if ordered else 0.0
+
+
+def make_sockets(args):
+    sockets = [SimulatedSocket(args.latency) for _ in range(args.sockets)]
+    for socket in sockets[:args.slow]:
+        socket.latency = args.slow_latency
+    return sockets
+
+
+async def run_sequential(args):
+    sockets = make_sockets(args)
+    for i in range(args.messages):
+        message = json.dumps({"type": "layer_update", "seq": i, "sent_at": time.perf_counter()})
+        for socket in sockets:
+            await socket.send_text(message)
+        await asyncio.sleep(args.interval)
+    return sockets
+
+
+async def run_queued(args):
+    sockets = make_sockets(args)
+    manager = ConnectionManager(LocalBackplane(), max_queue=args.queue, send_timeout=args.send_timeout)
+    for socket in sockets:
+        await manager.connect(socket, "bench")
+    for i in range(args.messages):
+        await manager.broadcast_to_project("bench", {"type": "layer_update", "seq": i, "sent_at": time.perf_counter()})
+        await asyncio.sleep(args.interval)
+    # Let the healthy queues drain before reading the results
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline and any(len(s.delays) < args.messages for s in sockets[args.slow:]):
+        await asyncio.sleep(0.01)
+    print(f"  manager: {manager.stats()['slow_disconnects']} slow disconnects, max queue depth {manager.stats()['max_queue_depth']}")
+    return sockets
+
+
+def report(name, sockets, args):
+    healthy = [delay for socket in sockets[args.slow:] for delay in socket.delays]
+    print(f"{name:<10} delivered {len(healthy):>6}  p50 {percentile(healthy, 0.50):8.2f} ms  p99 {percentile(healthy, 0.99):8.2f} ms  max {percentile(healthy, 1.0):8.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sockets", type=int, default=300)
+    parser.add_argument("--slow", type=int, default=3, help="sockets on a slow link")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between broadcasts")
+    parser.add_argument("--latency", type=float, default=0.001, help="per-send latency of a healthy socket")
+    parser.add_argument("--slow-latency", type=float, default=0.2)
+    parser.add_argument("--queue", type=int, default=256)
+    parser.add_argument("--send-timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{args.sockets} sockets ({args.slow} slow), {args.messages} broadcasts every {args.interval * 1000:.0f} ms\n")
+    if args.slow * args.slow_latency * args.messages <= 60:
+        report("sequential", await run_sequential(args), args)
+    else:
+        print("sequential skipped (would take over a minute)")
+    report("queued", await run_queued(args), args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Decoded image cache benchmark.
+Runs a burst of filter previews on one large photo (as dragging a filter slider does) and compares decoding
+the upload for every preview with sharing one decoded copy through image_cache.
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from filters import apply_filter_chain, normalize_chain  # noqa: E402
+from image_cache import DecodedImageCache, decode_image  # noqa: E402
+
+
+def make_photo(width, height, rng):
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def preview_chains(count):
+    # Slider positions of one brightness drag, each a separate preview job
+    return [normalize_chain([{"op": "brightness", "params": {"factor": 0.5 + i / count}}]) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--previews", type=int, default=20)
+    args = parser.parse_args()
+
+    raw = make_photo(args.width, args.height, np.random.default_rng(0))
+    chains = preview_chains(args.previews)
+    print(f"{args.previews} filter previews of a {args.width}x{args.height} JPEG ({len(raw) / 1024:.0f} KiB)")
+
+    started = time.perf_counter()
+    for chain in chains:
+        apply_filter_chain(decode_image(raw), chain)
+    uncached = time.perf_counter() - started
+
+    cache = DecodedImageCache()
+    started = time.perf_counter()
+    for chain in chains:
+        apply_filter_chain(cache.get("photo", lambda: raw), chain)
+    cached = time.perf_counter() - started
+
+    print(f"decode per preview  {uncached * 1000 / args.previews:8.1f} ms/preview")
+    print(f"shared decode       {cached * 1000 / args.previews:8.1f} ms/preview  x{uncached / cached:4.2f}")
+    print(f"cache               {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Upload normalization benchmark.
+Builds synthetic phone-style uploads (high-quality JPEGs with an EXIF rotation, at a few sensor sizes) and
+compares what the blob store keeps and what every later decode costs, for the upload as sent versus the
+result of ingest.normalize_image() with the server's defaults.
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from ingest import normalize_image  # noqa: E402
+
+
+def make_upload(width, height, rng):
+    # Smooth gradients plus sensor-like noise compress roughly like a real photo
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # held sideways: rotate 90 degrees to display
+    out = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(out, "JPEG", quality=95, exif=exif)
+    return out.getvalue()
+
+
+def decode_seconds(data, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        Image.open(io.BytesIO(data)).load()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="4032x3024,8160x6120", help="comma-separated sensor sizes")
+    parser.add_argument("--max-edge", type=int, default=4096)
+    parser.add_argument("--format", default="auto")
+    parser.add_argument("--quality", type=int, default=85)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'upload':>12} {'sent KiB':>10} {'stored KiB':>11} {'ratio':>6} {'decode ms':>10} {'-> ms':>7} {'ingest ms':>10}  stored as")
+    for size in args.sizes.split(","):
+        width, height = (int(value) for value in size.split("x"))
+        raw = make_upload(width, height, rng)
+        started = time.perf_counter()
+        result = normalize_image(io.BytesIO(raw), args.max_edge, args.format, args.quality)
+        ingest_seconds = time.perf_counter() - started
+        stored = result["data"] if result["data"] is not None else raw
+        print(f"{size:>12} {len(raw) / 1024:10.0f} {len(stored) / 1024:11.0f} {len(stored) / len(raw):6.1%} "
+              f"{decode_seconds(raw) * 1000:10.1f} {decode_seconds(stored) * 1000:7.1f} {ingest_seconds * 1000:10.1f}  "
+              f"{result['width']}x{result['height']} {result['content_type']}")
+
+
+if __name__ == "__main__":
+    main()
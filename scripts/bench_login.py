@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Login storm benchmark.
+Fires concurrent logins at a running backend while probing /api/health, and reports login throughput
+alongside the latency distribution of the unrelated health endpoint.
+"""
+
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000 if ordered else 0.0
+
+
+async def create_users(client, api, count, password):
+    users = []
+    for _ in range(count):
+        email = f"bench_{uuid.uuid4().hex[:10]}@pixelcraft.com"
+        response = await client.post(f"{api}/auth/register", json={"username": "bench", "email": email, "password": password})
+        response.raise_for_status()
+        users.append(email)
+    return users
+
+
+async def login_storm(client, api, users, password, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def login(email):
+        nonlocal failures
+        async with semaphore:
+            response = await client.post(f"{api}/auth/login", json={"email": email, "password": password})
+            if response.status_code != 200:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login(users[i % len(users)]) for i in range(total)))
+    return time.perf_counter() - start, failures
+
+
+async def probe_health(client, api, stop, interval):
+    """Measure /api/health latency until `stop` is set"""
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get(f"{api}/health")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--probe-interval", type=float, default=0.01)
+    args = parser.parse_args()
+
+    api = f"{args.url}/api"
+    password = "BenchPassword2024!"
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        users = await create_users(client, api, args.users, password)
+
+        stop = asyncio.Event()
+        idle_probe = asyncio.create_task(probe_health(client, api, stop, args.probe_interval))
+        await asyncio.sleep(2)
+        stop.set()
+        idle = await idle_probe
+
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_health(client, api, stop, args.probe_interval))
+        elapsed, failures = await login_storm(client, api, users, password, args.logins, args.concurrency)
+        stop.set()
+        loaded = await probe
+
+    print(f"Logins: {args.logins} in {elapsed:.2f}s ({args.logins / elapsed:.1f}/s), {failures} failed")
+    for label, latencies in (("idle", idle), ("during storm", loaded)):
+        print(
+            f"/api/health {label:<13} n={len(latencies):<5} "
+            f"p50={percentile(latencies, 0.50):7.2f} ms  p99={percentile(latencies, 0.99):7.2f} ms  "
+            f"mean={statistics.mean(latencies) * 1000 if latencies else 0:7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
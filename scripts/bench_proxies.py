@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Progressive loading benchmark.
+Builds a project of synthetic photos, generates their proxy pyramids the way ingest does, and compares
+what opening the project costs at a given viewport scale: bytes the editor downloads and time to decode
+them, for the original images versus the proxies get_project(scale=...) would select.
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from proxies import select_proxy  # noqa: E402
+from image_cache import decode_image  # noqa: E402
+from render import render_proxies  # noqa: E402
+
+
+def make_photo(width, height, rng):
+    # Smooth gradients plus sensor-like noise compress roughly like a real photo
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    noise = rng.normal(0, 12, (height, width, 3))
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def decode_seconds(blobs):
+    started = time.perf_counter()
+    for data in blobs:
+        Image.open(io.BytesIO(data)).load()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--layer-width", type=float, default=600, help="size of each layer on the canvas")
+    parser.add_argument("--scales", default="0.25,0.5,1,2")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    originals = [make_photo(args.width, args.height, rng) for _ in range(args.images)]
+    started = time.perf_counter()
+    pyramids = [render_proxies(decode_image(data).image()) for data in originals]
+    ingest = (time.perf_counter() - started) / args.images
+    layer_height = args.layer_width * args.height / args.width
+
+    print(f"{args.images} images of {args.width}x{args.height}, shown {args.layer_width:.0f} px wide; pyramid build {ingest * 1000:.0f} ms/image\n")
+    full_bytes = sum(len(data) for data in originals)
+    full_decode = decode_seconds(originals)
+    print(f"{'scale':>6} {'bytes':>12} {'of full':>8} {'decode ms':>10} {'of full':>8}")
+    print(f"{'full':>6} {full_bytes:>12,} {'100%':>8} {full_decode * 1000:>10.0f} {'100%':>8}")
+    for scale in (float(value) for value in args.scales.split(",")):
+        chosen = []
+        for original, pyramid in zip(originals, pyramids):
+            proxies = [{"width": w, "height": h, "data": data} for w, h, data in pyramid["levels"]]
+            proxy = select_proxy(proxies, args.layer_width * scale, layer_height * scale)
+            chosen.append(proxy["data"] if proxy else original)
+        size = sum(len(data) for data in chosen)
+        decode = decode_seconds(chosen)
+        print(f"{scale:>6} {size:>12,} {size / full_bytes:>8.1%} {decode * 1000:>10.0f} {decode / full_decode:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
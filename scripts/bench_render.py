@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the server-side compositor.
+Renders a 4K canvas with a mix of image, shape and text layers and reports encode times per format,
+then replays single-layer edits and compares a full re-render with the incremental one (render_cache).
+"""
+
+import io
+import os
+import sys
+import time
+import hashlib
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from render import SourceCache, encode_image, render_project  # noqa: E402
+from render_cache import CompositeCache  # noqa: E402
+
+
+def make_blobs(count, rng):
+    """Create random PNG sources keyed by their hash, standing in for the blob store"""
+    blobs = {}
+    for _ in range(count):
+        w, h = rng.integers(256, 1600, size=2)
+        pixels = rng.integers(0, 255, size=(h, w, 4), dtype=np.uint8)
+        pixels[..., 3] = rng.integers(128, 255)
+        buf = io.BytesIO()
+        Image.fromarray(pixels, "RGBA").save(buf, "PNG", compress_level=1)
+        data = buf.getvalue()
+        blobs[hashlib.sha256(data).hexdigest()] = data
+    return blobs
+
+
+def make_project(width, height, layer_count, blobs, rng):
+    hashes = list(blobs)
+    layers = []
+    for i in range(layer_count):
+        kind = ("image", "shape", "text")[i % 3]
+        layer = {
+            "id": f"layer_{i}",
+            "name": f"Layer {i}",
+            "type": kind,
+            "visible": True,
+            "opacity": float(rng.uniform(0.4, 1.0)),
+            "x": float(rng.uniform(-200, width - 200)),
+            "y": float(rng.uniform(-200, height - 200)),
+            "width": float(rng.uniform(200, 1400)),
+            "height": float(rng.uniform(200, 1000)),
+            "z_index": i,
+        }
+        if kind == "image":
+            layer["data"] = {"blob": hashes[i % len(hashes)]}
+        elif kind == "shape":
+            layer["data"] = {"shape": ("rectangle", "circle")[i % 2], "fill": "#%06x" % rng.integers(0, 0xFFFFFF)}
+        else:
+            layer["width"] = layer["height"] = 0
+            layer["data"] = {"text": f"Layer {i}", "fontSize": 48, "color": "#222222"}
+        layers.append(layer)
+    return {"id": "bench", "name": "bench", "width": width, "height": height, "background_color": "#ffffff", "layers": layers}
+
+
+def single_layer_edits(project, count, rng, drag):
+    """Yield `count` edits of one small layer each: moves, opacity and visibility changes; `drag` keeps moving the same layer"""
+    small = [layer for layer in project["layers"] if layer["type"] != "text" and layer["width"] * layer["height"] < 400_000]
+    dragged = small[-1]
+    for i in range(count):
+        layer = dragged if drag else small[rng.integers(0, len(small))]
+        kind = "move" if drag else ("move", "move", "opacity", "visible")[i % 4]
+        if kind == "move":
+            layer["x"] += float(rng.uniform(-40, 40))
+            layer["y"] += float(rng.uniform(-40, 40))
+        elif kind == "opacity":
+            layer["opacity"] = float(rng.uniform(0.4, 1.0))
+        else:
+            layer["visible"] = not layer["visible"]
+        yield kind
+
+
+def compare_incremental(project, blobs, edits, scale, rng, drag):
+    cache = CompositeCache()
+    sources = SourceCache()
+    read_blob = blobs.__getitem__
+    cache.render(project["id"], project, scale, read_blob, sources)
+    full_seconds = incremental_seconds = 0.0
+    max_difference = 0
+    for _ in single_layer_edits(project, edits, rng, drag):
+        start = time.perf_counter()
+        expected = np.asarray(render_project(project, read_blob, scale, sources))
+        full_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        pixels = cache.render(project["id"], project, scale, read_blob, sources)
+        incremental_seconds += time.perf_counter() - start
+        # Image layers resampled per region may differ from the full render by a rounding step, as tiles do
+        max_difference = max(max_difference, int(np.abs(pixels.astype(np.int16) - expected).max()))
+    return full_seconds / edits, incremental_seconds / edits, max_difference, cache.stats()
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--layers", type=int, default=60)
+    parser.add_argument("--sources", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--edits", type=int, default=20, help="single-layer edits replayed for the incremental comparison")
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    blobs = make_blobs(args.sources, rng)
+    project = make_project(args.width, args.height, args.layers, blobs, rng)
+
+    print(f"Canvas {args.width}x{args.height}, {args.layers} layers, {args.sources} distinct image sources")
+    seconds, image = timed(lambda: render_project(project, blobs.__getitem__), args.repeat)
+    print(f"composite          {seconds * 1000:8.1f} ms")
+    for fmt, quality in (("PNG", 90), ("JPEG", 90), ("WEBP", 85)):
+        seconds, data = timed(lambda: encode_image(image, fmt, quality), args.repeat)
+        print(f"encode {fmt:<5}       {seconds * 1000:8.1f} ms  {len(data) / 1024:10.0f} KiB")
+
+    print(f"\nRe-render after each of {args.edits} single-layer edits at scale {args.scale}")
+    for label, drag in (("scattered edits", False), ("dragging a layer", True)):
+        full, incremental, difference, stats = compare_incremental(project, blobs, args.edits, args.scale, rng, drag)
+        print(f"{label:<18} full {full * 1000:8.1f} ms  incremental {incremental * 1000:8.1f} ms  "
+              f"x{full / incremental:5.1f}  composited {stats['composited_ratio']:.1%}  max diff {difference}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Wire protocol benchmark for the collaboration channel.
+Generates a typical editing session (mostly cursor moves, some layer transforms, a few server patches)
+and compares JSON text frames with the MessagePack subprotocol: bytes on the wire with and without
+permessage-deflate, and encode/decode CPU per message.
+"""
+
+import json
+import time
+import uuid
+import zlib
+import random
+import argparse
+
+import msgpack
+
+
+def make_session(count, rng):
+    senders = [uuid.uuid4().hex for _ in range(4)]
+    layers = [str(uuid.uuid4()) for _ in range(20)]
+    messages = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.80:
+            messages.append({"type": "cursor", "x": round(rng.uniform(0, 1920), 1), "y": round(rng.uniform(0, 1080), 1), "sender": rng.choice(senders)})
+        elif roll < 0.95:
+            messages.append({
+                "type": "layer_update",
+                "layer_id": rng.choice(layers),
+                "data": {"x": round(rng.uniform(0, 1920), 2), "y": round(rng.uniform(0, 1080), 2), "width": 300, "height": 200, "angle": 0},
+                "sender": rng.choice(senders)
+            })
+        else:
+            messages.append({
+                "type": "layers_patch",
+                "data": {
+                    "changes": [{"op": "move", "id": rng.choice(layers), "fields": {"x": rng.randint(0, 1920), "y": rng.randint(0, 1080)}}],
+                    "updated_at": "2024-01-01T12:00:00.%06d" % i,
+                    "revision": i
+                },
+                "user_id": rng.choice(senders)
+            })
+    return messages
+
+
+def json_encode(message):
+    return json.dumps(message, separators=(",", ":"))
+
+
+def deflated_size(frames, context_takeover):
+    # permessage-deflate: raw deflate, sync flush per message, trailing 00 00 ff ff stripped
+    total = 0
+    compressor = zlib.compressobj(wbits=-15)
+    for frame in frames:
+        if not context_takeover:
+            compressor = zlib.compressobj(wbits=-15)
+        data = frame.encode("utf-8") if isinstance(frame, str) else frame
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def timed(fn, items, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - started)
+    return best / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = make_session(args.messages, random.Random(42))
+    codecs = {
+        "json": (json_encode, json.loads),
+        "msgpack": (msgpack.packb, msgpack.unpackb),
+    }
+
+    print(f"{args.messages} messages (80% cursor, 15% layer_update, 5% layers_patch)\n")
+    print(f"{'codec':<8} {'bytes/msg':>10} {'deflate':>10} {'deflate ctx':>12} {'encode us':>10} {'decode us':>10} {'deflate us':>11}")
+    for name, (encode, decode) in codecs.items():
+        frames = [encode(message) for message in messages]
+        raw = sum(len(frame.encode("utf-8") if isinstance(frame, str) else frame) for frame in frames)
+        no_context = deflated_size(frames, context_takeover=False)
+        with_context = deflated_size(frames, context_takeover=True)
+        encode_us = timed(encode, messages, args.repeat)
+        decode_us = timed(decode, frames, args.repeat)
+        started = time.perf_counter()
+        deflated_size(frames, context_takeover=True)
+        deflate_us = (time.perf_counter() - started) / len(frames) * 1e6
+        count = len(frames)
+        print(f"{name:<8} {raw / count:>10.1f} {no_context / count:>10.1f} {with_context / count:>12.1f} {encode_us:>10.2f} {decode_us:>10.2f} {deflate_us:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()